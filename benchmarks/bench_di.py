@@ -0,0 +1,65 @@
+'''Micro-benchmark of resolving dependencies with dither.di, against
+calling a function with its arguments directly.
+
+Run from the repository root:
+
+    python benchmarks/bench_di.py
+'''
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dither.di
+
+REPEATS = 5
+CALLS = 100000
+
+def make_resolver():
+    dependencies = dither.di.DependencyRegister()
+    providers = dither.di.ResourceProviderRegister()
+    resolver = dither.di.DependencyResolver(
+            dependency_register=dependencies,
+            resource_provider_register=providers)
+
+    providers.register_callable(object, 'per_call')
+    providers.register_callable(
+            object, 'singleton', scope=dither.di.SINGLETON)
+    providers.register_callable(
+            object, 'per_build', scope=dither.di.PER_BUILD)
+    return dependencies, resolver
+
+def time_per_call(func):
+    best = min(timeit.repeat(func, number=CALLS, repeat=REPEATS))
+    return best / CALLS * 1e9
+
+def main():
+    dependencies, resolver = make_resolver()
+
+    @dependencies.register_by_decorator('per_call')
+    @dependencies.register_by_decorator('singleton')
+    @dependencies.register_by_decorator('per_build')
+    def dependent(per_call, singleton, per_build):
+        pass
+
+    singleton, per_build = object(), object()
+
+    def call_directly():
+        dependent(object(), singleton, per_build)
+
+    def call_with_injection():
+        dependent(*resolver.resolve_all_dependencies(dependent))
+
+    with resolver.build_scope():
+        results = [
+            ('direct call', time_per_call(call_directly)),
+            ('injected call', time_per_call(call_with_injection)),
+        ]
+
+    for name, nanoseconds in results:
+        print('{:<16}{:>8.0f} ns'.format(name, nanoseconds))
+
+if __name__ == '__main__':
+    main()
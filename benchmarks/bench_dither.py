@@ -0,0 +1,249 @@
+'''Benchmarks of building, linking and updating synthetic dotfiles.
+
+Each run makes a sandbox like the integration tests' (see
+tests/integration/common.py), with a generated dither_templates tree and a
+home directory already full of dotfiles, then times:
+
+    build_cold   the first build, with no caches or previous builds
+    build_warm   building again, with nothing changed
+    link_cold    the first link into the home directory
+    link_warm    linking again, with nothing changed
+    update_warm  `dither update`, with nothing changed
+    update_cold  `dither update`, after one template has changed
+
+Run from the repository root, eg:
+
+    python benchmarks/bench_dither.py --files 2000 --output results.json
+    python benchmarks/bench_dither.py --compare results.json
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import statistics
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'tests', 'integration'))
+
+import dither.di
+import dither.link
+import dither.build
+import dither.resources
+from dither.cli import cli
+
+from common import CreateDitherSandboxDirMixin, create_test_context
+
+TIMINGS = (
+        'build_cold', 'build_warm', 'link_cold', 'link_warm', 'update_warm',
+        'update_cold')
+
+TEMPLATE_DIR_FMT = '.bench_{level}'
+TEMPLATE_NAME_FMT = '.bench_file_{index}.conf.template'
+PARTIALS_DIR_NAME = '.bench_partials'
+PARTIAL_NAME_FMT = 'partial_{index}.inc'
+HOME_FILE_NAME_FMT = '.existing_{index}'
+# Each line of template output is this long, including its newline
+LINE_LENGTH = 64
+
+class Sandbox(CreateDitherSandboxDirMixin):
+    pass
+
+def get_template_subdir(index, depth):
+    # Spread templates evenly between the top level and each nested level
+    levels = index % (depth + 1)
+    return os.path.join('', *[
+            TEMPLATE_DIR_FMT.format(level=level) for level in range(levels)])
+
+def make_template_text(index, fan_out, output_size):
+    lines = ['# Template {} for {{{{ hostname }}}}'.format(index)]
+    for partial in range(fan_out):
+        lines.append('{{% include "{}/{}" %}}'.format(
+                PARTIALS_DIR_NAME,
+                PARTIAL_NAME_FMT.format(index=(index + partial) % fan_out)))
+    lines.append(
+            '{{% for line in range({}) %}}{{{{ "%063d" % line }}}}\n'
+            '{{% endfor %}}'.format(output_size // LINE_LENGTH))
+    return '\n'.join(lines) + '\n'
+
+def create_template_tree(templates_dir, files, depth, fan_out, output_size):
+    '''Generate a dither_templates tree of files templates, nested up to
+    depth directories deep, each including fan_out partials and rendering
+    to about output_size bytes.
+    '''
+    partials_dir = os.path.join(templates_dir, PARTIALS_DIR_NAME)
+    os.makedirs(partials_dir)
+    for index in range(fan_out):
+        partial_path = os.path.join(
+                partials_dir, PARTIAL_NAME_FMT.format(index=index))
+        with open(partial_path, 'w') as f:
+            f.write('# Partial {} on {{{{ os_family }}}}\n'.format(index))
+
+    for index in range(files):
+        template_dir = os.path.join(
+                templates_dir, get_template_subdir(index, depth))
+        os.makedirs(template_dir, exist_ok=True)
+        template_path = os.path.join(
+                template_dir, TEMPLATE_NAME_FMT.format(index=index))
+        with open(template_path, 'w') as f:
+            f.write(make_template_text(index, fan_out, output_size))
+
+    create_test_context(templates_dir)
+
+def create_home_files(home_dir, home_files):
+    for index in range(home_files):
+        home_file_path = os.path.join(
+                home_dir, HOME_FILE_NAME_FMT.format(index=index))
+        with open(home_file_path, 'w') as f:
+            f.write('existing dotfile {}\n'.format(index))
+
+def quieten_build_log():
+    logger = dither.di.resolver.resolve('logger')
+    logger.setLevel(logging.WARNING)
+
+def build():
+    dither.build.build()
+
+def link(home_dir):
+    dither.link.link(
+            base_build_dir=dither.link.BASE_BUILD_DIR, home_dir=home_dir)
+
+def update():
+    cli.main(args=['update'], standalone_mode=False)
+
+def change_template(templates_dir):
+    template_path = os.path.join(
+            templates_dir, TEMPLATE_NAME_FMT.format(index=0))
+    with open(template_path, 'a') as f:
+        f.write('# Changed\n')
+
+def time_call(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+def run_once(args):
+    '''Time everything in TIMINGS once, in a new sandbox.
+    '''
+    sandbox = Sandbox()
+    sandbox.create_dither_sandbox_dir()
+    previous_cwd = os.getcwd()
+    previous_home = os.environ.get('HOME')
+    try:
+        create_template_tree(
+                sandbox.templates_dir, files=args.files, depth=args.depth,
+                fan_out=args.fan_out, output_size=args.output_size)
+        create_home_files(sandbox.home_dir, args.home_files)
+        sandbox.change_cwd_to_sandbox_dither_dir()
+        # `dither update` links into ~
+        os.environ['HOME'] = sandbox.home_dir
+
+        timings = {}
+        timings['build_cold'] = time_call(build)
+        timings['build_warm'] = time_call(build)
+        timings['link_cold'] = time_call(link, sandbox.home_dir)
+        timings['link_warm'] = time_call(link, sandbox.home_dir)
+        timings['update_warm'] = time_call(update)
+        change_template(sandbox.templates_dir)
+        timings['update_cold'] = time_call(update)
+        return timings
+    finally:
+        os.chdir(previous_cwd)
+        if previous_home is None:
+            del os.environ['HOME']
+        else:
+            os.environ['HOME'] = previous_home
+        shutil.rmtree(sandbox.sandbox_root_dir)
+
+def summarise(runs):
+    summary = {}
+    for name in TIMINGS:
+        seconds = [timings[name] for timings in runs]
+        summary[name] = {
+            'min': min(seconds),
+            'median': statistics.median(seconds),
+            'runs': seconds,
+        }
+    return summary
+
+def format_results(summary, previous_summary=None):
+    lines = ['{:<14}{:>12}{:>12}'.format('', 'min (s)', 'median (s)')]
+    for name in TIMINGS:
+        line = '{:<14}{:>12.3f}{:>12.3f}'.format(
+                name, summary[name]['min'], summary[name]['median'])
+        if previous_summary and name in previous_summary:
+            previous_median = previous_summary[name]['median']
+            if previous_median:
+                line += '{:>+9.1f}%'.format(
+                        (summary[name]['median'] / previous_median - 1)
+                        * 100)
+        lines.append(line)
+    return '\n'.join(lines)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+            description='Time dither build, link and update.')
+    parser.add_argument(
+            '--files', type=int, default=500,
+            help='Number of templates to generate.')
+    parser.add_argument(
+            '--depth', type=int, default=3,
+            help='How many directories deep templates are nested.')
+    parser.add_argument(
+            '--fan-out', type=int, default=4,
+            help='Number of partials each template includes.')
+    parser.add_argument(
+            '--output-size', type=int, default=4096,
+            help='Roughly how many bytes each template renders to.')
+    parser.add_argument(
+            '--home-files', type=int, default=2000,
+            help='Number of dotfiles already in the home directory.')
+    parser.add_argument(
+            '--repeat', type=int, default=3,
+            help='Number of sandboxes to time everything in.')
+    parser.add_argument(
+            '--output', metavar='PATH',
+            help='Save the results as JSON.')
+    parser.add_argument(
+            '--compare', metavar='PATH',
+            help='Show the change in median times from earlier results.')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    quieten_build_log()
+
+    runs = [run_once(args) for repeat in range(args.repeat)]
+    summary = summarise(runs)
+
+    previous_summary = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            previous_summary = json.load(f)['timings']
+    print(format_results(summary, previous_summary))
+
+    if args.output:
+        results = {
+            'parameters': {
+                'files': args.files,
+                'depth': args.depth,
+                'fan_out': args.fan_out,
+                'output_size': args.output_size,
+                'home_files': args.home_files,
+                'repeat': args.repeat,
+            },
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'timings': summary,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
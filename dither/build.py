@@ -1,43 +1,253 @@
-import logging
 import os
 import sys
+import shutil
+import fnmatch
 import datetime
+import functools
+import multiprocessing
+import concurrent.futures
+import hashlib
+import contextlib
 
 import staticjinja
 import jinja2
+import jinja2.bccache
 
 from . import context
+from . import manifest
+from . import deps
+from . import link
+from . import timing
+from . import store
+from . import fastcopy
+from . import retention
+from . import fingerprint
+from . import catalogue
+from . import facts
+from . import di
+from . import resources
+
+PROG_NAME = 'dither'
 
 TEMPLATES_DIR = 'dither_templates'
 BUILD_OUTPUT_DIR = 'built_dotfiles'
 OUTPUT_SUBDIR_FMT = 'built_at_{timestamp}'
+HOSTS_SUBDIR = retention.HOSTS_SUBDIR
 TIMESTAMP_FMT = '%Y-%m-%d_%H-%M-%S'
 TEMPLATE_EXTENSIONS = ('.template', '.tpl')
 CONTEXT_PATH = os.path.join(TEMPLATES_DIR, 'template_context.py')
 LATEST_BUILD_LINK_NAME = 'latest_build'
+MANIFEST_PATH = os.path.join(BUILD_OUTPUT_DIR, manifest.MANIFEST_NAME)
+DEPENDENCY_INDEX_PATH = os.path.join(
+        BUILD_OUTPUT_DIR, deps.DEPENDENCY_INDEX_NAME)
+BYTECODE_CACHE_DIR = os.path.join(BUILD_OUTPUT_DIR, 'bytecode_cache')
+# Rendered text is encoded, hashed and written in pieces of about this
+# many characters
+WRITE_CHUNK_SIZE = 64 * 1024
+# Rendered outputs up to this many bytes are hashed before being written,
+# so that one identical to the previous build's is never written at all
+IN_MEMORY_OUTPUT_LIMIT = 1024 * 1024
+OBJECT_STORE_DIR = os.path.join(BUILD_OUTPUT_DIR, store.OBJECTS_DIR_NAME)
+FACT_CACHE_PATH = os.path.join(BUILD_OUTPUT_DIR, facts.FACT_CACHE_NAME)
+FINGERPRINT_PATH = os.path.join(
+        BUILD_OUTPUT_DIR, fingerprint.FINGERPRINT_NAME)
 
 
 def get_logger():
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.DEBUG)
-    logger.addHandler(logging.StreamHandler())
-    return logger
+    return di.resolver.resolve('logger')
 
 def ensure_dir_exists(dir_path):
     if not os.path.exists(dir_path):
         os.makedirs(dir_path)
 
-def get_build_output_subdir():
+def get_build_output_subdir(build_output_dir=BUILD_OUTPUT_DIR):
     timestamp = datetime.datetime.now().strftime(TIMESTAMP_FMT)
     subdir_name = OUTPUT_SUBDIR_FMT.format(timestamp=timestamp)
-    outpath = os.path.join(BUILD_OUTPUT_DIR, subdir_name)
+    outpath = os.path.join(build_output_dir, subdir_name)
+
+    # Never build into an existing directory: an earlier build in the same
+    # second may be the one we're carrying unchanged outputs forward from.
+    suffix = 0
+    while os.path.lexists(outpath):
+        suffix += 1
+        outpath = os.path.join(
+                build_output_dir, '{}_{}'.format(subdir_name, suffix))
+
     ensure_dir_exists(outpath)
     return outpath
 
+def get_temp_path(file_path):
+    return '{}.tmp-{}-{}'.format(file_path, PROG_NAME, os.getpid())
+
+def get_shared_output_key(name, inputs):
+    return '{}:{}'.format(name, manifest.hash_context(inputs))
+
+def carry_forward_file(previous_path, new_path):
+    '''Put an unchanged output from a previous build into the new build.
+
+    This hardlinks where possible, and falls back to copying (eg if the
+    builds are on different filesystems).
+    '''
+    ensure_dir_exists(os.path.dirname(new_path))
+    if os.path.lexists(new_path):
+        if os.path.samefile(previous_path, new_path):
+            return
+        # Replace, rather than overwrite, the existing file: it may be
+        # hardlinked into other builds
+        place_path = get_temp_path(new_path)
+    else:
+        place_path = new_path
+
+    store.link_or_copy(previous_path, place_path)
+
+    if place_path != new_path:
+        os.replace(place_path, new_path)
+
+def encode_chunks(chunks, encoding):
+    '''Encode strings as they're produced, in pieces of about
+    WRITE_CHUNK_SIZE characters.
+    '''
+    pending = []
+    pending_size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size >= WRITE_CHUNK_SIZE:
+            yield ''.join(pending).encode(encoding)
+            pending = []
+            pending_size = 0
+    if pending:
+        yield ''.join(pending).encode(encoding)
+
+def spool_chunks(chunks, file_path, encoding):
+    '''Encode and hash strings as they're produced.
+
+    Returns the hash of the encoded content, and the content itself if it's
+    no bigger than IN_MEMORY_OUTPUT_LIMIT. Anything bigger is written to
+    file_path as it's produced instead, so the whole content is never in
+    memory at once, and None is returned in place of the content.
+    '''
+    hasher = manifest.new_hasher()
+    pieces = []
+    size = 0
+    f = None
+    try:
+        for piece in encode_chunks(chunks, encoding):
+            hasher.update(piece)
+            if f is not None:
+                f.write(piece)
+                continue
+            pieces.append(piece)
+            size += len(piece)
+            if size > IN_MEMORY_OUTPUT_LIMIT:
+                f = open(file_path, 'wb')
+                f.writelines(pieces)
+                pieces = None
+    except BaseException:
+        if f is not None:
+            f.close()
+            os.remove(file_path)
+        raise
+
+    if f is not None:
+        f.close()
+        return hasher.hexdigest(), None
+    return hasher.hexdigest(), b''.join(pieces)
+
+def copy_file_atomically(source_path, dest_path):
+    ensure_dir_exists(os.path.dirname(dest_path))
+    temp_path = get_temp_path(dest_path)
+    fastcopy.copy_file(source_path, temp_path)
+    os.replace(temp_path, dest_path)
+
+class TemplateBytecodeCache(jinja2.FileSystemBytecodeCache):
+    '''An on-disk cache of compiled templates.
+
+    Unlike jinja2's default, which keeps one entry per template name and
+    overwrites it whenever the source changes, entries are keyed by the
+    template's source and the jinja2 version too. Switching back to an
+    earlier version of a template (eg by changing git branch) then hits
+    the cache, and upgrading jinja2 never loads stale bytecode.
+    '''
+
+    def get_key(self, name, filename, source):
+        return hashlib.sha1('|'.join([
+                self.get_cache_key(name, filename),
+                self.get_source_checksum(source),
+                jinja2.__version__,
+        ]).encode('utf-8')).hexdigest()
+
+    def get_bucket(self, environment, name, filename, source):
+        checksum = self.get_source_checksum(source)
+        key = self.get_key(name, filename, source)
+        bucket = jinja2.bccache.Bucket(environment, key, checksum)
+        self.load_bytecode(bucket)
+        return bucket
+
+    def prune(self, environment):
+        '''Delete entries for anything but the current source of each
+        template environment can load, and return how many were deleted.
+        '''
+        current_filenames = set()
+        for name in environment.list_templates():
+            try:
+                source, filename, _unused = environment.loader.get_source(
+                        environment, name)
+            except (jinja2.TemplateNotFound, UnicodeDecodeError):
+                # Removed since listing, or not a template at all
+                continue
+            current_filenames.add(
+                    self.pattern % (self.get_key(name, filename, source),))
+
+        pruned = 0
+        for filename in fnmatch.filter(
+                os.listdir(self.directory), self.pattern % ('*',)):
+            if filename not in current_filenames:
+                os.remove(os.path.join(self.directory, filename))
+                pruned += 1
+        return pruned
+
+def clear_bytecode_cache(cache_dir=BYTECODE_CACHE_DIR):
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+
+def prune_bytecode_cache(cache_dir=BYTECODE_CACHE_DIR,
+                         templates_dir=TEMPLATES_DIR):
+    '''Delete compiled templates cached for sources which have since
+    changed or been removed, and return how many were deleted.
+    '''
+    if not os.path.isdir(cache_dir):
+        return 0
+    environment = make_environment(
+            templates_dir, bytecode_cache_dir=cache_dir)
+    return environment.bytecode_cache.prune(environment)
+
 class CustomRenderer(staticjinja.Renderer):
 
     TEMPLATE_EXTENSIONS = ('.template', '.tpl')
 
+    def __init__(self, *args, previous_manifest=None, dependency_index=None,
+                 shared_outputs=None, profiler=None, object_store=None,
+                 **kwargs):
+        super(CustomRenderer, self).__init__(*args, **kwargs)
+        self.profiler = profiler or timing.NullProfiler()
+        # Where outputs are stored by content, if anywhere. Without one,
+        # outputs are written straight into the build.
+        self.object_store = object_store
+        # Manifest of the last build, used to find outputs which can be
+        # carried forward instead of being rendered again
+        self.previous_manifest = previous_manifest
+        # Outputs other renderers have already produced in this run (eg for
+        # other hosts), keyed by the inputs they were produced from
+        self.shared_outputs = shared_outputs
+        self.manifest = manifest.BuildManifest(build_path=self.outpath)
+        if dependency_index is None:
+            dependency_index = deps.DependencyIndex(self._env)
+        self.dependency_index = dependency_index
+        # How many outputs were written, and how many were reused unchanged
+        self.output_counts = {'written': 0, 'reused': 0}
+        self._source_hashes = {}
+
     def transform_template_path(self, template_path):
         for extension in TEMPLATE_EXTENSIONS:
             if template_path.endswith(extension):
@@ -47,6 +257,10 @@ class CustomRenderer(staticjinja.Renderer):
         else:
             return template_path
 
+    def get_output_path(self, template_name):
+        return self.transform_template_path(
+                os.path.join(self.outpath, template_name))
+
     def is_static(self, filename):
         '''Only files ending in .tpl or .template are considered templates
         '''
@@ -60,6 +274,22 @@ class CustomRenderer(staticjinja.Renderer):
         '''
         return False
 
+    def find_dependent_names(self, filename):
+        '''Find the names of every template which needs rendering again
+        when filename changes.
+        '''
+        template_names = set(self.template_names)
+        for template_name in template_names:
+            self.find_referenced_templates(template_name)
+        return sorted(
+                template_names &
+                self.dependency_index.find_dependents([filename]))
+
+    def get_dependencies(self, filename):
+        return [
+                self.get_template(name)
+                for name in self.find_dependent_names(filename)]
+
     def is_ignored(self, filename):
         '''Prevent dotfiles being ignored as templates
         '''
@@ -67,24 +297,408 @@ class CustomRenderer(staticjinja.Renderer):
             return True
         if filename == os.path.basename(CONTEXT_PATH):
             return True
-        if 'context' in filename:
-            raise Exception("filename is: {!r}".format(filename))
         return False
 
+    def get_context_for_name(self, template_name):
+        '''Like get_context(), but without needing a compiled Template.
+        '''
+        try:
+            context_generator = self._get_context_generator(template_name)
+        except ValueError:
+            return {}
+        return context_generator()
+
+    def hash_source(self, name):
+        '''Hash a source file, or return None if it doesn't exist (eg a
+        partial included with `ignore missing`).
+        '''
+        if name not in self._source_hashes:
+            try:
+                source_hash = manifest.hash_file(
+                        os.path.join(self.searchpath, name))
+            except FileNotFoundError:
+                source_hash = None
+            self._source_hashes[name] = source_hash
+        return self._source_hashes[name]
+
+    def forget_sources(self, names):
+        '''Drop anything cached about the given source files, eg because
+        they've been modified.
+        '''
+        for name in names:
+            self._source_hashes.pop(name, None)
+
+    def find_referenced_templates(self, template_name):
+        return self.dependency_index.find_referenced_templates(
+                template_name, self.hash_source)
+
+    def select_context(self, build_context, template_name, partials):
+        '''Pick out the part of the build context a template uses, so lazy
+        values no template needs are never computed.
+        '''
+        if partials is None:
+            # Can't tell what the template uses, so give it everything
+            return dict(build_context)
+
+        variables = self.dependency_index.find_referenced_variables(
+                template_name, partials)
+        return {
+                name: build_context[name]
+                for name in variables if name in build_context}
+
+    def get_template_inputs(self, template_name, context, partials):
+        if partials is not None:
+            partials = {
+                    partial_name: self.hash_source(partial_name)
+                    for partial_name in partials}
+
+        return {
+            'source': self.hash_source(template_name),
+            'partials': partials,
+            'context': manifest.hash_context(context),
+        }
+
+    def is_output_intact(self, previous_output):
+        '''Check an earlier output still has the content recorded for it,
+        rather than having been edited (eg through its link in the home
+        directory). Outputs with no recorded hash can't be checked.
+        '''
+        previous_path, output_hash = previous_output
+        if output_hash is None:
+            return True
+        if (self.object_store is not None
+                and self.object_store.has_object(output_hash)):
+            return True
+        return manifest.hash_file(previous_path) == output_hash
+
+    def find_previous_output(self, find_func_name, name, inputs):
+        '''Find an intact output built from identical inputs, by the
+        previous build or another renderer sharing shared_outputs.
+
+        Returns its path and hash (None if it wasn't recorded),
+        or None if there's no such output.
+        '''
+        if self.previous_manifest is not None:
+            find_func = getattr(self.previous_manifest, find_func_name)
+            previous_output = find_func(name, inputs)
+            if (previous_output is not None
+                    and self.is_output_intact(previous_output)):
+                return previous_output
+
+        if self.shared_outputs is not None:
+            shared_output = self.shared_outputs.get(
+                    get_shared_output_key(name, inputs))
+            if (shared_output is not None
+                    and os.path.isfile(shared_output[0])
+                    and self.is_output_intact(shared_output)):
+                return shared_output
+
+        return None
+
+    def share_output(self, name, entry):
+        '''Offer an output to other renderers sharing this one's
+        shared_outputs.
+        '''
+        if self.shared_outputs is None:
+            return
+        inputs = manifest.get_inputs(entry)
+        self.shared_outputs[get_shared_output_key(name, inputs)] = (
+                os.path.join(self.outpath, entry['output']),
+                entry.get('hash'))
+
+    def find_identical_output(self, template_name, output_hash):
+        if self.previous_manifest is None:
+            return None
+        previous_path = self.previous_manifest.find_template_output_by_hash(
+                template_name, output_hash)
+        if previous_path is None:
+            return None
+        if not self.is_output_intact((previous_path, output_hash)):
+            return None
+        return previous_path, output_hash
+
+    def count_output(self, kind):
+        self.output_counts[kind] += 1
+
+    def pop_output_counts(self):
+        output_counts = self.output_counts
+        self.output_counts = dict.fromkeys(output_counts, 0)
+        return output_counts
+
+    def merge_output_counts(self, output_counts):
+        for kind, count in output_counts.items():
+            self.output_counts[kind] += count
+
+    def carry_forward(self, previous_output, output_path):
+        '''Put an unchanged output into this build, and return its hash.
+        '''
+        previous_path, output_hash = previous_output
+        if self.object_store is None:
+            carry_forward_file(previous_path, output_path)
+            return output_hash
+
+        if output_hash is None or not self.object_store.has_object(
+                output_hash):
+            output_hash = self.object_store.adopt(previous_path)
+        self.object_store.materialise(output_hash, output_path)
+        return output_hash
+
+    def build_template(self, template_name):
+        '''Render a template, or carry its output forward from the
+        previous build if none of its inputs have changed.
+        '''
+        with self.profiler.measure('template', template_name) as event:
+            filepath = self.get_output_path(template_name)
+            partials = self.find_referenced_templates(template_name)
+            context = self.select_context(
+                    self.get_context_for_name(template_name),
+                    template_name,
+                    partials)
+            inputs = self.get_template_inputs(
+                    template_name, context, partials)
+
+            previous_output = self.find_previous_output(
+                    'find_reusable_template_output', template_name, inputs)
+            if previous_output is not None:
+                self.logger.info("Reusing unchanged %s..." % template_name)
+                output_hash = self.carry_forward(previous_output, filepath)
+                self.count_output('reused')
+            else:
+                with self.profiler.measure('compile', template_name):
+                    template = self.get_template(template_name)
+                with self.profiler.measure(
+                        'render', template_name) as render_event:
+                    output_hash = self.render_template(
+                            template, context=context, filepath=filepath)
+                    render_event['bytes'] = event['bytes'] = (
+                            os.path.getsize(filepath))
+
+        self.manifest.record_template(
+                template_name, filepath, inputs, output_hash=output_hash)
+        self.share_output(
+                template_name, self.manifest.templates[template_name])
+
     def render_template(self, template, context=None, filepath=None):
-        '''Render a template.
+        '''Render a template, and return the hash of its output.
 
         This wraps the parent class implementation to strip template
         extensions (eg '.template') from filepath, so
         'my_subdir/my_file.conf.template' becomes
         'my_subdir/my_file.conf'.
+
+        Output is hashed as it's produced by Template.generate(). If it's
+        identical to the previous build's output, that file is linked
+        into this build rather than writing a new one. Otherwise it's
+        written to a temporary file, which then replaces filepath, so a
+        half-written file is never visible and files hardlinked into other
+        builds are left untouched. With an object store, the temporary
+        file is added to the store and filepath is linked to it.
         '''
+        try:
+            self.get_rule(template.name)
+        except ValueError:
+            pass
+        else:
+            # Rules write their output wherever they like
+            super(CustomRenderer, self).render_template(
+                    template, context=context, filepath=filepath)
+            self.count_output('written')
+            return None
+
+        self.logger.info("Rendering %s..." % template.name)
+        if context is None:
+            context = self.get_context(template)
         if filepath is None:
-            filepath = os.path.join(self.outpath, template.name)
-        filepath = self.transform_template_path(filepath)
+            filepath = self.get_output_path(template.name)
+        if self.object_store is None:
+            ensure_dir_exists(os.path.dirname(filepath))
+            temp_filepath = get_temp_path(filepath)
+        else:
+            temp_filepath = self.object_store.make_temp_path()
+
+        # Large outputs are streamed straight to temp_filepath
+        output_hash, data = spool_chunks(
+                template.generate(**context), temp_filepath, self.encoding)
+
+        identical_output = self.find_identical_output(
+                template.name, output_hash)
+        if identical_output is not None:
+            if data is None:
+                os.remove(temp_filepath)
+            self.carry_forward(identical_output, filepath)
+            self.count_output('reused')
+            return output_hash
+
+        if data is not None:
+            with open(temp_filepath, 'wb') as f:
+                f.write(data)
+        if self.object_store is None:
+            os.replace(temp_filepath, filepath)
+        else:
+            self.object_store.add_file(temp_filepath, digest=output_hash)
+            self.object_store.materialise(output_hash, filepath)
+        self.count_output('written')
+        return output_hash
+
+    def build_static(self, static_name):
+        with self.profiler.measure('static', static_name) as event:
+            output_location = os.path.join(self.outpath, static_name)
+            inputs = {'source': self.hash_source(static_name)}
+
+            previous_output = self.find_previous_output(
+                    'find_reusable_static_output', static_name, inputs)
+            if previous_output is not None:
+                self.logger.info("Reusing unchanged %s..." % static_name)
+                output_hash = self.carry_forward(
+                        previous_output, output_location)
+                self.count_output('reused')
+            else:
+                self.logger.info("Copying %s..." % static_name)
+                source_path = os.path.join(self.searchpath, static_name)
+                if self.object_store is None:
+                    output_hash = None
+                    copy_file_atomically(source_path, output_location)
+                else:
+                    output_hash = self.object_store.add_copy(
+                            source_path, digest=inputs['source'])
+                    self.object_store.materialise(
+                            output_hash, output_location)
+                self.count_output('written')
+                event['bytes'] = os.path.getsize(output_location)
+
+        self.manifest.record_static(
+                static_name, output_location, inputs, output_hash=output_hash)
+        self.share_output(static_name, self.manifest.static[static_name])
+
+    def copy_static(self, files):
+        for static_name in files:
+            self.build_static(static_name)
+
+    def save_dependency_index(self, index_path):
+        self.dependency_index.prune(self.template_names)
+        self.dependency_index.save(index_path)
+
+    def build_in_pool(self, jobs, template_names, static_names):
+        '''Build templates and static files across a pool of workers.
+
+        Each worker keeps its own copy of this renderer, and so its own
+        jinja2 Environment and compiled template cache, for the whole
+        build. Outputs are recorded in this renderer's manifest exactly as
+        a serial build would record them.
+        '''
+        if template_names:
+            # Compute the shared context before the workers are started, so
+            # they inherit it rather than each computing their own
+            self.get_context_for_name(template_names[0])
+
+        tasks = (
+                [('template', name) for name in template_names] +
+                [('static', name) for name in static_names])
+        chunksize = max(1, len(tasks) // (jobs * 4))
+
+        with make_worker_pool(jobs, self) as pool:
+            results = pool.map(_build_in_worker, tasks, chunksize=chunksize)
+            for (kind, name), result in zip(tasks, results):
+                entry, index_entries, profile_events, output_counts = result
+                if kind == 'template':
+                    self.manifest.templates[name] = entry
+                else:
+                    self.manifest.static[name] = entry
+                self.share_output(name, entry)
+                self.dependency_index.merge(index_entries)
+                self.profiler.merge(profile_events)
+                self.merge_output_counts(output_counts)
+
+    def run(self, use_reloader=False, jobs=1):
+        '''Build every template and static file.
 
-        return super(CustomRenderer, self).render_template(
-                template, context=context, filepath=filepath)
+        Unlike the parent class, this doesn't compile templates whose
+        outputs can be carried forward from the previous build, and can
+        spread the work over several processes.
+
+        :param jobs: the number of workers to build with. 0 means one per
+                     CPU. Where processes can't be forked, this is ignored
+                     and everything is built in this process.
+        '''
+        if not jobs:
+            jobs = os.cpu_count() or 1
+
+        if jobs > 1 and can_fork_workers():
+            self.build_in_pool(
+                    jobs, list(self.template_names), list(self.static_names))
+        else:
+            for template_name in self.template_names:
+                self.build_template(template_name)
+            self.copy_static(self.static_names)
+        self.logger.info(
+                "Wrote %d files, reused %d unchanged files." % (
+                    self.output_counts['written'],
+                    self.output_counts['reused']))
+
+        if use_reloader:
+            self.logger.info("Watching '%s' for changes..." %
+                             self.searchpath)
+            self.logger.info("Press Ctrl+C to stop.")
+            staticjinja.Reloader(self).watch()
+
+# The renderer each worker in a build pool uses. Set once as each worker
+# starts, so it's inherited rather than sent along with every task.
+_worker_renderer = None
+
+def _init_worker_process(renderer):
+    global _worker_renderer
+    _worker_renderer = renderer
+    # Only report back what this worker does, not what it inherited
+    renderer.dependency_index.pop_updated()
+    renderer.profiler.pop_events()
+    renderer.pop_output_counts()
+
+def _build_in_worker(task):
+    kind, name = task
+    if kind == 'template':
+        _worker_renderer.build_template(name)
+        entry = _worker_renderer.manifest.templates[name]
+    else:
+        _worker_renderer.build_static(name)
+        entry = _worker_renderer.manifest.static[name]
+    return (
+            entry,
+            _worker_renderer.dependency_index.pop_updated(),
+            _worker_renderer.profiler.pop_events(),
+            _worker_renderer.pop_output_counts())
+
+def can_fork_workers():
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+def make_worker_pool(jobs, renderer):
+    '''Get a pool of forked processes which build with the given
+    renderer, each inheriting its own copy of it without it needing to be
+    pickled.
+
+    There's no fallback to threads: they would share one renderer, whose
+    manifest, output counts, profile and dependency index aren't safe to
+    update from several threads at once.
+    '''
+    return concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=multiprocessing.get_context('fork'),
+            initializer=_init_worker_process,
+            initargs=(renderer,))
+
+def make_environment(searchpath, encoding='utf8', extensions=None,
+                     bytecode_cache_dir=None):
+    loader = jinja2.FileSystemLoader(
+            searchpath=os.path.abspath(searchpath), encoding=encoding)
+
+    bytecode_cache = None
+    if bytecode_cache_dir is not None:
+        ensure_dir_exists(bytecode_cache_dir)
+        bytecode_cache = TemplateBytecodeCache(directory=bytecode_cache_dir)
+
+    return jinja2.Environment(
+            loader=loader,
+            extensions=extensions or [],
+            bytecode_cache=bytecode_cache)
 
 def make_renderer(searchpath=None,
                   outpath=None,
@@ -92,7 +706,17 @@ def make_renderer(searchpath=None,
                   rules=None,
                   encoding="utf8",
                   extensions=None,
-                  staticpath=None):
+                  staticpath=None,
+                  previous_manifest=None,
+                  bytecode_cache_dir=None,
+                  dependency_index_path=None,
+                  environment=None,
+                  dependency_index=None,
+                  facts=None,
+                  shared_outputs=None,
+                  profiler=None,
+                  object_store_dir=None,
+                  get_build_context=None):
     """Get a Renderer object.
 
     :param searchpath: the name of the directory to search for templates.
@@ -122,6 +746,47 @@ def make_renderer(searchpath=None,
     :param staticpath: the name of the directory to get static files from
                        (relative to searchpath). Defaults to ``None``.
 
+    :param previous_manifest: the :class:`BuildManifest` of the previous
+                              build, whose unchanged outputs will be carried
+                              forward. Defaults to ``None``.
+
+    :param bytecode_cache_dir: the name of the directory to cache compiled
+                               templates in. Defaults to ``None``, meaning
+                               templates aren't cached.
+
+    :param dependency_index_path: the name of the file to load the
+                                  :class:`DependencyIndex` from. Defaults
+                                  to ``None``, meaning every template is
+                                  parsed for its dependencies.
+
+    :param environment: a jinja2 Environment to use, eg one shared with
+                        another renderer, instead of making a new one.
+                        Defaults to ``None``.
+
+    :param dependency_index: a :class:`DependencyIndex` to use instead of
+                             loading one from dependency_index_path.
+                             Defaults to ``None``.
+
+    :param facts: facts to use instead of the local machine's, eg
+                  ``{'hostname': 'web01'}``, and extra facts to pass to
+                  the template context. Defaults to ``None``.
+
+    :param shared_outputs: a dict of outputs to share with other renderers,
+                           so templates rendering identically for each are
+                           only rendered once. Defaults to ``None``.
+
+    :param profiler: a :class:`dither.timing.Profiler` to record timings
+                     with. Defaults to ``None``.
+
+    :param object_store_dir: the name of the directory to store outputs in
+                             by content, hardlinking them into the build.
+                             Defaults to ``None``, meaning outputs are
+                             written straight into the build.
+
+    :param get_build_context: a function returning the build context,
+                              called the first time a template needs it.
+                              Defaults to ``None``, meaning the context is
+                              computed from facts.
 
     """
     if searchpath is None:
@@ -132,21 +797,36 @@ def make_renderer(searchpath=None,
     # Coerce search to an absolute path if it is not already
     searchpath = os.path.abspath(searchpath)
 
-    loader = jinja2.FileSystemLoader(
-            searchpath=searchpath, encoding=encoding)
-    environment = jinja2.Environment(
-            loader=loader, extensions=extensions or [])
+    if environment is None:
+        environment = make_environment(
+                searchpath,
+                encoding=encoding,
+                extensions=extensions,
+                bytecode_cache_dir=bytecode_cache_dir)
+
+    if dependency_index is None and dependency_index_path is not None:
+        dependency_index = deps.DependencyIndex.load(
+                environment, dependency_index_path)
 
     logger = get_logger()
+    if profiler is None:
+        profiler = timing.NullProfiler()
+
+    if get_build_context is None:
+        def get_build_context():
+            return context.get_build_context(
+                    context_path=CONTEXT_PATH,
+                    log=logger,
+                    **(facts or {}))
+
+    # The context is the same for every template, so only compute it once
+    @functools.lru_cache(maxsize=None)
+    def _get_build_context():
+        with profiler.phase('context'):
+            return get_build_context()
 
     def _get_context(template=None):
-        return context.get_context(
-                os=context.get_os(),
-                os_family=context.get_os_family(),
-                hostname=context.get_hostname(),
-                context_path=CONTEXT_PATH,
-                log=logger
-        )
+        return _get_build_context()
 
     context_mappings = [
             ('.*', _get_context)
@@ -160,6 +840,13 @@ def make_renderer(searchpath=None,
                     rules=rules,
                     contexts=context_mappings,
                     staticpath=staticpath,
+                    previous_manifest=previous_manifest,
+                    dependency_index=dependency_index,
+                    shared_outputs=shared_outputs,
+                    profiler=profiler,
+                    object_store=(
+                        store.ObjectStore(object_store_dir)
+                        if object_store_dir is not None else None),
                     )
 
 def create_latest_build_link(build_output_dir, latest_build_path):
@@ -169,23 +856,174 @@ def create_latest_build_link(build_output_dir, latest_build_path):
             raise Exception(
                     "{!r} already exists, but isn't a symlink. Cautiously not "
                     "removing it.".format(link_location))
-        os.remove(link_location)
 
-    # XXX TODO Clean this up, maybe use functions from link module
-    os.symlink(
+    link.replace_with_symlink(
             os.path.basename(latest_build_path),
             link_location)
 
-def build():
-    latest_build_path = get_build_output_subdir()
+@contextlib.contextmanager
+def build_scope(use_cache=True, profiler=None, **instances):
+    '''Run a build: the per-build resources in dither.resources are made
+    when first needed, and shared until the with statement ends. Each fact
+    is found out at most once meanwhile (or comes from the fact cache),
+    then the fact cache is saved.
+
+    Resources named in instances are used as given, eg to carry on with an
+    existing jinja2 Environment.
+    '''
+    instances.setdefault(
+            'bytecode_cache_dir', BYTECODE_CACHE_DIR if use_cache else None)
+    if profiler is not None:
+        instances['profiler'] = profiler
+
+    with di.resolver.build_scope(**instances):
+        fact_set = di.resolver.resolve('fact_set')
+        with facts.using(fact_set):
+            yield
+        fact_set.save_cache()
+
+@contextlib.contextmanager
+def cataloguing(build_output_dir, build_path):
+    '''Record a build in build_output_dir's catalogue as building for the
+    duration of a with statement, or as failed if it raises.
+
+    The with statement's value is the catalogue, for recording the build
+    as complete.
+    '''
+    build_catalogue = catalogue.BuildCatalogue.open(build_output_dir)
+    build_id = os.path.basename(build_path)
+    build_catalogue.record_started(build_id)
+    try:
+        yield build_catalogue
+    except BaseException:
+        build_catalogue.record_failed(build_id)
+        raise
+
+def count_outputs(build_manifest):
+    return len(build_manifest.templates) + len(build_manifest.static)
+
+def build(jobs=1, use_cache=True, profiler=None,
+          keep=retention.DEFAULT_KEEP):
+    '''Build dotfiles for this machine.
+
+    Afterwards, all but the newest keep builds are removed, unless keep is
+    None. Their files, and anything only they used, are deleted in the
+    background (see retention.collect_garbage()).
+    '''
+    with build_scope(use_cache=use_cache, profiler=profiler):
+        profiler = di.resolver.resolve('profiler')
+
+        # Taken before rendering, so a template changed during the build
+        # makes the fingerprint stale rather than wrongly up to date
+        with profiler.phase('fingerprint'):
+            tree_fingerprint = fingerprint.TreeFingerprint.take(
+                    TEMPLATES_DIR,
+                    build_context=di.resolver.resolve('build_context'),
+                    previous=fingerprint.TreeFingerprint.load(
+                        FINGERPRINT_PATH))
+
+        with profiler.phase('load manifest'):
+            di.resolver.resolve('previous_manifest')
+        with profiler.phase('make renderer'):
+            renderer = di.resolver.resolve('renderer')
+        latest_build_path = renderer.outpath
+
+        with cataloguing(
+                BUILD_OUTPUT_DIR, latest_build_path) as build_catalogue:
+            with profiler.phase('run'):
+                renderer.run(use_reloader=False, jobs=jobs)
+            with profiler.phase('save manifest'):
+                renderer.manifest.save(MANIFEST_PATH)
+                renderer.save_dependency_index(DEPENDENCY_INDEX_PATH)
+
+            with profiler.phase('latest build link'):
+                create_latest_build_link(BUILD_OUTPUT_DIR, latest_build_path)
+            tree_fingerprint.build = os.path.basename(latest_build_path)
+            tree_fingerprint.save(FINGERPRINT_PATH)
+            build_catalogue.record_complete(
+                    tree_fingerprint.build,
+                    fingerprint=tree_fingerprint.digest(),
+                    file_count=count_outputs(renderer.manifest))
+
+        if keep is not None:
+            with profiler.phase('remove old builds'):
+                retention.gc(keep=keep, wait=False)
+    return renderer
+
+def build_hosts(host_list_path, jobs=1, use_cache=True, profiler=None,
+                keep=retention.DEFAULT_KEEP):
+    '''Build dotfiles for every host in a host list, in one run.
+
+    Each host gets its own build directory (with its own latest_build
+    link) under built_dotfiles/hosts/<hostname>/. Templates are parsed
+    and compiled once for all hosts, and a template which renders
+    identically for several hosts is rendered once and hardlinked into
+    each host's build.
+
+    As with build(), old builds are then removed unless keep is None.
+    '''
+    hosts = context.load_host_list(host_list_path)
+
+    with build_scope(use_cache=use_cache, profiler=profiler):
+        profiler = di.resolver.resolve('profiler')
+        shared_outputs = {}
+        for hostname, host_facts in sorted(hosts.items()):
+            host_output_dir = os.path.join(
+                    BUILD_OUTPUT_DIR, HOSTS_SUBDIR, hostname)
+            host_manifest_path = os.path.join(
+                    host_output_dir, manifest.MANIFEST_NAME)
+            previous_manifest = manifest.BuildManifest.load(
+                    host_manifest_path, host_output_dir)
+            build_path = get_build_output_subdir(host_output_dir)
+
+            host_facts = dict(host_facts, hostname=hostname)
+            renderer = make_renderer(
+                    searchpath=TEMPLATES_DIR,
+                    outpath=build_path,
+                    previous_manifest=previous_manifest,
+                    environment=di.resolver.resolve('jinja_environment'),
+                    dependency_index=di.resolver.resolve(
+                        'dependency_index'),
+                    facts=host_facts,
+                    shared_outputs=shared_outputs,
+                    profiler=profiler,
+                    object_store_dir=OBJECT_STORE_DIR)
+
+            renderer.logger.info("Building for host %s..." % hostname)
+            with cataloguing(host_output_dir, build_path) as build_catalogue:
+                with profiler.phase('run for ' + hostname):
+                    renderer.run(use_reloader=False, jobs=jobs)
+                renderer.manifest.save(host_manifest_path)
+                create_latest_build_link(host_output_dir, build_path)
+                build_catalogue.record_complete(
+                        os.path.basename(build_path),
+                        file_count=count_outputs(renderer.manifest))
+
+        if hosts:
+            renderer.save_dependency_index(DEPENDENCY_INDEX_PATH)
+        if keep is not None:
+            retention.gc(keep=keep, wait=False)
+
+def query_dependencies(template_file, requires=False):
+    '''List the templates which depend on template_file, or with
+    requires, the templates which template_file depends on.
 
+    Returns None if the dependencies can't be determined without rendering.
+    '''
     renderer = make_renderer(
             searchpath=TEMPLATES_DIR,
-            outpath=latest_build_path)
+            outpath=BUILD_OUTPUT_DIR,
+            dependency_index_path=DEPENDENCY_INDEX_PATH)
 
-    renderer.run(use_reloader=False)
+    template_name = template_file
+    if os.path.exists(template_file):
+        template_name = os.path.relpath(
+                os.path.abspath(template_file), renderer.searchpath)
 
-    create_latest_build_link(BUILD_OUTPUT_DIR, latest_build_path)
+    if requires:
+        names = renderer.find_referenced_templates(template_name)
+    else:
+        names = renderer.find_dependent_names(template_name)
 
-    # enable automatic reloading
-    renderer.run(use_reloader=False)
+    renderer.save_dependency_index(DEPENDENCY_INDEX_PATH)
+    return sorted(names) if names is not None else None
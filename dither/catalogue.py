@@ -0,0 +1,134 @@
+'''A catalogue of the builds in a build output directory, kept in sqlite.
+
+Finding the latest build, or a build made from given inputs, is then an
+indexed lookup, rather than listing and sorting every built_at_*
+directory. Builds made before the catalogue existed aren't in it, so
+callers fall back to looking at the directories themselves.
+'''
+
+import os
+import time
+import sqlite3
+import collections
+
+CATALOGUE_NAME = 'catalogue.sqlite'
+# Seconds to wait for another dither process to finish writing
+CONNECT_TIMEOUT = 10
+
+BUILDING = 'building'
+COMPLETE = 'complete'
+FAILED = 'failed'
+REMOVED = 'removed'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS builds (
+    id TEXT PRIMARY KEY,
+    built_at REAL NOT NULL,
+    fingerprint TEXT,
+    file_count INTEGER,
+    status TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS builds_by_status
+    ON builds (status, built_at);
+CREATE INDEX IF NOT EXISTS builds_by_fingerprint
+    ON builds (fingerprint, status, built_at);
+'''
+COLUMNS = 'id, built_at, fingerprint, file_count, status'
+
+BuildRecord = collections.namedtuple(
+        'BuildRecord', ['id', 'built_at', 'fingerprint', 'file_count', 'status'])
+
+
+class BuildCatalogue:
+    '''Records each build's id (its directory's name), when it was
+    started, the fingerprint of its inputs, how many files it has, and
+    whether it's building, complete, failed or removed.
+    '''
+
+    def __init__(self, catalogue_path):
+        self.catalogue_path = catalogue_path
+
+    @classmethod
+    def open(cls, build_output_dir):
+        return cls(os.path.join(build_output_dir, CATALOGUE_NAME))
+
+    def _connect(self, create=False):
+        if not create and not os.path.exists(self.catalogue_path):
+            return None
+        connection = sqlite3.connect(
+                self.catalogue_path, timeout=CONNECT_TIMEOUT)
+        if create:
+            connection.executescript(SCHEMA)
+        return connection
+
+    def _write(self, sql, rows, create=True):
+        connection = self._connect(create=create)
+        if connection is None:
+            return
+        try:
+            with connection:
+                connection.executemany(sql, rows)
+        finally:
+            connection.close()
+
+    def _query(self, sql, params=()):
+        '''Return the BuildRecords sql selects, or none if the catalogue
+        can't be read.
+        '''
+        connection = self._connect()
+        if connection is None:
+            return []
+        try:
+            return [BuildRecord(*row) for row in connection.execute(
+                    'SELECT {} FROM builds {}'.format(COLUMNS, sql), params)]
+        except sqlite3.DatabaseError:
+            return []
+        finally:
+            connection.close()
+
+    def record_started(self, build_id, built_at=None):
+        if built_at is None:
+            built_at = time.time()
+        self._write(
+                'INSERT OR REPLACE INTO builds (id, built_at, status) '
+                'VALUES (?, ?, ?)',
+                [(build_id, built_at, BUILDING)])
+
+    def record_complete(self, build_id, fingerprint=None, file_count=None):
+        self._write(
+                'UPDATE builds SET status = ?, fingerprint = ?, '
+                'file_count = ? WHERE id = ?',
+                [(COMPLETE, fingerprint, file_count, build_id)])
+
+    def record_failed(self, build_id):
+        self._write(
+                'UPDATE builds SET status = ? WHERE id = ?',
+                [(FAILED, build_id)])
+
+    def record_removed(self, build_ids):
+        self._write(
+                'UPDATE builds SET status = ? WHERE id = ?',
+                [(REMOVED, build_id) for build_id in build_ids],
+                create=False)
+
+    def find_latest(self, status=COMPLETE):
+        records = self._query(
+                'WHERE status = ? ORDER BY built_at DESC LIMIT 1', (status,))
+        return records[0] if records else None
+
+    def find_by_fingerprint(self, fingerprint, status=COMPLETE):
+        '''Find the latest build made from inputs with this fingerprint.
+        '''
+        records = self._query(
+                'WHERE fingerprint = ? AND status = ? '
+                'ORDER BY built_at DESC LIMIT 1',
+                (fingerprint, status))
+        return records[0] if records else None
+
+    def list_builds(self, status=None):
+        '''List builds, oldest first, optionally only those with status.
+        '''
+        if status is None:
+            return self._query('ORDER BY built_at')
+        return self._query(
+                'WHERE status = ? ORDER BY built_at', (status,))
@@ -5,27 +5,268 @@ import click
 @click.group(
         name='dither',
 )
-def cli():
+@click.option(
+        '--timing-imports', is_flag=True,
+        help='Print how long the command spent importing modules, and '
+             'whether it imported jinja2.')
+def cli(timing_imports):
+    # --timing-imports is acted on by dither.main, before click is imported
     pass
 
 @cli.command()
-def build():
+@click.option(
+        '--jobs', '-j', default=1, type=click.IntRange(min=0),
+        help='Number of templates to render at once (0 for one per CPU).')
+@click.option(
+        '--cache/--no-cache', default=True,
+        help='Use (or ignore) the cache of compiled templates.')
+@click.option(
+        '--host-list', type=click.Path(exists=True, dir_okay=False),
+        help='YAML or JSON file of hostnames and their facts, to build '
+             'dotfiles for each of them instead of this machine.')
+@click.option(
+        '--profile', is_flag=True,
+        help='Print the slowest phases and templates of the build.')
+@click.option(
+        '--profile-top', default=20, type=click.IntRange(min=1),
+        help='Number of entries to print with --profile.')
+@click.option(
+        '--profile-output', type=click.Path(dir_okay=False, writable=True),
+        help='Also write every --profile timing to this file.')
+@click.option(
+        '--profile-format', default='json',
+        type=click.Choice(['json', 'chrome']),
+        help='Format for --profile-output: plain JSON, or Chrome '
+             'trace events.')
+@click.option(
+        '--gc/--no-gc', 'remove_old', default=True,
+        help='Remove (or keep) all but the newest 10 builds afterwards.')
+def build(jobs, cache, host_list, profile, profile_top, profile_output,
+          profile_format, remove_old):
     '''Builds new dotfiles from ./dither_templates.'''
     from . import build
-    build.build()
+    from . import retention
+    from . import timing
+    profiler = timing.Profiler() if profile or profile_output else None
+    keep = retention.DEFAULT_KEEP if remove_old else None
+
+    if host_list:
+        build.build_hosts(
+                host_list, jobs=jobs, use_cache=cache, profiler=profiler,
+                keep=keep)
+    else:
+        build.build(
+                jobs=jobs, use_cache=cache, profiler=profiler, keep=keep)
+
+    if profile:
+        click.echo(profiler.format_table(top_n=profile_top), err=True)
+    if profile_output:
+        profiler.save(profile_output, output_format=profile_format)
 
 @cli.command()
-def link():
+@click.option(
+        '--full', is_flag=True,
+        help='Check every link, not just those for added or removed files.')
+@click.option(
+        '--recursive/--top-level', default=None,
+        help='Link each file in nested directories (eg .config/nvim) '
+             'separately, or link top-level files and directories whole. '
+             'Defaults to the same as last time.')
+@click.option(
+        '--jobs', '-j', default=1, type=click.IntRange(min=1),
+        help='Change this many links at once, eg on a network home '
+             'directory.')
+def link(full, recursive, jobs):
     '''Symlinks latest build into home directory.'''
     from . import link
     link.link(
             base_build_dir=link.BASE_BUILD_DIR,
-            home_dir=os.path.expanduser('~'))
+            home_dir=os.path.expanduser('~'),
+            full=full,
+            recursive=recursive,
+            jobs=jobs)
+
+@cli.command()
+@click.option(
+        '--cache/--no-cache', default=True,
+        help='Use (or ignore) the cache of compiled templates.')
+def watch(cache):
+    '''Rebuilds and relinks whenever ./dither_templates changes.'''
+    from . import watch
+    watch.watch(home_dir=os.path.expanduser('~'), use_cache=cache)
 
 @cli.command()
+@click.option(
+        '--force', is_flag=True,
+        help='Build and link even if nothing has changed.')
 @click.pass_context
-def update(context):
-    '''Performs the "build" and "link" steps.'''
-    context.forward(build)
-    context.forward(link)
+def update(context, force):
+    '''Performs the "build" and "link" steps.
+
+    Does nothing if neither the templates nor the build context (this
+    machine's facts, and whatever template_context.py adds) have changed
+    since the installed build was made.
+    '''
+    from . import fingerprint
+    if not force and fingerprint.is_installed_build_current():
+        click.echo("Already up to date.", err=True)
+        return
+    context.invoke(build)
+    context.invoke(link)
+
+
+@cli.command()
+@click.argument('template_file')
+@click.option(
+        '--requires', is_flag=True,
+        help='List what TEMPLATE_FILE includes, extends or imports instead.')
+def deps(template_file, requires):
+    '''Lists templates to re-render when TEMPLATE_FILE changes.'''
+    from . import build
+    names = build.query_dependencies(template_file, requires=requires)
+    if names is None:
+        raise click.ClickException(
+                "Dependencies of {} can't be determined without "
+                "rendering".format(template_file))
+    for name in names:
+        click.echo(name)
+
+def parse_duration_option(context, param, value):
+    if value is None:
+        return None
+    from . import retention
+    try:
+        return retention.parse_duration(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+@cli.command()
+@click.option(
+        '--keep', type=click.IntRange(min=0),
+        help='Keep the newest KEEP builds.')
+@click.option(
+        '--keep-within', callback=parse_duration_option,
+        help='Keep builds made within this long, eg 30d, 12h or 2w.')
+@click.option(
+        '--dry-run', is_flag=True,
+        help='List the builds which would be removed, without removing '
+             'them.')
+def gc(keep, keep_within, dry_run):
+    '''Removes old builds, and compiled templates no longer in use.
+
+    A build is kept if either --keep or --keep-within would keep it. The
+    latest and installed builds are always kept.
+    '''
+    from . import retention
+    if keep is None and keep_within is None:
+        raise click.UsageError("Give --keep, --keep-within or both")
+    removed, pruned = retention.gc(
+            keep=keep, keep_within=keep_within, dry_run=dry_run)
+    for path in removed:
+        click.echo(path)
+    if not dry_run:
+        click.echo(
+                "Removed {} builds and {} unused files".format(
+                    len(removed), pruned),
+                err=True)
 
+@cli.command()
+@click.option(
+        '--current', is_flag=True,
+        help='Only show the latest build made from the templates and facts '
+             'as they are now.')
+def builds(current):
+    '''Lists builds recorded in the build catalogue, oldest first.'''
+    import datetime
+    from . import catalogue
+    from . import link
+    build_catalogue = catalogue.BuildCatalogue.open(link.BASE_BUILD_DIR)
+    if current:
+        from . import fingerprint
+        record = build_catalogue.find_by_fingerprint(
+                fingerprint.TreeFingerprint.take().digest())
+        records = [record] if record is not None else []
+    else:
+        records = build_catalogue.list_builds()
+
+    for record in records:
+        click.echo('{:<30}  {}  {:<8}  {:>5}  {}'.format(
+                record.id,
+                datetime.datetime.fromtimestamp(record.built_at).strftime(
+                    '%Y-%m-%d %H:%M:%S'),
+                record.status,
+                '' if record.file_count is None else record.file_count,
+                (record.fingerprint or '')[:12]))
+
+@cli.command(name='facts')
+@click.option(
+        '--refresh', is_flag=True,
+        help='Find out every fact afresh, ignoring the fact cache.')
+def show_facts(refresh):
+    '''Shows facts about this machine, and how long each took to find.'''
+    from . import context
+    from . import facts
+    if os.path.exists(context.CONTEXT_PATH):
+        # Registers any facts template_context.py provides
+        context.get_context_func(context.CONTEXT_PATH)
+
+    fact_set = facts.FactSet(
+            cache_path=facts.FACT_CACHE_PATH, use_cache=not refresh)
+    with facts.using(fact_set):
+        for name in sorted(facts.providers):
+            fact_set.lookup(name)
+    fact_set.save_cache()
+
+    for name, value in sorted(fact_set.values.items()):
+        click.echo('{:>10.4f}  {:<6}  {} = {!r}'.format(
+                fact_set.timings[name],
+                'cached' if name in fact_set.from_cache else '',
+                name,
+                value))
+
+@cli.command(name='di-graph')
+@click.option(
+        '--dot', is_flag=True,
+        help='Print the graph in Graphviz dot format.')
+def di_graph(dot):
+    '''Checks and shows how resources' providers depend on each other.
+
+    Resources are listed after those they require, with their scope.
+    '''
+    from . import di
+    from . import resources
+    try:
+        di.resolver.validate()
+    except di.DIError as e:
+        raise click.ClickException(str(e))
+
+    providers = di.resolver.resource_provider_register
+    if dot:
+        click.echo('digraph dither {')
+    for resource_name in providers.sort_topologically():
+        requirements = providers.resource_requirements[resource_name]
+        scope = providers.resource_scopes[resource_name]
+        if dot:
+            click.echo('    "{}" [label="{}\\n({})"];'.format(
+                    resource_name, resource_name, scope))
+            for required_name in requirements:
+                click.echo('    "{}" -> "{}";'.format(
+                        resource_name, required_name))
+        elif requirements:
+            click.echo('{} ({}) <- {}'.format(
+                    resource_name, scope, ', '.join(requirements)))
+        else:
+            click.echo('{} ({})'.format(resource_name, scope))
+    if dot:
+        click.echo('}')
+
+@cli.group()
+def cache():
+    '''Manages the cache of compiled templates.'''
+    pass
+
+@cache.command()
+def clear():
+    '''Deletes all cached compiled templates.'''
+    from . import build
+    build.clear_bytecode_cache()
@@ -1,6 +1,11 @@
 import os
 import sys
+import json
 import importlib
+import importlib.util
+import collections.abc
+
+from . import facts
 
 TEMPLATES_DIR = 'dither_templates'
 CONTEXT_PATH = os.path.join(TEMPLATES_DIR, 'template_context.py')
@@ -12,6 +17,7 @@ def hostname_from_socket():
     import socket
     return socket.gethostname()
 
+@facts.fact('hostname')
 def get_hostname():
     for get_func in [hostname_from_env, hostname_from_socket]:
         hostname = get_func()
@@ -32,6 +38,7 @@ def linux_parse_issue_file():
             
     return None
 
+@facts.fact('os')
 def get_os():
     os_family = get_os_family()
     if os_family == 'linux':
@@ -42,6 +49,7 @@ def get_os():
     else:
         return os_family
 
+@facts.fact('os_family')
 def get_os_family():
     py_platform = sys.platform
     if 'linux' in py_platform:
@@ -54,17 +62,24 @@ def get_os_family():
         return ''
 
 def get_context_func(context_path):
-    context_subdir = os.path.dirname(os.path.abspath(CONTEXT_PATH))
-    context_filename = os.path.basename(CONTEXT_PATH)
+    context_path = os.path.abspath(context_path)
+    context_subdir = os.path.dirname(context_path)
+    context_filename = os.path.basename(context_path)
     context_module_name, context_ext = os.path.splitext(context_filename)
 
     if context_ext != '.py':
         raise ValueError("Context filename must end in .py")
-    
-    if context_subdir:
+
+    # Allow the context module to import its neighbours
+    if context_subdir and context_subdir not in sys.path:
         sys.path.insert(0, context_subdir)
 
-    context_module = importlib.import_module(context_module_name)
+    # Load from the path given, rather than whichever module of the same
+    # name was imported first
+    spec = importlib.util.spec_from_file_location(
+            context_module_name, context_path)
+    context_module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(context_module)
     return context_module.get_context
 
 def get_context(
@@ -85,3 +100,130 @@ def get_context(
         context.update(custom_context)
 
     return context
+
+class LazyValue:
+    '''Wraps a function which computes a context value, so that it's only
+    called if a template actually uses the value.
+
+    For use in template_context.py, eg:
+
+        def get_context(**kwargs):
+            return {'gpg_key': lazy(find_gpg_key)}
+    '''
+
+    def __init__(self, func):
+        self.func = func
+
+    def __repr__(self):
+        return 'lazy({!r})'.format(self.func)
+
+# For use in template_context.py
+lazy = LazyValue
+fact = facts.fact
+
+class BuildContext(collections.abc.Mapping):
+    '''A read-only template context, computed once and shared by every
+    template in a build.
+
+    Values wrapped in lazy() are computed the first time they're looked
+    up, then cached.
+    '''
+
+    def __init__(self, values):
+        self._values = dict(values)
+        self._resolved = {}
+
+    def __getitem__(self, key):
+        if key not in self._resolved:
+            value = self._values[key]
+            if isinstance(value, LazyValue):
+                value = value.func()
+            self._resolved[key] = value
+        return self._resolved[key]
+
+    def __contains__(self, key):
+        # Avoid Mapping's default, which would compute lazy values
+        return key in self._values
+
+    def has_lazy_values(self):
+        return any(
+                isinstance(value, LazyValue)
+                for value in self._values.values())
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+LOCAL_FACTS = (
+        ('os', get_os),
+        ('os_family', get_os_family),
+        ('hostname', get_hostname),
+)
+
+def get_build_context(context_path=None, log=None, **overrides):
+    '''Compute the context shared by every template in a build.
+
+    Facts not given (os, os_family and hostname) are found from the local
+    machine. Any other facts given are passed on to the custom context
+    function, and are in the context unless it overrides them.
+    '''
+    # The local OS name makes no sense for a host with another OS family
+    if 'os_family' in overrides and 'os' not in overrides:
+        overrides['os'] = overrides['os_family']
+
+    for fact_name, get_fact in LOCAL_FACTS:
+        if fact_name not in overrides:
+            overrides[fact_name] = get_fact()
+
+    values = dict(overrides)
+    values.update(
+            get_context(context_path=context_path, log=log, **overrides))
+    return BuildContext(values)
+
+def load_host_list(host_list_path):
+    '''Load a mapping of hostnames to the facts to build for each.
+
+    The file may be YAML (which needs PyYAML installed) or, if its name
+    ends in .json, JSON. For example:
+
+        web01:
+          os: Ubuntu 14.04
+        laptop:
+          os_family: macosx
+          os: macosx
+    '''
+    with open(host_list_path, 'r') as host_list_file:
+        if host_list_path.endswith('.json'):
+            hosts = json.load(host_list_file)
+        else:
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError(
+                        "PyYAML must be installed to read {!r}; use a .json "
+                        "host list otherwise".format(host_list_path))
+            hosts = yaml.safe_load(host_list_file)
+
+    if not isinstance(hosts, dict):
+        raise ValueError(
+                "Host list {!r} must map hostnames to facts".format(
+                    host_list_path))
+
+    checked_hosts = {}
+    for hostname, host_facts in hosts.items():
+        # Hostnames become directory names
+        hostname = str(hostname)
+        if not hostname or os.sep in hostname or hostname.startswith('.'):
+            raise ValueError(
+                    "Invalid hostname {!r} in {!r}".format(
+                        hostname, host_list_path))
+        if host_facts is None:
+            host_facts = {}
+        if not isinstance(host_facts, dict):
+            raise ValueError(
+                    "Facts for host {!r} in {!r} must be a mapping".format(
+                        hostname, host_list_path))
+        checked_hosts[hostname] = host_facts
+    return checked_hosts
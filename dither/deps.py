@@ -0,0 +1,169 @@
+import json
+
+import jinja2.meta
+
+from . import manifest
+
+DEPENDENCY_INDEX_NAME = 'dependency_index.json'
+
+
+class DependencyIndex:
+    '''Records which templates each template includes, extends or imports,
+    and which context variables it looks up.
+
+    Each template is parsed at most once per change to its source: entries
+    remember the hash of the source they were parsed from, and are saved
+    between builds. The reverse mapping (from a partial to the templates
+    using it) is derived from the entries as needed.
+    '''
+
+    def __init__(self, environment, entries=None):
+        self._env = environment
+        # Maps template names to the hash of their source, the templates
+        # they reference directly (None if that can't be determined without
+        # rendering) and the variables they look up
+        self.entries = entries or {}
+        # Names of entries added or changed since last popped
+        self._updated = set()
+        self._reverse = None
+
+    @classmethod
+    def load(cls, environment, index_path):
+        try:
+            with open(index_path, 'r') as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            entries = None
+        return cls(environment, entries=entries)
+
+    def save(self, index_path):
+        manifest.write_json_atomically(index_path, self.entries)
+
+    def _parse(self, template_name, source_hash):
+        source, _unused, _unused = self._env.loader.get_source(
+                self._env, template_name)
+        ast = self._env.parse(source)
+
+        references = []
+        for referenced_name in jinja2.meta.find_referenced_templates(ast):
+            if referenced_name is None:
+                references = None
+                break
+            references.append(referenced_name)
+
+        return {
+            'source': source_hash,
+            'references': (
+                sorted(set(references)) if references is not None else None),
+            'variables': sorted(jinja2.meta.find_undeclared_variables(ast)),
+        }
+
+    def update(self, template_name, source_hash):
+        '''Make sure the entry for a template reflects its current source.
+        '''
+        entry = self.entries.get(template_name)
+        if entry is not None and entry['source'] == source_hash:
+            return entry
+
+        entry = self._parse(template_name, source_hash)
+        self.entries[template_name] = entry
+        self._updated.add(template_name)
+        self._reverse = None
+        return entry
+
+    def pop_updated(self):
+        '''Return, and stop tracking, the entries changed since last called.
+        '''
+        updated = {name: self.entries[name] for name in self._updated}
+        self._updated = set()
+        return updated
+
+    def merge(self, entries):
+        self.entries.update(entries)
+        self._reverse = None
+
+    def forget(self, names):
+        for name in names:
+            self.entries.pop(name, None)
+        self._reverse = None
+
+    def prune(self, keep_names):
+        '''Drop entries for templates which no longer exist.
+        '''
+        self.forget(set(self.entries) - set(keep_names))
+
+    def find_referenced_templates(self, template_name, hash_source):
+        '''Find every template which template_name includes, extends or
+        imports, directly or indirectly.
+
+        Returns None if any of those references can't be determined
+        without rendering (eg `{% include some_variable %}`).
+
+        Missing templates (eg included with `ignore missing`) are found,
+        but reference nothing.
+
+        :param hash_source: a function giving the current source hash of a
+                            template, or None if it doesn't exist, used to
+                            bring entries up to date
+        '''
+        found = set()
+        to_visit = [template_name]
+        while to_visit:
+            name = to_visit.pop()
+            source_hash = hash_source(name)
+            if source_hash is None:
+                continue
+            references = self.update(name, source_hash)['references']
+            if references is None:
+                return None
+            for referenced_name in references:
+                if referenced_name not in found:
+                    found.add(referenced_name)
+                    to_visit.append(referenced_name)
+        return found
+
+    def find_referenced_variables(self, template_name, partials):
+        '''Find the context variables a template, or any of its partials,
+        might look up.
+
+        Entries must already be up to date, eg from calling
+        find_referenced_templates().
+        '''
+        variables = set()
+        for name in [template_name] + sorted(partials):
+            entry = self.entries.get(name)
+            # Missing partials look nothing up
+            if entry is not None:
+                variables.update(entry['variables'])
+        return variables
+
+    @property
+    def reverse(self):
+        '''Map each template name to the names of templates referencing it
+        directly.
+        '''
+        if self._reverse is None:
+            self._reverse = {}
+            for name, entry in self.entries.items():
+                for referenced_name in entry['references'] or []:
+                    self._reverse.setdefault(referenced_name, set()).add(name)
+        return self._reverse
+
+    def find_dependents(self, changed_names):
+        '''Find every indexed template whose output may depend on any of the
+        changed files, including the changed files themselves.
+        '''
+        dependents = set()
+        to_visit = list(changed_names)
+        while to_visit:
+            name = to_visit.pop()
+            if name in dependents:
+                continue
+            dependents.add(name)
+            to_visit.extend(self.reverse.get(name, ()))
+
+        # Templates with references we can't follow might use anything
+        dependents.update(
+                name for name, entry in self.entries.items()
+                if entry['references'] is None)
+        return dependents
@@ -2,9 +2,16 @@
 '''
 
 import inspect
+import contextlib
+import collections
 
 import click
 
+# Scopes a resource's instances can be cached in
+SINGLETON = 'singleton'
+PER_BUILD = 'build'
+PER_CALL = 'call'
+SCOPES = (SINGLETON, PER_BUILD, PER_CALL)
 
 class DIError(Exception): pass
 
@@ -14,6 +21,8 @@ class DependencyRegister:
         self.dependents = {}
         # Maps names of resources to their dependents
         self.resources = {}
+        # Called, with no arguments, whenever anything is registered
+        self.on_change = []
 
     @classmethod
     def _unwrap_func(cls, decorated_func):
@@ -29,7 +38,7 @@ class DependencyRegister:
 
         elif hasattr(decorated_func, '__wrapped__'):
             # Recursion: unwrap more if needed
-            return self._unwrap_func(decorated_func.__wrapped__)
+            return cls._unwrap_func(decorated_func.__wrapped__)
         else:
             # decorated_func isn't actually decorated, no more
             # unwrapping to do
@@ -46,8 +55,10 @@ class DependencyRegister:
 
     def _register_dependent(self, dependent, resource_name):
         if dependent not in self.dependents:
-            self.dependents[dependent] = []
-        self.dependents[dependent].insert(0, resource_name)
+            self.dependents[dependent] = collections.deque()
+        # Decorators are applied bottom up, so this keeps resources in the
+        # order their @dependsOn decorators are written
+        self.dependents[dependent].appendleft(resource_name)
 
     def _register_resource_dependency(self, resource_name, dependent):
         if resource_name not in self.resources:
@@ -58,6 +69,8 @@ class DependencyRegister:
         dependent = self._unwrap_dependent(dependent)
         self._register_dependent(dependent, resource_name)
         self._register_resource_dependency(resource_name, dependent)
+        for listener in self.on_change:
+            listener()
 
     def register_by_decorator(self, resource_name):
         def decorator(dependent):
@@ -91,24 +104,328 @@ class ResourceProviderRegister:
     def __init__(self):
         # Maps resource names to a provider
         self.resource_providers = {}
-
-    def register_callable(self, provider, resource_name):
+        # Maps resource names to the scope their instances are cached in
+        self.resource_scopes = {}
+        # Maps resource names to the names of resources their providers
+        # require, in the order they're passed to the provider
+        self.resource_requirements = {}
+        # Maps resource names to the resources whose providers require them
+        self.required_by = {}
+        # Instances of singleton resources
+        self.singleton_instances = {}
+        # Instances of per-build resources, or None outside a build
+        self.build_instances = None
+        # Called, with no arguments, whenever a provider is registered
+        self.on_change = []
+        # Maps resource names to the functions resolving them and calling
+        # their providers, made by get_resolver()
+        self._resolvers = {}
+        self._provider_calls = {}
+
+    def register_callable(
+            self, provider, resource_name, scope=PER_CALL, requires=()):
+        '''Register a provider for a resource.
+
+        Per-call resources are provided afresh on every lookup. Singleton
+        resources are provided once, and per-build resources once per
+        build_scope().
+
+        The resources named in requires are resolved first, and passed to
+        the provider in the same order. They needn't have providers yet,
+        but registering a provider which would make a cycle raises
+        DependencyCycleError, and leaves the registration as it was.
+        '''
         if resource_name in self.resource_providers:
             raise ProviderAlreadyRegisteredError(
                     resource_name=resource_name,
                     existing_provider=self.resource_providers[resource_name])
+        if scope not in SCOPES:
+            raise UnknownScopeError(scope=scope)
+
+        cycle = self._find_cycle_through(resource_name, requires)
+        if cycle:
+            raise DependencyCycleError(cycle=cycle)
 
         self.resource_providers[resource_name] = provider
+        self.resource_scopes[resource_name] = scope
+        self.resource_requirements[resource_name] = tuple(requires)
+        for required_name in requires:
+            self.required_by.setdefault(required_name, []).append(
+                    resource_name)
+        self._resolvers = {}
+        self._provider_calls = {}
+        for listener in self.on_change:
+            listener()
+
+    def _find_cycle_through(self, resource_name, requirements):
+        '''Find the cycle which giving resource_name these requirements
+        would make, if any.
+
+        Any new cycle must pass through resource_name, so this searches
+        back from it through whatever requires it, for one of its
+        requirements.
+        '''
+        requirements = set(requirements)
+        # Maps each resource found to the one it requires on the way back
+        # to resource_name
+        leads_to = {resource_name: None}
+        queue = collections.deque([resource_name])
+        while queue:
+            found_name = queue.popleft()
+            if found_name in requirements:
+                cycle = [resource_name]
+                while found_name is not None:
+                    cycle.append(found_name)
+                    found_name = leads_to[found_name]
+                return cycle
+            for dependent_name in self.required_by.get(found_name, ()):
+                if dependent_name not in leads_to:
+                    leads_to[dependent_name] = found_name
+                    queue.append(dependent_name)
+        return None
 
     # For registering providers which always return the same instance
     def register_instance(self, provider, resource_name):
         self.register_callable(lambda : provider, resource_name)
 
-    def resolve(self, resource_name):
-        if resource_name not in self.resource_providers:
-            raise ProviderNotFoundError(resource_name=resource_name)
+    def register_by_decorator(
+            self, resource_name, scope=PER_CALL, requires=()):
+        def decorator(provider):
+            self.register_callable(
+                    provider, resource_name, scope=scope, requires=requires)
+            return provider
+        return decorator
+
+    def sort_topologically(self, resource_names=None, exclude=()):
+        '''List resources so that each comes after those it requires.
+
+        The list has resource_names (by default, every resource with a
+        provider) and everything they require, directly or not, except
+        those in exclude, which are assumed to be dealt with along with
+        everything they require. Raises DependencyCycleError if any of them
+        require themselves.
+        '''
+        if resource_names is None:
+            resource_names = list(self.resource_providers)
+
+        order = []
+        # Maps resources to False while their requirements are being
+        # visited, then True once they're in order
+        visited = {}
+        for root_name in resource_names:
+            if root_name in visited or root_name in exclude:
+                continue
+            visited[root_name] = False
+            # Depth first, without recursion, so deep graphs are fine
+            path = [root_name]
+            unvisited = [iter(self.resource_requirements.get(root_name, ()))]
+            while unvisited:
+                for required_name in unvisited[-1]:
+                    state = visited.get(required_name)
+                    if state is None:
+                        if required_name in exclude:
+                            continue
+                        visited[required_name] = False
+                        path.append(required_name)
+                        unvisited.append(iter(
+                                self.resource_requirements.get(
+                                    required_name, ())))
+                        break
+                    elif state is False:
+                        cycle = path[path.index(required_name):]
+                        raise DependencyCycleError(
+                                cycle=cycle + [required_name])
+                else:
+                    unvisited.pop()
+                    finished_name = path.pop()
+                    visited[finished_name] = True
+                    order.append(finished_name)
+        return order
+
+    def validate(self):
+        '''Check that every resource can be provided, raising a DIError if
+        not.
+
+        As well as cycles, this finds requirements with no provider, and
+        singletons which require per-build resources (and so would keep
+        using the first build's instances).
+        '''
+        self.sort_topologically()
+        for resource_name, requirements in sorted(
+                self.resource_requirements.items()):
+            for required_name in requirements:
+                if required_name not in self.resource_providers:
+                    raise ProviderNotFoundError(
+                            resource_name=required_name,
+                            required_by=resource_name)
+                if (self.resource_scopes[resource_name] == SINGLETON
+                        and self.resource_scopes[required_name] == PER_BUILD):
+                    raise ScopeMismatchError(
+                            resource_name=resource_name,
+                            required_name=required_name)
+
+    def eager_init(self, resource_names=None):
+        '''Provide resources now, rather than when first resolved, each
+        after those it requires.
+
+        By default, every singleton resource is provided, as is every
+        per-build one if a build is in progress. Per-call resources are
+        never provided in advance.
+        '''
+        if resource_names is None:
+            skipped_scopes = {PER_CALL}
+            if self.build_instances is None:
+                skipped_scopes.add(PER_BUILD)
+            resource_names = [
+                    resource_name
+                    for resource_name, scope in self.resource_scopes.items()
+                    if scope not in skipped_scopes]
+
+        for resource_name in self.sort_topologically(resource_names):
+            if self.resource_scopes.get(resource_name) != PER_CALL:
+                self.resolve(resource_name)
+
+    @contextlib.contextmanager
+    def build_scope(self, **instances):
+        '''Cache instances of per-build resources for the duration of a
+        with statement.
+
+        Per-build resources named in instances are provided as given,
+        rather than by their providers, as are resources with no provider.
+        '''
+        previous_build_instances = self.build_instances
+        self.build_instances = dict(instances)
+        try:
+            yield
+        finally:
+            self.build_instances = previous_build_instances
+
+    def defer(self, resource_name):
+        '''Get a function which resolves a resource when called.
+
+        Per-build resources are resolved in the build in progress now,
+        even if the function is only called after it ends.
+        '''
+        build_instances = self.build_instances
 
-        return self.resource_providers[resource_name]()
+        def resolve_deferred():
+            previous_build_instances = self.build_instances
+            self.build_instances = build_instances
+            try:
+                return self.resolve(resource_name)
+            finally:
+                self.build_instances = previous_build_instances
+        return resolve_deferred
+
+    def resolve(self, resource_name):
+        return self.get_resolver(resource_name)()
+
+    def _get_provider_call(self, resource_name):
+        provider = self.resource_providers[resource_name]
+        requirements = self.resource_requirements[resource_name]
+        if not requirements:
+            return provider
+
+        # Made after those of the resources required, by get_resolver()
+        resolvers = tuple(
+                self._resolvers[required_name]
+                for required_name in requirements)
+
+        def call_provider():
+            return provider(*[resolve() for resolve in resolvers])
+        return call_provider
+
+    def _is_uncached(self, resource_name):
+        scope = self.resource_scopes.get(resource_name)
+        if scope == SINGLETON:
+            return resource_name not in self.singleton_instances
+        elif scope == PER_BUILD:
+            return (self.build_instances is not None
+                    and resource_name not in self.build_instances)
+        # Per-call resources may require uncached ones
+        return scope == PER_CALL
+
+    def _provide_uncached(self, resource_name):
+        '''Provide a singleton or per-build resource, first providing those
+        it requires, directly or not, which haven't been yet.
+
+        They're provided deepest first, so providing a resource at the end
+        of a long chain of requirements needs no deep recursion.
+        '''
+        visited = {resource_name}
+        unvisited = [(resource_name, iter(
+                self.resource_requirements[resource_name]))]
+        while unvisited:
+            visited_name, requirements = unvisited[-1]
+            for required_name in requirements:
+                if (required_name not in visited
+                        and self._is_uncached(required_name)):
+                    visited.add(required_name)
+                    unvisited.append((required_name, iter(
+                            self.resource_requirements[required_name])))
+                    break
+            else:
+                unvisited.pop()
+                if (visited_name != resource_name
+                        and self.resource_scopes[visited_name] != PER_CALL):
+                    self._resolvers[visited_name]()
+        return self._provider_calls[resource_name]()
+
+    def _make_resolver(self, resource_name):
+        scope = self.resource_scopes.get(resource_name)
+        if scope is None:
+            def resolve_given():
+                # No provider: may be given to build_scope() by the time
+                # this is called
+                instances = self.build_instances
+                if instances is not None and resource_name in instances:
+                    return instances[resource_name]
+                raise ProviderNotFoundError(resource_name=resource_name)
+            return resolve_given
+
+        provider = self._provider_calls[resource_name] = \
+                self._get_provider_call(resource_name)
+        if scope == PER_CALL:
+            return provider
+        elif scope == SINGLETON:
+            instances = self.singleton_instances
+
+            def resolve_singleton():
+                try:
+                    return instances[resource_name]
+                except KeyError:
+                    instance = instances[resource_name] = \
+                            self._provide_uncached(resource_name)
+                    return instance
+            return resolve_singleton
+        else:
+            def resolve_per_build():
+                # The build in progress when called, not now
+                instances = self.build_instances
+                if instances is None:
+                    raise NoBuildInProgressError(resource_name=resource_name)
+                try:
+                    return instances[resource_name]
+                except KeyError:
+                    instance = instances[resource_name] = \
+                            self._provide_uncached(resource_name)
+                    return instance
+            return resolve_per_build
+
+    def get_resolver(self, resource_name):
+        '''Get the quickest function to resolve a resource with, until
+        another provider is registered.
+
+        Resolvers are made once per resource, each after those of the
+        resources it requires, so deep or widely shared requirements are
+        neither recursed through nor made twice.
+        '''
+        if resource_name not in self._resolvers:
+            for sorted_name in self.sort_topologically(
+                    [resource_name], exclude=self._resolvers):
+                self._resolvers[sorted_name] = self._make_resolver(
+                        sorted_name)
+        return self._resolvers[resource_name]
 
 class ProviderAlreadyRegisteredError(DIError):
 
@@ -127,11 +444,58 @@ class ProviderAlreadyRegisteredError(DIError):
                     'resource')
         super().__init__(message)
 
-class ProviderNotFoundError(DIError):
+class UnknownScopeError(DIError):
+
+    def __init__(self, scope=None):
+        self.scope = scope
+        super().__init__(
+                "Unknown scope {!r}: must be one of {!r}".format(
+                    scope, SCOPES))
+
+class NoBuildInProgressError(DIError):
 
     def __init__(self, resource_name=None):
         self.resource_name = resource_name
         if resource_name:
+            message = (
+                    "Resource {!r} is provided per build, but no build is "
+                    "in progress".format(resource_name))
+        else:
+            message = (
+                    "The resource is provided per build, but no build is "
+                    "in progress")
+        super().__init__(message)
+
+class ScopeMismatchError(DIError):
+
+    def __init__(self, resource_name=None, required_name=None):
+        self.resource_name = resource_name
+        self.required_name = required_name
+        super().__init__(
+                "Singleton resource {!r} requires per-build resource {!r}"
+                "".format(resource_name, required_name))
+
+class DependencyCycleError(DIError):
+
+    def __init__(self, cycle=None):
+        self.cycle = cycle
+        if cycle:
+            message = "Resources require each other: {}".format(
+                    ' -> '.join(cycle))
+        else:
+            message = "Resources require each other"
+        super().__init__(message)
+
+class ProviderNotFoundError(DIError):
+
+    def __init__(self, resource_name=None, required_by=None):
+        self.resource_name = resource_name
+        self.required_by = required_by
+        if resource_name and required_by:
+            message = (
+                    "A provider could not be found for resource {!r}, "
+                    "required by {!r}".format(resource_name, required_by))
+        elif resource_name:
             message = (
                     "A provider could not be found for resource {!r}"
                     "".format(resource_name))
@@ -157,12 +521,50 @@ class DependencyResolver:
         self.query_dependents_resources = \
                 self.dependency_register.query_resources
         self.resolve = self.resource_provider_register.resolve
+        self.build_scope = self.resource_provider_register.build_scope
+        self.defer = self.resource_provider_register.defer
+        self.eager_init = self.resource_provider_register.eager_init
+
+        # Maps dependents to functions returning their resources, made by
+        # _make_injector(), until anything else is registered
+        self._injectors = {}
+        self.dependency_register.on_change.append(self._injectors.clear)
+        self.resource_provider_register.on_change.append(
+                self._injectors.clear)
+
+    def _make_injector(self, dependent):
+        '''Make a function returning a list of dependent's resources, in
+        order.
+        '''
+        resolvers = tuple(
+                self.resource_provider_register.get_resolver(resource_name)
+                for resource_name in
+                self.query_dependents_resources(dependent))
+
+        def inject():
+            return [resolve() for resolve in resolvers]
+        return inject
 
     def resolve_all_dependencies(self, dependent):
-        return [
-                self.resolve(resource_name)
-                for resource_name in
-                self.query_dependents_resources(dependent)]
+        injector = self._injectors.get(dependent)
+        if injector is None:
+            injector = self._injectors[dependent] = self._make_injector(
+                    dependent)
+        return injector()
+
+    def validate(self):
+        '''Check that every resource, and every dependent's resources, can
+        be provided, raising a DIError if not.
+        '''
+        self.resource_provider_register.validate()
+        providers = self.resource_provider_register.resource_providers
+        for dependent, resource_names in (
+                self.dependency_register.dependents.items()):
+            for resource_name in resource_names:
+                if resource_name not in providers:
+                    raise ProviderNotFoundError(
+                            resource_name=resource_name,
+                            required_by=dependent)
 
     def unpack(self, dependent):
         resources = self.resolve_all_dependencies(dependent)
@@ -181,5 +583,6 @@ resolver = DependencyResolver(
         dependency_register=dependencies,
         resource_provider_register=providers)
 
-# For use as a decorator
+# For use as decorators
 dependsOn = dependencies.register_by_decorator
+provides = providers.register_by_decorator
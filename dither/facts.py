@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import functools
+import contextlib
+
+from . import manifest
+
+FACT_CACHE_NAME = 'fact_cache.json'
+FACT_CACHE_PATH = os.path.join('built_dotfiles', FACT_CACHE_NAME)
+
+
+class FactProvider:
+    '''A function which finds out a fact about the local machine.
+
+    :param ttl: how many seconds the fact's value may be kept in the
+                on-disk fact cache, or None to find it out afresh in every
+                build.
+    '''
+
+    def __init__(self, name, func, ttl=None):
+        self.name = name
+        self.func = func
+        self.ttl = ttl
+
+    def __repr__(self):
+        return 'FactProvider({!r}, {!r}, ttl={!r})'.format(
+                self.name, self.func, self.ttl)
+
+# Maps fact names to their providers. Filled in by @fact, including from
+# template_context.py.
+providers = {}
+
+class FactSet:
+    '''The facts found out during one build.
+
+    Each fact is found out at most once, the first time it's looked up.
+    Facts whose provider has a ttl are also kept in an on-disk cache
+    between builds, until they expire.
+    '''
+
+    def __init__(self, cache_path=None, use_cache=True, clock=time.time):
+        self.cache_path = cache_path
+        self.use_cache = use_cache
+        self.clock = clock
+        self.values = {}
+        # Maps fact names to how long finding them out took, in seconds
+        self.timings = {}
+        # Names of facts which came from the on-disk cache
+        self.from_cache = set()
+        self._cache = None
+        self._cache_changed = False
+
+    def _load_cache(self):
+        if self._cache is None:
+            self._cache = {}
+            if self.cache_path is not None:
+                try:
+                    with open(self.cache_path, 'r') as f:
+                        self._cache = json.load(f)
+                except (IOError, ValueError):
+                    pass
+        return self._cache
+
+    def _find_cached(self, provider):
+        if not self.use_cache or provider.ttl is None:
+            return None
+        entry = self._load_cache().get(provider.name)
+        if entry is None or self.clock() - entry['time'] > provider.ttl:
+            return None
+        return entry
+
+    def _store_cached(self, provider, value):
+        if provider.ttl is None or self.cache_path is None:
+            return
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError):
+            # Only JSON-serialisable values can be cached
+            return
+        self._load_cache()[provider.name] = {
+            'value': value,
+            'time': self.clock(),
+        }
+        self._cache_changed = True
+
+    def lookup(self, name):
+        if name in self.values:
+            return self.values[name]
+        provider = providers.get(name)
+        if provider is None:
+            raise KeyError("No provider registered for fact {!r}".format(
+                    name))
+
+        start = time.perf_counter()
+        cached = self._find_cached(provider)
+        if cached is not None:
+            value = cached['value']
+            self.from_cache.add(name)
+        else:
+            value = provider.func()
+            self._store_cached(provider, value)
+        self.timings[name] = time.perf_counter() - start
+
+        self.values[name] = value
+        return value
+
+    def save_cache(self):
+        if not self._cache_changed:
+            return
+        # Outside a dither directory, there's nowhere to keep the cache
+        if not os.path.isdir(os.path.dirname(self.cache_path) or os.curdir):
+            return
+        manifest.write_json_atomically(self.cache_path, self._cache)
+        self._cache_changed = False
+
+# The FactSet which lookups are made in. Outside a build, facts are still
+# only found out once per process.
+_current_fact_set = FactSet()
+
+def get_current_fact_set():
+    return _current_fact_set
+
+@contextlib.contextmanager
+def using(fact_set):
+    '''Make lookups in fact_set for the duration of a with statement.
+    '''
+    global _current_fact_set
+    previous_fact_set = _current_fact_set
+    _current_fact_set = fact_set
+    try:
+        yield fact_set
+    finally:
+        _current_fact_set = previous_fact_set
+
+def lookup(name):
+    return _current_fact_set.lookup(name)
+
+def fact(name=None, ttl=None):
+    '''Register a function as the provider of a fact.
+
+    Calling the decorated function then looks the fact up, so it's only
+    found out once per build. For use in template_context.py, eg:
+
+        @fact(ttl=24 * 60 * 60)
+        def git_email():
+            return subprocess.check_output(
+                    ['git', 'config', 'user.email']).decode().strip()
+
+    :param name: the fact's name. Defaults to the function's name.
+    :param ttl: see :class:`FactProvider`.
+    '''
+    def decorator(func):
+        fact_name = name or func.__name__
+        providers[fact_name] = FactProvider(fact_name, func, ttl=ttl)
+
+        @functools.wraps(func)
+        def look_up_fact():
+            return lookup(fact_name)
+        return look_up_fact
+    return decorator
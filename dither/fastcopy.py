@@ -0,0 +1,138 @@
+'''Copying files as cheaply as the filesystem allows.
+
+In order of preference:
+
+- a reflink (FICLONE), which shares the source's blocks until either copy
+  is modified, so costs no time or space whatever the file's size
+- copy_file_range(), which copies within the kernel, and lets some
+  filesystems (eg NFS 4.2) copy on the server
+- sendfile(), which also copies within the kernel
+- reading and writing through userspace
+
+Which of these works is found out once for each pair of filesystems, then
+remembered for the rest of the process.
+'''
+
+import os
+import sys
+import errno
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# From linux/fs.h
+FICLONE = 0x40049409
+# Most bytes copied by each system call
+CHUNK_SIZE = 64 * 1024 * 1024
+READ_WRITE_CHUNK_SIZE = 1024 * 1024
+
+REFLINK = 'reflink'
+COPY_FILE_RANGE = 'copy_file_range'
+SENDFILE = 'sendfile'
+READ_WRITE = 'read_write'
+METHODS = (REFLINK, COPY_FILE_RANGE, SENDFILE, READ_WRITE)
+
+# Errors meaning a method doesn't work between two filesystems, rather
+# than that copying failed
+UNSUPPORTED_ERRNOS = frozenset(
+        getattr(errno, name) for name in (
+            'EXDEV', 'EOPNOTSUPP', 'ENOTSUP', 'EINVAL', 'ENOSYS', 'ENOTTY',
+            'EBADF', 'ENOTSOCK', 'EPERM')
+        if hasattr(errno, name))
+
+# Maps (source st_dev, destination st_dev) to the first method which
+# worked between them
+_methods_by_devices = {}
+
+
+class UnsupportedCopyMethodError(OSError):
+
+    def __init__(self, method):
+        self.method = method
+        super().__init__(
+                errno.ENOTSUP, "{} isn't available here".format(method))
+
+def _reflink(source_fd, dest_fd, size):
+    if fcntl is None or not sys.platform.startswith('linux'):
+        raise UnsupportedCopyMethodError(REFLINK)
+    fcntl.ioctl(dest_fd, FICLONE, source_fd)
+
+def _copy_in_chunks(copy_chunk, method, size):
+    copied = 0
+    while True:
+        chunk_copied = copy_chunk()
+        if chunk_copied == 0:
+            break
+        copied += chunk_copied
+    # Some files (eg in /proc) claim to be empty to these system calls
+    if copied == 0 and size > 0:
+        raise UnsupportedCopyMethodError(method)
+
+def _copy_file_range(source_fd, dest_fd, size):
+    if not hasattr(os, 'copy_file_range'):
+        raise UnsupportedCopyMethodError(COPY_FILE_RANGE)
+    _copy_in_chunks(
+            lambda: os.copy_file_range(source_fd, dest_fd, CHUNK_SIZE),
+            COPY_FILE_RANGE, size)
+
+def _sendfile(source_fd, dest_fd, size):
+    if not hasattr(os, 'sendfile'):
+        raise UnsupportedCopyMethodError(SENDFILE)
+    _copy_in_chunks(
+            lambda: os.sendfile(dest_fd, source_fd, None, CHUNK_SIZE),
+            SENDFILE, size)
+
+def _read_write(source_fd, dest_fd, size):
+    while True:
+        data = os.read(source_fd, READ_WRITE_CHUNK_SIZE)
+        if not data:
+            break
+        view = memoryview(data)
+        while view:
+            view = view[os.write(dest_fd, view):]
+
+COPY_FUNCS = {
+    REFLINK: _reflink,
+    COPY_FILE_RANGE: _copy_file_range,
+    SENDFILE: _sendfile,
+    READ_WRITE: _read_write,
+}
+
+def get_method(source_dev, dest_dev):
+    '''Return the method copying between these devices will start with.
+    '''
+    return _methods_by_devices.get((source_dev, dest_dev), METHODS[0])
+
+def copy_file(source_path, dest_path):
+    '''Copy source_path's contents (but, like shutil.copyfile(), not its
+    permissions) to dest_path, replacing anything there. Returns the
+    method used.
+    '''
+    source_fd = os.open(source_path, os.O_RDONLY)
+    try:
+        dest_fd = os.open(
+                dest_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            source_stat = os.fstat(source_fd)
+            devices = (source_stat.st_dev, os.fstat(dest_fd).st_dev)
+            first_method = get_method(*devices)
+            for method in METHODS[METHODS.index(first_method):]:
+                try:
+                    COPY_FUNCS[method](source_fd, dest_fd, source_stat.st_size)
+                except OSError as e:
+                    if (method == READ_WRITE
+                            or e.errno not in UNSUPPORTED_ERRNOS):
+                        raise
+                    # Start again with the next method
+                    os.lseek(source_fd, 0, os.SEEK_SET)
+                    os.lseek(dest_fd, 0, os.SEEK_SET)
+                    os.ftruncate(dest_fd, 0)
+                    continue
+                _methods_by_devices[devices] = method
+                return method
+        finally:
+            os.close(dest_fd)
+    finally:
+        os.close(source_fd)
@@ -0,0 +1,187 @@
+import os
+import json
+
+from . import facts
+from . import context
+from . import link
+from . import manifest
+
+# Kept light (no jinja2 or staticjinja) so that `dither update` can find
+# out it has nothing to do quickly
+
+TEMPLATES_DIR = context.TEMPLATES_DIR
+FINGERPRINT_NAME = 'fingerprint.json'
+FINGERPRINT_PATH = os.path.join(link.BASE_BUILD_DIR, FINGERPRINT_NAME)
+# Change this whenever what goes into a fingerprint changes, so that older
+# fingerprints never match
+FINGERPRINT_VERSION = 2
+IGNORED_DIR_NAMES = ('__pycache__',)
+
+
+def scan_tree(root_dir):
+    '''Map the path, relative to root_dir, of each file under root_dir to
+    its modification time (in nanoseconds) and size.
+    '''
+    stats = {}
+    to_visit = ['']
+    while to_visit:
+        relative_dir = to_visit.pop()
+        with os.scandir(os.path.join(root_dir, relative_dir)) as entries:
+            for entry in entries:
+                relative_path = os.path.join(relative_dir, entry.name)
+                if entry.is_dir():
+                    if entry.name not in IGNORED_DIR_NAMES:
+                        to_visit.append(relative_path)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    stats[relative_path] = [stat.st_mtime_ns, stat.st_size]
+    return stats
+
+def get_context_digest(build_context):
+    '''Hash a build context, or return None if it has lazy values, which
+    can't be compared without computing them.
+    '''
+    if build_context.has_lazy_values():
+        return None
+    return manifest.hash_context(dict(build_context))
+
+def get_current_context_digest(templates_dir=TEMPLATES_DIR):
+    '''Compute the build context as a build would now, and hash it.
+
+    This runs template_context.py, and finds out any facts it uses (or
+    takes them from the fact cache), but needs neither jinja2 nor
+    staticjinja.
+    '''
+    fact_set = facts.FactSet(cache_path=facts.FACT_CACHE_PATH)
+    with facts.using(fact_set):
+        build_context = context.get_build_context(
+                context_path=os.path.join(
+                    templates_dir, os.path.basename(context.CONTEXT_PATH)))
+    fact_set.save_cache()
+    return get_context_digest(build_context)
+
+class TreeFingerprint:
+    '''Identifies what a build of this machine's dotfiles was made from:
+    the modification time, size and hash of each file in the templates
+    directory, and the hash of the build context (including the local
+    machine's facts, and anything template_context.py added).
+
+    Comparing modification times and sizes is enough to tell no template
+    has changed without reading any files. Files whose modification time
+    has changed but whose size hasn't (eg after switching git branch and
+    back) are hashed to check. A build context with lazy values never
+    matches, since they may have changed.
+    '''
+
+    def __init__(self, files, context_digest, build=None):
+        # Map file names to [mtime_ns, size, hash]
+        self.files = files
+        # Hash of the build context, or None if it can't be compared
+        self.context_digest = context_digest
+        # Name of the build made from these inputs
+        self.build = build
+
+    @classmethod
+    def take(cls, templates_dir=TEMPLATES_DIR, build_context=None,
+             previous=None):
+        '''Fingerprint the templates directory and build_context (or the
+        build context as it would be now, if that isn't given).
+
+        Files whose modification time and size are as recorded in the
+        previous fingerprint aren't hashed again.
+        '''
+        previous_files = previous.files if previous is not None else {}
+        files = {}
+        for name, stat in scan_tree(templates_dir).items():
+            previous_file = previous_files.get(name)
+            if previous_file is not None and previous_file[:2] == stat:
+                files[name] = previous_file
+            else:
+                files[name] = stat + [
+                        manifest.hash_file(os.path.join(templates_dir, name))]
+
+        if build_context is None:
+            context_digest = get_current_context_digest(templates_dir)
+        else:
+            context_digest = get_context_digest(build_context)
+        return cls(files, context_digest)
+
+    @classmethod
+    def load(cls, fingerprint_path):
+        '''Load a fingerprint, or return None if there's no usable one.
+        '''
+        try:
+            with open(fingerprint_path, 'r') as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if data.get('version') != FINGERPRINT_VERSION:
+            return None
+        return cls(
+                data['files'], data['context'], build=data.get('build'))
+
+    def save(self, fingerprint_path):
+        manifest.write_json_atomically(fingerprint_path, {
+            'version': FINGERPRINT_VERSION,
+            'build': self.build,
+            'files': self.files,
+            'context': self.context_digest,
+        })
+
+    def digest(self):
+        '''Sum up what was built from, ignoring modification times, so
+        fingerprints of the same templates and context have the same
+        digest.
+        '''
+        hasher = manifest.new_hasher()
+        hasher.update(json.dumps({
+            'version': FINGERPRINT_VERSION,
+            'files': {
+                name: file_hash
+                for name, (_mtime_ns, _size, file_hash) in self.files.items()},
+            'context': self.context_digest,
+        }, sort_keys=True).encode('utf-8'))
+        return hasher.hexdigest()
+
+    def matches(self, templates_dir=TEMPLATES_DIR):
+        '''Check the templates directory and build context haven't
+        changed since this fingerprint was taken.
+        '''
+        if self.context_digest is None:
+            return False
+
+        current_stats = scan_tree(templates_dir)
+        if current_stats.keys() != self.files.keys():
+            return False
+        for name, (mtime_ns, size) in current_stats.items():
+            recorded_mtime_ns, recorded_size, recorded_hash = self.files[name]
+            if size != recorded_size:
+                return False
+            if mtime_ns != recorded_mtime_ns and manifest.hash_file(
+                    os.path.join(templates_dir, name)) != recorded_hash:
+                return False
+
+        # Checked last, since it runs template_context.py
+        return get_current_context_digest(templates_dir) == self.context_digest
+
+def is_installed_build_current(
+        base_build_dir=link.BASE_BUILD_DIR,
+        fingerprint_path=FINGERPRINT_PATH,
+        templates_dir=TEMPLATES_DIR):
+    '''Check whether the installed build was made from the templates and
+    build context as they are now, in which case `dither update` has nothing to do.
+    '''
+    fingerprint = TreeFingerprint.load(fingerprint_path)
+    if fingerprint is None or fingerprint.build is None:
+        return False
+
+    installed_build_link_path = os.path.join(
+            base_build_dir, link.INSTALLED_BUILD_NAME)
+    if not os.path.islink(installed_build_link_path):
+        return False
+    installed_build_path = os.path.realpath(installed_build_link_path)
+    if (os.path.basename(installed_build_path) != fingerprint.build
+            or not os.path.isdir(installed_build_path)):
+        return False
+
+    return fingerprint.matches(templates_dir)
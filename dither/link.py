@@ -1,7 +1,14 @@
 import os
 import os.path
 import re
+import json
+import stat
 import datetime
+import collections
+import concurrent.futures
+
+from . import manifest
+from . import catalogue
 
 PROG_NAME = 'dither'
 
@@ -14,6 +21,18 @@ TIMESTAMP_FMT = '%Y-%m-%d_%H-%M-%S'
 MOVE_TIMESTAMPED_FORMAT = '{original_name}.moved_by_{prog_name}_at_{timestamp}'
 
 HOME_DIR_LINK_NAME = '.dither_dotfiles'
+LINK_MANIFEST_NAME = 'link_manifest.json'
+
+# Recursive linking works relative to open directories with these
+RECURSIVE_LINK_FUNCS = (
+        os.open, os.stat, os.mkdir, os.rmdir, os.readlink, os.symlink,
+        os.rename, os.unlink)
+DIR_OPEN_FLAGS = (
+        os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0)
+        | getattr(os, 'O_NOFOLLOW', 0))
+
+# One change to a link: func is called with args to make it
+LinkAction = collections.namedtuple('LinkAction', ['path', 'func', 'args'])
 
 def _get_latest_build_subdir_from_link(build_dir):
     latest_build_link_path = os.path.join(build_dir, LATEST_BUILD_NAME)
@@ -30,6 +49,16 @@ def _get_latest_build_subdir_from_link(build_dir):
 
     return link_target
 
+def _get_latest_build_subdir_from_catalogue(build_dir):
+    record = catalogue.BuildCatalogue.open(build_dir).find_latest()
+    if record is None:
+        return None
+
+    build_subdir = os.path.join(build_dir, record.id)
+    if not os.path.isdir(build_subdir):
+        return None
+    return build_subdir
+
 def _get_latest_build_subdir_by_file_sorting(build_dir):
     built_at_dirs = [
             name for name in os.listdir(build_dir)
@@ -46,10 +75,13 @@ def find_latest_build_subdir(build_dir):
     # `<build_dir>/latest_build` to the last
     # `<build_dir>/built_at_<timestamp>` subdirectory it made.
     # If this does exist, return its target
-    # Otherwise, try to guess what the newest built `built_at_*` dir is
-    # by sorting all of the `built_at_*` subdirs and using the last one.
+    # Otherwise, look up the newest complete build in the build catalogue,
+    # and failing that (eg for builds from before there was a catalogue),
+    # try to guess what the newest built `built_at_*` dir is by sorting
+    # all of the `built_at_*` subdirs and using the last one.
     for strategy in (
             _get_latest_build_subdir_from_link,
+            _get_latest_build_subdir_from_catalogue,
             _get_latest_build_subdir_by_file_sorting):
         result = strategy(build_dir)
         if result is not None:
@@ -57,13 +89,15 @@ def find_latest_build_subdir(build_dir):
     else:
         return None
 
-def move_to_timestamped_name(filepath):
+def get_timestamped_name(original_name):
     timestamp = datetime.datetime.now().strftime(TIMESTAMP_FMT)
-    new_filepath = MOVE_TIMESTAMPED_FORMAT.format(
-            original_name=filepath,
+    return MOVE_TIMESTAMPED_FORMAT.format(
+            original_name=original_name,
             prog_name=PROG_NAME,
             timestamp=timestamp)
-    os.rename(filepath, new_filepath)
+
+def move_to_timestamped_name(filepath):
+    os.rename(filepath, get_timestamped_name(filepath))
 
 def is_link_pointing_to_target(link_location, desired_target):
     if not os.path.exists(link_location):
@@ -79,38 +113,339 @@ def is_link_pointing_to_target(link_location, desired_target):
 
     return (abs_current_target == abs_desired_target)
 
+def replace_with_symlink(raw_link_target, link_location):
+    '''Point link_location at raw_link_target, atomically replacing any
+    symlink or file already there.
+
+    The new symlink is made under a temporary name and renamed over
+    link_location, so anything resolving link_location sees either the
+    old target or the new one, never nothing.
+    '''
+    temp_location = '{}.tmp-{}-{}'.format(
+            link_location, PROG_NAME, os.getpid())
+    if os.path.lexists(temp_location):
+        os.remove(temp_location)
+    os.symlink(raw_link_target, temp_location)
+    try:
+        os.replace(temp_location, link_location)
+    except OSError:
+        os.remove(temp_location)
+        raise
+
 def create_or_update_link(link_location, link_target, move_if_exists=False):
+    '''Make link_location a symlink to link_target.
+
+    Returns True if anything was changed.
+    '''
+    relative_link_target = os.path.relpath(
+            link_target, start=os.path.dirname(os.path.abspath(link_location)))
+
     # Test if link exists, even if it's broken
     if os.path.lexists(link_location):
         if is_link_pointing_to_target(link_location, link_target):
             # Nothing to do: link already exists and points to link_target
-            return
+            return False
 
-        # Link exists. Either move it aside, or just delete it.
+        # Link exists. Either move it aside, or just replace it.
         if move_if_exists:
             move_to_timestamped_name(link_location)
         else:
-            os.remove(link_location)
-
-    # XXX TODO: Possible bug in that commonprefix works character-by-character,
-    # and so may not always give valid directory names
-    common_base_dir = os.path.commonprefix([link_location, link_target])
-    relative_link_target = os.path.relpath(link_target, start=common_base_dir)
+            replace_with_symlink(relative_link_target, link_location)
+            return True
 
     os.symlink(relative_link_target, link_location)
+    return True
+
+def _apply_actions_in_order(actions):
+    errors = []
+    for action in actions:
+        try:
+            action.func(*action.args)
+        except OSError as e:
+            errors.append((action.path, e))
+    return errors
+
+def apply_link_actions(actions, jobs=1):
+    '''Apply actions, returning (path, exception) pairs for any which
+    failed, rather than stopping at the first failure.
+
+    Up to jobs threads apply actions at once, which pays off when each
+    filesystem operation is a round trip (eg on NFS or SSHFS). Actions on
+    the same path are always applied in the order given.
+    '''
+    actions_by_path = {}
+    for action in actions:
+        actions_by_path.setdefault(action.path, []).append(action)
+    if jobs <= 1 or len(actions_by_path) <= 1:
+        return _apply_actions_in_order(actions)
+
+    errors = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for path_errors in executor.map(
+                _apply_actions_in_order, actions_by_path.values()):
+            errors.extend(path_errors)
+    return errors
 
 def create_links_for_each_file_in_dir(
-        dir_of_files_to_link_to, dir_to_make_links_in):
+        dir_of_files_to_link_to, dir_to_make_links_in, filenames=None,
+        jobs=1):
+    '''Link each of filenames in dir_to_make_links_in to the same name in
+    dir_of_files_to_link_to, moving aside anything else in the way.
+
+    Returns (filename, exception) pairs for any links which couldn't be
+    made.
+    '''
+    if filenames is None:
+        filenames = os.listdir(dir_of_files_to_link_to)
+
+    actions = [
+            LinkAction(filename, create_or_update_link, (
+                os.path.join(dir_to_make_links_in, filename),
+                os.path.join(dir_of_files_to_link_to, filename),
+                True))
+            for filename in filenames]
+    return apply_link_actions(actions, jobs=jobs)
+
+def is_link_to(link_location, expected_target):
+    '''Like is_link_pointing_to_target(), but also true for broken links.
+    '''
+    if not os.path.islink(link_location):
+        return False
+    raw_target = os.readlink(link_location)
+    abs_target = os.path.abspath(
+            os.path.join(os.path.dirname(link_location), raw_target))
+    return abs_target == os.path.abspath(expected_target)
+
+def remove_link_to(link_location, expected_target):
+    if is_link_to(link_location, expected_target):
+        os.remove(link_location)
+
+def remove_links_for_each_file(
+        dir_of_linked_files, dir_links_are_in, filenames, jobs=1):
+    '''Remove links to files which are no longer built.
+
+    Anything which isn't a link into dir_of_linked_files is left alone.
+    Returns (filename, exception) pairs for any links which couldn't be
+    removed.
+    '''
+    actions = [
+            LinkAction(filename, remove_link_to, (
+                os.path.join(dir_links_are_in, filename),
+                os.path.join(dir_of_linked_files, filename)))
+            for filename in filenames]
+    return apply_link_actions(actions, jobs=jobs)
+
+def find_built_files(build_dir):
+    '''Return the paths, relative to build_dir, of every file in it or its
+    subdirectories.
+    '''
+    paths = set()
+    subdirs = ['']
+    while subdirs:
+        subdir = subdirs.pop()
+        with os.scandir(os.path.join(build_dir, subdir)) as entries:
+            for entry in entries:
+                path = os.path.join(subdir, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(path)
+                else:
+                    paths.add(path)
+    return paths
+
+def get_relative_link_target(path):
+    '''Return what the link at home_dir/path should point to, for the
+    file at the same path in ~/.dither_dotfiles.
+    '''
+    return os.path.join(
+            *([os.pardir] * path.count(os.sep)
+              + [HOME_DIR_LINK_NAME, path]))
+
+def supports_recursive_links():
+    return all(func in os.supports_dir_fd for func in RECURSIVE_LINK_FUNCS)
 
-    for filename in os.listdir(dir_of_files_to_link_to):
-        created_link_location = os.path.join(dir_to_make_links_in, filename)
-        created_link_target = os.path.join(dir_of_files_to_link_to, filename)
-        create_or_update_link(
-                created_link_location,
-                created_link_target,
-                move_if_exists=True)
+def _prepare_dir_at(parent_fd, name, path):
+    '''Make sure name, in the directory open as parent_fd, is a real
+    directory links can be made in.
+    '''
+    try:
+        stat_result = os.stat(name, dir_fd=parent_fd, follow_symlinks=False)
+    except FileNotFoundError:
+        os.mkdir(name, dir_fd=parent_fd)
+        return
 
-def link(base_build_dir=None, home_dir=None):
+    if stat.S_ISDIR(stat_result.st_mode):
+        return
+    if (stat.S_ISLNK(stat_result.st_mode)
+            and os.readlink(name, dir_fd=parent_fd) ==
+                get_relative_link_target(path)):
+        # The whole directory was linked before; link its files instead
+        os.unlink(name, dir_fd=parent_fd)
+    else:
+        os.rename(
+                name, get_timestamped_name(name),
+                src_dir_fd=parent_fd, dst_dir_fd=parent_fd)
+    os.mkdir(name, dir_fd=parent_fd)
+
+def _open_dir(dir_fds, path, create=False):
+    '''Return a file descriptor for the directory at path, relative to the
+    one open as dir_fds[''], or None if it doesn't exist.
+
+    Its parents are opened first (and, if create is given, made), and
+    every descriptor is kept in dir_fds, so each directory is only looked
+    up once.
+    '''
+    if path in dir_fds:
+        return dir_fds[path]
+
+    parent_path, name = os.path.split(path)
+    parent_fd = _open_dir(dir_fds, parent_path, create=create)
+    dir_fd = None
+    if parent_fd is not None:
+        if create:
+            _prepare_dir_at(parent_fd, name, path)
+        try:
+            dir_fd = os.open(name, DIR_OPEN_FLAGS, dir_fd=parent_fd)
+        except OSError:
+            # Missing, or not a directory. Symlinks aren't followed.
+            if create:
+                raise
+    dir_fds[path] = dir_fd
+    return dir_fd
+
+def _close_dirs(dir_fds):
+    for dir_fd in dir_fds.values():
+        if dir_fd is not None:
+            os.close(dir_fd)
+
+def _link_file_at(dir_fd, name, link_target):
+    try:
+        stat_result = os.stat(name, dir_fd=dir_fd, follow_symlinks=False)
+    except FileNotFoundError:
+        pass
+    else:
+        if (stat.S_ISLNK(stat_result.st_mode)
+                and os.readlink(name, dir_fd=dir_fd) == link_target):
+            return
+        # Any other file, directory or link is moved aside
+        os.rename(
+                name, get_timestamped_name(name),
+                src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+    os.symlink(link_target, name, dir_fd=dir_fd)
+
+def _remove_link_at(dir_fd, name, link_target):
+    try:
+        is_link = os.readlink(name, dir_fd=dir_fd) == link_target
+    except OSError:
+        # Missing, or not a link
+        return
+    if is_link:
+        os.unlink(name, dir_fd=dir_fd)
+
+def create_links_for_each_file_in_tree(
+        dir_to_make_links_in, paths, jobs=1):
+    '''Link each of paths (relative, eg '.config/nvim/init.vim') in
+    dir_to_make_links_in to the same path in ~/.dither_dotfiles.
+
+    Directories on the way are made as needed, so existing directories
+    like ~/.config are kept, and files in them dither doesn't build are
+    left alone. Anything else in the way is moved aside. Returns (path,
+    exception) pairs for any links which couldn't be made.
+    '''
+    dir_fds = {'': os.open(dir_to_make_links_in, DIR_OPEN_FLAGS)}
+    try:
+        # Directories are made first, so the links in them are independent
+        actions = []
+        errors = []
+        for path in paths:
+            parent_path, name = os.path.split(path)
+            try:
+                dir_fd = _open_dir(dir_fds, parent_path, create=True)
+            except OSError as e:
+                errors.append((path, e))
+                continue
+            actions.append(LinkAction(path, _link_file_at, (
+                    dir_fd, name, get_relative_link_target(path))))
+        return errors + apply_link_actions(actions, jobs=jobs)
+    finally:
+        _close_dirs(dir_fds)
+
+def remove_links_for_each_file_in_tree(dir_links_are_in, paths, jobs=1):
+    '''Remove links to files which are no longer built, and then any
+    directories left empty.
+
+    Anything which isn't a link into ~/.dither_dotfiles is left alone.
+    Returns (path, exception) pairs for any links which couldn't be
+    removed.
+    '''
+    dir_fds = {'': os.open(dir_links_are_in, DIR_OPEN_FLAGS)}
+    try:
+        actions = []
+        emptied_paths = set()
+        for path in paths:
+            parent_path, name = os.path.split(path)
+            dir_fd = _open_dir(dir_fds, parent_path)
+            if dir_fd is None:
+                continue
+            actions.append(LinkAction(path, _remove_link_at, (
+                    dir_fd, name, get_relative_link_target(path))))
+            while parent_path:
+                emptied_paths.add(parent_path)
+                parent_path = os.path.dirname(parent_path)
+        errors = apply_link_actions(actions, jobs=jobs)
+
+        # Deepest first, so parents are empty by the time they're tried
+        for path in sorted(emptied_paths, key=len, reverse=True):
+            parent_path, name = os.path.split(path)
+            try:
+                os.rmdir(name, dir_fd=dir_fds[parent_path])
+            except OSError:
+                # Not empty
+                pass
+        return errors
+    finally:
+        _close_dirs(dir_fds)
+
+def format_link_errors(errors):
+    return '\n'.join(
+            '  {}: {}'.format(path, error) for path, error in sorted(
+                errors, key=lambda path_error: path_error[0]))
+
+def load_link_manifest(link_manifest_path, home_dir):
+    '''Return the names dither last linked into home_dir, and whether they
+    were linked recursively, or None if that isn't known.
+    '''
+    try:
+        with open(link_manifest_path, 'r') as f:
+            data = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if data.get('home_dir') != os.path.abspath(home_dir):
+        return None
+    return set(data.get('links', [])), data.get('recursive', False)
+
+def save_link_manifest(link_manifest_path, home_dir, names, recursive):
+    manifest.write_json_atomically(link_manifest_path, {
+        'home_dir': os.path.abspath(home_dir),
+        'links': sorted(names),
+        'recursive': recursive,
+    })
+
+def link(
+        base_build_dir=None, home_dir=None, full=False, recursive=None,
+        jobs=1):
+    '''Link the latest build into home_dir.
+
+    Only links for files added to or removed from the build since the
+    last link are touched, unless full is given, in which case every
+    link is checked. With jobs above 1, that many links are changed at
+    once (see apply_link_actions()), and every link is tried even if
+    some fail.
+
+    If recursive is given, each file in the build's subdirectories is
+    linked in a directory of its own in home_dir, rather than linking
+    each top-level file or directory as a whole. By default, the build is
+    linked the same way as last time.
+    '''
     # Figure out what the latest build subdir is, usually by looking
     # for a "latest_build" symlink in build_dir
     latest_build_subdir = find_latest_build_subdir(base_build_dir)
@@ -119,18 +454,79 @@ def link(base_build_dir=None, home_dir=None):
                 "Couldn't find latest build directory in {!r}".format(
                     base_build_dir))
 
-    # Update "installed_build" link to point to latest build
+    link_manifest_path = os.path.join(base_build_dir, LINK_MANIFEST_NAME)
+    link_manifest = load_link_manifest(link_manifest_path, home_dir)
+    if recursive is None:
+        recursive = link_manifest is not None and link_manifest[1]
+    if recursive and not supports_recursive_links():
+        raise Exception("Recursive linking isn't supported on this platform")
+
+    # Update "installed_build" link to point to latest build. This is
+    # atomic, and links in the home directory all resolve through it, so
+    # they switch to the new build at the same instant.
     installed_build_link_path = os.path.join(
             base_build_dir, INSTALLED_BUILD_NAME)
     create_or_update_link(installed_build_link_path, latest_build_subdir)
 
     # Update ~/.dither_dotfiles/ to point to installed_build
     home_dir_link_path = os.path.join(home_dir, HOME_DIR_LINK_NAME)
-    create_or_update_link(
+    home_dir_link_changed = create_or_update_link(
             home_dir_link_path,
             os.path.abspath(installed_build_link_path),
             move_if_exists=True)
 
-    # For each file in ~/.dither_dotfiles/, make a link from
+    if recursive:
+        built_names = find_built_files(latest_build_subdir)
+    else:
+        built_names = set(os.listdir(latest_build_subdir))
+
+    linked_names, linked_recursively = None, recursive
+    if link_manifest is not None:
+        linked_names, linked_recursively = link_manifest
+    # Links made last time still resolve through ~/.dither_dotfiles, so
+    # unless that has moved, or the build is linked differently now, only
+    # new files need links
+    if (full or home_dir_link_changed or linked_names is None
+            or linked_recursively != recursive):
+        names_to_link = built_names
+    else:
+        names_to_link = built_names - linked_names
+    names_to_unlink = (linked_names or set()) - built_names
+
+    # For each new file in ~/.dither_dotfiles/, make a link from
     # ~/each_file to ~/.dither_dotfiles/eachfile
-    create_links_for_each_file_in_dir(home_dir_link_path, home_dir)
+    errors = []
+    if recursive:
+        if linked_names is not None and not linked_recursively:
+            # Whole directories which are now linked file by file are
+            # replaced as they're reached
+            errors += remove_links_for_each_file(
+                    home_dir_link_path, home_dir, sorted(names_to_unlink),
+                    jobs=jobs)
+            names_to_unlink = set()
+        errors += create_links_for_each_file_in_tree(
+                home_dir, sorted(names_to_link), jobs=jobs)
+        errors += remove_links_for_each_file_in_tree(
+                home_dir, sorted(names_to_unlink), jobs=jobs)
+    else:
+        if linked_names is not None and linked_recursively:
+            errors += remove_links_for_each_file_in_tree(
+                    home_dir, sorted(names_to_unlink), jobs=jobs)
+            names_to_unlink = set()
+        errors += create_links_for_each_file_in_dir(
+                home_dir_link_path, home_dir, filenames=sorted(names_to_link),
+                jobs=jobs)
+        errors += remove_links_for_each_file(
+                home_dir_link_path, home_dir, sorted(names_to_unlink),
+                jobs=jobs)
+
+    # The manifest is left as it was, so failed links are retried next time
+    if errors:
+        raise Exception(
+                "Couldn't update {} links in {!r}:\n{}".format(
+                    len(errors), home_dir, format_link_errors(errors)))
+
+    if (names_to_link or names_to_unlink or link_manifest is None
+            or linked_recursively != recursive):
+        save_link_manifest(
+                link_manifest_path, home_dir, built_names, recursive)
@@ -0,0 +1,43 @@
+'''The dither command's entry point.
+
+This imports nothing beyond the standard library until it has checked for
+--timing-imports, so that the import timer sees everything the command
+imports, click and dither.cli included.
+'''
+
+import sys
+
+TIMING_IMPORTS_OPTION = '--timing-imports'
+
+
+def wants_import_timing(args):
+    '''Check for --timing-imports among the options given before the
+    command name, where click accepts it.
+    '''
+    for arg in args:
+        if arg == TIMING_IMPORTS_OPTION:
+            return True
+        if not arg.startswith('-'):
+            break
+    return False
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    import_timer = None
+    if wants_import_timing(args):
+        from . import timing
+        import_timer = timing.ImportTimer()
+        import_timer.start()
+
+    try:
+        from .cli import cli
+        cli.main(args=args, prog_name='dither')
+    finally:
+        if import_timer is not None:
+            import_timer.stop()
+            print(import_timer.format_table(), file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
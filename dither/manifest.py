@@ -0,0 +1,142 @@
+import os
+import json
+import hashlib
+
+MANIFEST_NAME = 'build_manifest.json'
+HASH_CHUNK_SIZE = 64 * 1024
+# Keys of manifest entries which describe the output rather than the inputs
+OUTPUT_KEYS = ('output', 'hash')
+
+
+def new_hasher():
+    return hashlib.sha1()
+
+def hash_file(file_path):
+    hasher = new_hasher()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def hash_context(context):
+    '''Hash a template context.
+
+    Values which can't be serialised as JSON are hashed by their repr(),
+    which may not be stable between runs. At worst this means a template
+    gets re-rendered when it didn't need to be.
+    '''
+    serialised = json.dumps(context, sort_keys=True, default=repr)
+    return hashlib.sha1(serialised.encode('utf-8')).hexdigest()
+
+def write_json_atomically(file_path, data):
+    temp_path = '{}.tmp-{}'.format(file_path, os.getpid())
+    with open(temp_path, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(temp_path, file_path)
+
+def get_inputs(entry):
+    return {
+            key: value for key, value in entry.items()
+            if key not in OUTPUT_KEYS}
+
+
+class BuildManifest:
+    '''Records the inputs each output of a build was produced from.
+
+    For templates this is the hash of the template source, the hashes of
+    every partial it includes, extends or imports, and the hash of the
+    context it was rendered with. For static files it's just the hash of
+    the source file.
+
+    Each entry also records where the output is in the build and, where
+    known, the hash of the output's content.
+    '''
+
+    def __init__(self, build_path=None, templates=None, static=None):
+        self.build_path = build_path
+        # Map template names to their inputs and output path
+        self.templates = templates or {}
+        # Map static file names to their inputs and output path
+        self.static = static or {}
+
+    @classmethod
+    def load(cls, manifest_path, build_output_dir):
+        '''Load a manifest, or return None if there's no usable one.
+        '''
+        try:
+            with open(manifest_path, 'r') as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        build_path = os.path.join(build_output_dir, data.get('build', ''))
+        if not (data.get('build') and os.path.isdir(build_path)):
+            return None
+
+        return cls(
+                build_path=build_path,
+                templates=data.get('templates'),
+                static=data.get('static'))
+
+    def save(self, manifest_path):
+        write_json_atomically(manifest_path, {
+            'build': os.path.basename(self.build_path),
+            'templates': self.templates,
+            'static': self.static,
+        })
+
+    def _find_reusable_output(self, entries, name, inputs):
+        entry = entries.get(name)
+        if entry is None:
+            return None
+        if any(entry.get(key) != value for key, value in inputs.items()):
+            return None
+
+        output_path = os.path.join(self.build_path, entry['output'])
+        if not os.path.isfile(output_path):
+            return None
+        return output_path, entry.get('hash')
+
+    def find_reusable_template_output(self, template_name, inputs):
+        '''Return the path and hash of a previous output rendered from
+        identical inputs, or None if the template must be rendered again.
+
+        The hash is None if it wasn't recorded.
+        '''
+        # Templates whose partials couldn't be determined are never reused
+        if inputs.get('partials') is None:
+            return None
+        return self._find_reusable_output(
+                self.templates, template_name, inputs)
+
+    def find_reusable_static_output(self, static_name, inputs):
+        return self._find_reusable_output(self.static, static_name, inputs)
+
+    def find_template_output_by_hash(self, template_name, output_hash):
+        '''Return the path of a template's output if its content has the
+        given hash, whatever it was rendered from, or None otherwise.
+        '''
+        entry = self.templates.get(template_name)
+        if entry is None or entry.get('hash') != output_hash:
+            return None
+        output_path = os.path.join(self.build_path, entry['output'])
+        if not os.path.isfile(output_path):
+            return None
+        return output_path
+
+    def _make_entry(self, output_path, inputs, output_hash):
+        entry = dict(inputs)
+        entry['output'] = os.path.relpath(output_path, self.build_path)
+        if output_hash is not None:
+            entry['hash'] = output_hash
+        return entry
+
+    def record_template(self, template_name, output_path, inputs,
+                        output_hash=None):
+        self.templates[template_name] = self._make_entry(
+                output_path, inputs, output_hash)
+
+    def record_static(self, static_name, output_path, inputs,
+                      output_hash=None):
+        self.static[static_name] = self._make_entry(
+                output_path, inputs, output_hash)
@@ -0,0 +1,97 @@
+'''Providers of the resources dither's commands use, for the dither.di
+container.
+
+Nothing is made until it's first resolved, so a command only pays for
+the resources it actually uses: `dither link` never makes a jinja2
+Environment, and so never imports jinja2. Per-build resources are shared
+by everything in the same build (see dither.build.build_scope()).
+
+Providers name the resources they require, which are passed to them in
+order; `dither di-graph` shows how they fit together.
+'''
+
+import logging
+
+from . import di
+
+LOGGER_NAME = 'dither.build'
+
+
+@di.provides('logger', scope=di.SINGLETON)
+def provide_logger():
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(logging.DEBUG)
+    if not logger.handlers:
+        logger.addHandler(logging.StreamHandler())
+    return logger
+
+@di.provides('profiler', scope=di.PER_BUILD)
+def provide_profiler():
+    from . import timing
+    return timing.NullProfiler()
+
+@di.provides('fact_set', scope=di.PER_BUILD)
+def provide_fact_set():
+    from . import facts
+    return facts.FactSet(cache_path=facts.FACT_CACHE_PATH)
+
+@di.provides('build_context', scope=di.PER_BUILD, requires=('logger',))
+def provide_build_context(logger):
+    from . import context
+    return context.get_build_context(
+            context_path=context.CONTEXT_PATH, log=logger)
+
+@di.provides('bytecode_cache_dir', scope=di.PER_BUILD)
+def provide_bytecode_cache_dir():
+    from . import build
+    return build.BYTECODE_CACHE_DIR
+
+@di.provides(
+        'jinja_environment', scope=di.PER_BUILD,
+        requires=('bytecode_cache_dir',))
+def provide_jinja_environment(bytecode_cache_dir):
+    from . import build
+    return build.make_environment(
+            build.TEMPLATES_DIR, bytecode_cache_dir=bytecode_cache_dir)
+
+@di.provides(
+        'dependency_index', scope=di.PER_BUILD,
+        requires=('jinja_environment',))
+def provide_dependency_index(jinja_environment):
+    from . import build
+    from . import deps
+    return deps.DependencyIndex.load(
+            jinja_environment, build.DEPENDENCY_INDEX_PATH)
+
+@di.provides('previous_manifest', scope=di.PER_BUILD)
+def provide_previous_manifest():
+    from . import build
+    from . import manifest
+    return manifest.BuildManifest.load(
+            build.MANIFEST_PATH, build.BUILD_OUTPUT_DIR)
+
+@di.provides('build_path', scope=di.PER_BUILD)
+def provide_build_path():
+    from . import build
+    return build.get_build_output_subdir()
+
+@di.provides(
+        'renderer', scope=di.PER_BUILD,
+        requires=(
+            'build_path', 'previous_manifest', 'jinja_environment',
+            'dependency_index', 'profiler'))
+def provide_renderer(
+        build_path, previous_manifest, jinja_environment, dependency_index,
+        profiler):
+    '''The renderer for a build of this machine's dotfiles.
+    '''
+    from . import build
+    return build.make_renderer(
+            searchpath=build.TEMPLATES_DIR,
+            outpath=build_path,
+            previous_manifest=previous_manifest,
+            environment=jinja_environment,
+            dependency_index=dependency_index,
+            profiler=profiler,
+            object_store_dir=build.OBJECT_STORE_DIR,
+            get_build_context=di.resolver.defer('build_context'))
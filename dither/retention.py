@@ -0,0 +1,265 @@
+import os
+import re
+import time
+import shutil
+import datetime
+import threading
+
+from . import link
+from . import manifest
+from . import store
+from . import catalogue
+
+BASE_BUILD_DIR = link.BASE_BUILD_DIR
+HOSTS_SUBDIR = 'hosts'
+OBJECT_STORE_DIR = os.path.join(BASE_BUILD_DIR, store.OBJECTS_DIR_NAME)
+
+# Builds kept by the automatic clean up after each build
+DEFAULT_KEEP = 10
+TRASH_DIR_FMT = '.trash-{pid}'
+TRASH_DIR_PREFIX = '.trash-'
+# Objects stored this recently are never pruned, since whatever stored them
+# (eg `dither watch`, which doesn't record builds in the catalogue) may not
+# have linked them into a build yet
+PRUNE_GRACE_SECONDS = 10 * 60
+# Builds recorded as building for longer than this are assumed to have
+# died without recording that they failed
+STALE_BUILD_SECONDS = 24 * 60 * 60
+DURATION_UNITS = {
+        's': 1,
+        'm': 60,
+        'h': 60 * 60,
+        'd': 24 * 60 * 60,
+        'w': 7 * 24 * 60 * 60,
+}
+BUILD_NAME_RE = re.compile(
+        r'^' + re.escape(link.BUILT_AT_PREFIX) +
+        r'(?P<timestamp>\d{4}-\d\d-\d\d_\d\d-\d\d-\d\d)(?:_(?P<suffix>\d+))?$')
+
+
+def parse_duration(text):
+    '''Parse a duration like '30d', '12h' or '2w' into a timedelta.
+    '''
+    match = re.match(r'^\s*(\d+)\s*([smhdw])\s*$', text)
+    if match is None:
+        raise ValueError(
+                "Durations look like 30d, 12h or 2w, not {!r}".format(text))
+    count, unit = match.groups()
+    return datetime.timedelta(seconds=int(count) * DURATION_UNITS[unit])
+
+def list_builds(build_output_dir):
+    '''List the built_at_* directories in build_output_dir, oldest first,
+    as (name, built_at) pairs.
+    '''
+    builds = []
+    with os.scandir(build_output_dir) as entries:
+        for entry in entries:
+            match = BUILD_NAME_RE.match(entry.name)
+            if match is None or not entry.is_dir(follow_symlinks=False):
+                continue
+            built_at = datetime.datetime.strptime(
+                    match.group('timestamp'), link.TIMESTAMP_FMT)
+            suffix = int(match.group('suffix') or 0)
+            builds.append(((built_at, suffix), entry.name))
+    builds.sort()
+    return [(name, built_at) for (built_at, _unused), name in builds]
+
+def find_protected_builds(build_output_dir):
+    '''Find the names of builds which must never be removed: those linked
+    as the latest and installed builds, and the one the next build carries
+    unchanged outputs forward from.
+    '''
+    protected = set()
+    for link_name in (link.LATEST_BUILD_NAME, link.INSTALLED_BUILD_NAME):
+        link_path = os.path.join(build_output_dir, link_name)
+        if os.path.islink(link_path):
+            protected.add(os.path.basename(os.path.normpath(os.path.join(
+                    build_output_dir, os.readlink(link_path)))))
+
+    build_manifest = manifest.BuildManifest.load(
+            os.path.join(build_output_dir, manifest.MANIFEST_NAME),
+            build_output_dir)
+    if build_manifest is not None:
+        protected.add(os.path.basename(build_manifest.build_path))
+    return protected
+
+def select_builds_to_remove(builds, protected, keep=None, keep_within=None,
+                            now=None):
+    '''Pick which builds a retention policy removes.
+
+    A build is kept if it's one of the newest keep builds, if it was built
+    within keep_within (a timedelta) of now, or if it's protected. With
+    neither keep nor keep_within, nothing is removed.
+
+    :param builds: (name, built_at) pairs, oldest first
+    '''
+    if keep is None and keep_within is None:
+        return []
+    if now is None:
+        now = datetime.datetime.now()
+
+    kept = set(protected)
+    if keep:
+        kept.update(name for name, _unused in builds[-keep:])
+    if keep_within is not None:
+        kept.update(
+                name for name, built_at in builds
+                if now - built_at <= keep_within)
+    return [name for name, _unused in builds if name not in kept]
+
+def remove_builds(build_output_dir, names):
+    '''Remove builds from sight, by renaming each into a trash directory.
+
+    Renaming is cheap, whereas deleting a build means unlinking each of its
+    files one at a time, so that's left to empty_trash().
+    '''
+    if not names:
+        return
+    trash_dir = os.path.join(
+            build_output_dir, TRASH_DIR_FMT.format(pid=os.getpid()))
+    os.makedirs(trash_dir, exist_ok=True)
+    for name in names:
+        os.rename(
+                os.path.join(build_output_dir, name),
+                os.path.join(trash_dir, name))
+    catalogue.BuildCatalogue.open(build_output_dir).record_removed(names)
+
+def empty_trash(build_output_dir):
+    '''Delete every trash directory in build_output_dir, including any
+    left behind by earlier runs, and return whether there were any.
+    '''
+    trash_dirs = [
+            os.path.join(build_output_dir, name)
+            for name in os.listdir(build_output_dir)
+            if name.startswith(TRASH_DIR_PREFIX)]
+    for trash_dir in trash_dirs:
+        # Another dither process may be emptying it too
+        shutil.rmtree(trash_dir, ignore_errors=True)
+    return bool(trash_dirs)
+
+def find_prune_cutoff(build_output_dirs, now=None):
+    '''Find the time before which objects must have been stored to be
+    pruned: the start of the oldest build still running, or
+    PRUNE_GRACE_SECONDS ago, whichever is earlier.
+    '''
+    if now is None:
+        now = time.time()
+    cutoff = now - PRUNE_GRACE_SECONDS
+    for build_output_dir in build_output_dirs:
+        running_builds = catalogue.BuildCatalogue.open(
+                build_output_dir).list_builds(status=catalogue.BUILDING)
+        for record in running_builds:
+            if now - record.built_at < STALE_BUILD_SECONDS:
+                cutoff = min(cutoff, record.built_at)
+    return cutoff
+
+def prune_objects(store_dir, cutoff=None):
+    '''Delete objects which no build links to any more, and return how
+    many were deleted.
+
+    Objects modified at or after cutoff (a time.time() value) are kept,
+    since a running build may have stored them without linking them into
+    the build yet.
+    '''
+    if not os.path.isdir(store_dir):
+        return 0
+
+    pruned = 0
+    with os.scandir(store_dir) as prefix_entries:
+        for prefix_entry in prefix_entries:
+            if (prefix_entry.name == store.TEMP_DIR_NAME
+                    or not prefix_entry.is_dir(follow_symlinks=False)):
+                continue
+            with os.scandir(prefix_entry.path) as entries:
+                for entry in entries:
+                    entry_stat = entry.stat(follow_symlinks=False)
+                    # Only the store itself links to it
+                    if (entry_stat.st_nlink == 1 and (
+                            cutoff is None or entry_stat.st_mtime < cutoff)):
+                        os.remove(entry.path)
+                        pruned += 1
+    return pruned
+
+def find_build_output_dirs(build_output_dir, hosts_subdir):
+    '''Find every directory builds are made in: build_output_dir, and each
+    host's directory from `dither build --host-list`.
+    '''
+    build_output_dirs = [build_output_dir]
+    hosts_dir = os.path.join(build_output_dir, hosts_subdir)
+    if os.path.isdir(hosts_dir):
+        build_output_dirs.extend(
+                os.path.join(hosts_dir, hostname)
+                for hostname in sorted(os.listdir(hosts_dir)))
+    return build_output_dirs
+
+def empty_trash_and_prune(build_output_dirs, store_dir):
+    '''Delete removed builds, then any objects in the store which only
+    they used, and return the number of objects pruned.
+    '''
+    emptied = False
+    for build_output_dir in build_output_dirs:
+        if os.path.isdir(build_output_dir):
+            emptied = empty_trash(build_output_dir) or emptied
+    if not emptied:
+        return 0
+    return prune_objects(
+            store_dir, cutoff=find_prune_cutoff(build_output_dirs))
+
+def collect_garbage(build_output_dirs, store_dir, keep=None,
+                    keep_within=None, dry_run=False, wait=True):
+    '''Remove old builds according to a retention policy, then any objects
+    in the store which only they used.
+
+    Removed builds are out of sight at once, but deleting their files
+    takes time. Unless wait is given, that's done in a background thread,
+    and anything it hasn't finished when the process exits is deleted by a
+    later call instead.
+
+    Returns the paths of removed builds, and the number of objects pruned
+    (None if not waiting).
+    '''
+    removed = []
+    for build_output_dir in build_output_dirs:
+        if not os.path.isdir(build_output_dir):
+            continue
+        names = select_builds_to_remove(
+                list_builds(build_output_dir),
+                find_protected_builds(build_output_dir),
+                keep=keep,
+                keep_within=keep_within)
+        if not dry_run:
+            remove_builds(build_output_dir, names)
+        removed.extend(
+                os.path.join(build_output_dir, name) for name in names)
+
+    if dry_run:
+        return removed, 0
+    if wait:
+        return removed, empty_trash_and_prune(build_output_dirs, store_dir)
+
+    # The working directory may change before the thread is done
+    thread = threading.Thread(
+            target=empty_trash_and_prune,
+            args=(
+                [os.path.abspath(path) for path in build_output_dirs],
+                os.path.abspath(store_dir)),
+            daemon=True)
+    thread.start()
+    return removed, None
+
+def gc(keep=None, keep_within=None, dry_run=False, wait=True):
+    '''Collect garbage in the build output directory (see
+    collect_garbage()), and prune the cache of compiled templates.
+    '''
+    removed, pruned = collect_garbage(
+            find_build_output_dirs(BASE_BUILD_DIR, HOSTS_SUBDIR),
+            OBJECT_STORE_DIR,
+            keep=keep,
+            keep_within=keep_within,
+            dry_run=dry_run,
+            wait=wait)
+    if not dry_run:
+        # Imported here, since it needs jinja2
+        from . import build
+        build.prune_bytecode_cache()
+    return removed, pruned
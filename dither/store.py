@@ -0,0 +1,134 @@
+import os
+import shutil
+import itertools
+
+from . import manifest
+from . import fastcopy
+
+OBJECTS_DIR_NAME = 'objects'
+TEMP_DIR_NAME = 'tmp'
+# Objects are shared by every build containing them, and by links into the
+# home directory, so mustn't be edited in place
+OBJECT_MODE = 0o444
+
+
+def ensure_dir_exists(dir_path):
+    if not os.path.exists(dir_path):
+        os.makedirs(dir_path, exist_ok=True)
+
+def link_or_copy(source_path, dest_path):
+    try:
+        os.link(source_path, dest_path)
+    except OSError:
+        fastcopy.copy_file(source_path, dest_path)
+        shutil.copystat(source_path, dest_path)
+
+class ObjectStore:
+    '''A content-addressed store of built files.
+
+    Each distinct file content is stored once, named by its hash, and
+    builds are made of hardlinks to the stored objects. A build in which
+    nothing changed then costs one hardlink per file, and no extra space.
+
+    Objects are read-only, but can still be changed (eg by root, or an
+    editor which makes them writable first), so they're checked against
+    their hash before being reused.
+    '''
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.temp_dir = os.path.join(store_dir, TEMP_DIR_NAME)
+        self._temp_counter = itertools.count()
+        # Maps hashes of objects found intact to the size, inode and
+        # modification time they had then
+        self._intact_stats = {}
+
+    def get_object_path(self, digest):
+        return os.path.join(self.store_dir, digest[:2], digest[2:])
+
+    def has_object(self, digest):
+        '''Check the store has an object with this hash, and that its
+        content hasn't been changed since it was stored.
+        '''
+        object_path = self.get_object_path(digest)
+        try:
+            object_stat = os.stat(object_path)
+        except FileNotFoundError:
+            return False
+        stat_key = (
+                object_stat.st_size, object_stat.st_ino,
+                object_stat.st_mtime_ns, object_stat.st_ctime_ns)
+        if self._intact_stats.get(digest) == stat_key:
+            return True
+        if manifest.hash_file(object_path) != digest:
+            return False
+        self._intact_stats[digest] = stat_key
+        return True
+
+    def make_temp_path(self):
+        '''Get a path to write a new file at before adding it to the store.
+        '''
+        ensure_dir_exists(self.temp_dir)
+        return os.path.join(self.temp_dir, '{}-{}'.format(
+                os.getpid(), next(self._temp_counter)))
+
+    def add_file(self, temp_path, digest=None):
+        '''Move a newly written file into the store, and return its hash.
+
+        If the store already has a file with the same content, the new file
+        is just deleted. If the stored file has been changed since, the new
+        file replaces it.
+        '''
+        if digest is None:
+            digest = manifest.hash_file(temp_path)
+        os.chmod(temp_path, OBJECT_MODE)
+        object_path = self.get_object_path(digest)
+        ensure_dir_exists(os.path.dirname(object_path))
+        try:
+            # Unlike renaming, this never replaces an object other builds
+            # may already be linked to
+            os.link(temp_path, object_path)
+        except FileExistsError:
+            if not self.has_object(digest):
+                os.replace(temp_path, object_path)
+                return digest
+        os.remove(temp_path)
+        return digest
+
+    def add_copy(self, source_path, digest=None):
+        '''Copy a file into the store, and return its hash.
+
+        If digest (the file's hash) is given and the store already has that
+        content, nothing is copied.
+        '''
+        if digest is not None and self.has_object(digest):
+            return digest
+        temp_path = self.make_temp_path()
+        fastcopy.copy_file(source_path, temp_path)
+        return self.add_file(temp_path)
+
+    def adopt(self, file_path):
+        '''Add an existing file, eg from a build made before there was an
+        object store, by hardlinking it into the store. Returns its hash.
+        '''
+        digest = manifest.hash_file(file_path)
+        if not self.has_object(digest):
+            temp_path = self.make_temp_path()
+            link_or_copy(file_path, temp_path)
+            self.add_file(temp_path, digest=digest)
+        return digest
+
+    def materialise(self, digest, dest_path):
+        '''Place a stored object at dest_path, replacing anything there.
+        '''
+        object_path = self.get_object_path(digest)
+        ensure_dir_exists(os.path.dirname(dest_path))
+        if not os.path.lexists(dest_path):
+            link_or_copy(object_path, dest_path)
+            return
+        if os.path.samefile(object_path, dest_path):
+            return
+
+        temp_path = self.make_temp_path()
+        link_or_copy(object_path, temp_path)
+        os.replace(temp_path, dest_path)
@@ -0,0 +1,224 @@
+import os
+import sys
+import json
+import time
+import builtins
+import importlib.util
+import contextlib
+
+PROFILE_FORMATS = ('json', 'chrome')
+DEFAULT_TOP_N = 20
+# Modules which commands that don't render templates should never import
+HEAVY_MODULES = ('jinja2', 'staticjinja')
+
+
+class Profiler:
+    '''Records how long each phase of a build, and each template, takes.
+
+    Times come from time.perf_counter(), which is shared between processes
+    on the same machine, so events recorded in build workers can be merged
+    into the parent's profile.
+    '''
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        # Dicts with category, name, start, duration, bytes and pid keys
+        self.events = []
+
+    @contextlib.contextmanager
+    def measure(self, category, name):
+        '''Time the body of a with statement.
+
+        The event is yielded, so the body can set how many bytes it wrote:
+
+            with profiler.measure('static', name) as event:
+                event['bytes'] = copy_file(...)
+        '''
+        event = {
+            'category': category,
+            'name': name,
+            'start': time.perf_counter(),
+            'bytes': 0,
+            'pid': os.getpid(),
+        }
+        try:
+            yield event
+        finally:
+            event['duration'] = time.perf_counter() - event['start']
+            self.events.append(event)
+
+    def phase(self, name):
+        return self.measure('phase', name)
+
+    def pop_events(self):
+        events = self.events
+        self.events = []
+        return events
+
+    def merge(self, events):
+        self.events.extend(events)
+
+    def get_totals(self):
+        totals = {}
+        for event in self.events:
+            total = totals.setdefault(
+                    event['category'],
+                    {'count': 0, 'duration': 0.0, 'bytes': 0})
+            total['count'] += 1
+            total['duration'] += event['duration']
+            total['bytes'] += event['bytes']
+        return totals
+
+    def format_table(self, top_n=DEFAULT_TOP_N):
+        lines = ['{:>10}  {:>12}  {:<10}  {}'.format(
+                'seconds', 'bytes', 'category', 'name')]
+        slowest = sorted(
+                self.events, key=lambda event: event['duration'],
+                reverse=True)
+        for event in slowest[:top_n]:
+            lines.append('{:>10.4f}  {:>12}  {:<10}  {}'.format(
+                    event['duration'], event['bytes'],
+                    event['category'], event['name']))
+
+        lines.append('')
+        lines.append('{:>10}  {:>12}  {:<10}  {}'.format(
+                'seconds', 'bytes', 'category', 'count'))
+        for category, total in sorted(self.get_totals().items()):
+            lines.append('{:>10.4f}  {:>12}  {:<10}  {}'.format(
+                    total['duration'], total['bytes'],
+                    category, total['count']))
+        lines.append('{:>10.4f}  {:>12}  {:<10}'.format(
+                time.perf_counter() - self.start_time, '', 'wall'))
+        return '\n'.join(lines)
+
+    def to_json(self):
+        return {
+            'events': [
+                dict(event, start=event['start'] - self.start_time)
+                for event in self.events],
+            'totals': self.get_totals(),
+        }
+
+    def to_chrome_trace(self):
+        '''Convert to the Trace Event Format read by chrome://tracing and
+        Perfetto.
+        '''
+        return {
+            'traceEvents': [
+                {
+                    'name': event['name'],
+                    'cat': event['category'],
+                    'ph': 'X',
+                    'ts': (event['start'] - self.start_time) * 1e6,
+                    'dur': event['duration'] * 1e6,
+                    'pid': event['pid'],
+                    'tid': event['pid'],
+                    'args': {'bytes': event['bytes']},
+                }
+                for event in self.events],
+            'displayTimeUnit': 'ms',
+        }
+
+    def save(self, output_path, output_format='json'):
+        if output_format not in PROFILE_FORMATS:
+            raise ValueError(
+                    "Profile format must be one of {!r}".format(
+                        PROFILE_FORMATS))
+        if output_format == 'chrome':
+            data = self.to_chrome_trace()
+        else:
+            data = self.to_json()
+        with open(output_path, 'w') as f:
+            json.dump(data, f, indent=1)
+
+class NullProfiler:
+    '''Stands in for a Profiler when not profiling.
+    '''
+
+    @contextlib.contextmanager
+    def measure(self, category, name):
+        yield {}
+
+    def phase(self, name):
+        return self.measure('phase', name)
+
+    def pop_events(self):
+        return []
+
+    def merge(self, events):
+        pass
+
+class ImportTimer:
+    '''Records which modules get imported while running, and how long
+    each takes to import, including the modules it imports itself.
+    '''
+
+    def __init__(self):
+        # Dicts with name, modules (the number of modules newly imported)
+        # and duration keys, in the order imports finished
+        self.imports = []
+        self._original_import = None
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self._original_import = builtins.__import__
+        builtins.__import__ = self._timed_import
+
+    def stop(self):
+        builtins.__import__ = self._original_import
+        self.duration = time.perf_counter() - self.start_time
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(),
+                      level=0):
+        already_imported = set(sys.modules)
+        start = time.perf_counter()
+        try:
+            return self._original_import(
+                    name, globals, locals, fromlist, level)
+        finally:
+            duration = time.perf_counter() - start
+            newly_imported = set(sys.modules) - already_imported
+            if newly_imported:
+                self.imports.append({
+                    'name': self._find_imported_name(
+                        name, globals, fromlist, level, newly_imported),
+                    'modules': len(newly_imported),
+                    'duration': duration,
+                })
+
+    def _find_imported_name(self, name, globals, fromlist, level,
+                            newly_imported):
+        '''Work out which of the newly imported modules an import statement
+        asked for, rather than one of that module's own imports.
+        '''
+        if level:
+            package = (globals or {}).get('__package__') or ''
+            name = importlib.util.resolve_name('.' * level + name, package)
+        requested = [
+                '{}.{}'.format(name, from_name) if name else from_name
+                for from_name in fromlist or ()]
+        requested.append(name)
+        for module_name in requested:
+            if module_name in newly_imported:
+                return module_name
+        return min(newly_imported)
+
+    def find_heavy_modules(self):
+        return [name for name in HEAVY_MODULES if name in sys.modules]
+
+    def format_table(self, top_n=DEFAULT_TOP_N):
+        lines = ['{:>10}  {:>7}  {}'.format('seconds', 'modules', 'import')]
+        slowest = sorted(
+                self.imports, key=lambda entry: entry['duration'],
+                reverse=True)
+        for entry in slowest[:top_n]:
+            lines.append('{:>10.4f}  {:>7}  {}'.format(
+                    entry['duration'], entry['modules'], entry['name']))
+
+        lines.append('')
+        lines.append('{:>10.4f}  {:>7}  {}'.format(
+                self.duration, len(sys.modules), 'command (total modules)'))
+        heavy_modules = self.find_heavy_modules()
+        if heavy_modules:
+            lines.append('Imported: {}'.format(', '.join(heavy_modules)))
+        return '\n'.join(lines)
@@ -0,0 +1,206 @@
+import os
+import time
+import queue
+
+import watchdog.events
+import watchdog.observers
+
+from . import build
+from . import di
+from . import link
+
+# After a change arrives, wait this long for more before rebuilding, so
+# that an editor saving via several writes and renames causes one rebuild
+SETTLE_SECONDS = 0.02
+
+WATCHED_EVENT_TYPES = (
+        watchdog.events.EVENT_TYPE_CREATED,
+        watchdog.events.EVENT_TYPE_MODIFIED,
+        watchdog.events.EVENT_TYPE_MOVED,
+        watchdog.events.EVENT_TYPE_DELETED,
+)
+
+
+class ChangeCollector(watchdog.events.FileSystemEventHandler):
+
+    def __init__(self, changes):
+        super().__init__()
+        # Queue of paths of changed files
+        self.changes = changes
+
+    def on_any_event(self, event):
+        if event.is_directory or event.event_type not in WATCHED_EVENT_TYPES:
+            return
+        self.changes.put(event.src_path)
+        if getattr(event, 'dest_path', None):
+            self.changes.put(event.dest_path)
+
+class Watcher:
+    '''Updates the latest build in place as templates change.
+
+    The renderer, and with it the jinja2 Environment and build context, is
+    kept for the whole time dither is watching. Only templates affected by
+    a change (including those which include or extend a changed partial)
+    are rendered again, and each replaces its old output atomically, so
+    dotfiles linked into the home directory never appear half-written.
+    '''
+
+    def __init__(self, renderer, base_build_dir=None, home_dir=None,
+                 manifest_path=None, dependency_index_path=None):
+        self.base_build_dir = base_build_dir
+        self.home_dir = home_dir
+        self.manifest_path = manifest_path
+        self.dependency_index_path = dependency_index_path
+        self.renderer = renderer
+        # Compare against the build being updated, so files which were
+        # touched but not actually changed aren't rendered again
+        self.renderer.previous_manifest = renderer.manifest
+
+    def to_source_name(self, path):
+        relative_path = os.path.relpath(
+                os.path.abspath(path), self.renderer.searchpath)
+        if relative_path.startswith(os.pardir):
+            return None
+        return relative_path
+
+    def is_linked_recursively(self):
+        link_manifest = link.load_link_manifest(
+                os.path.join(self.base_build_dir, link.LINK_MANIFEST_NAME),
+                self.home_dir)
+        return link_manifest is not None and link_manifest[1]
+
+    def list_outputs(self):
+        # Recursive links are made for each file, not each top-level entry
+        if self.is_linked_recursively():
+            return link.find_built_files(self.renderer.outpath)
+        return set(os.listdir(self.renderer.outpath))
+
+    def find_affected_templates(self, changed_names):
+        template_names = set(self.renderer.template_names)
+        # New templates aren't in the dependency index yet
+        for name in changed_names & template_names:
+            self.renderer.find_referenced_templates(name)
+        dependency_index = self.renderer.dependency_index
+        return template_names & dependency_index.find_dependents(changed_names)
+
+    def remove_output(self, name):
+        build_manifest = self.renderer.manifest
+        for entries in (build_manifest.templates, build_manifest.static):
+            entry = entries.pop(name, None)
+            if entry is None:
+                continue
+            output_path = os.path.join(
+                    build_manifest.build_path, entry['output'])
+            if os.path.lexists(output_path):
+                self.renderer.logger.info("Removing %s..." % name)
+                os.remove(output_path)
+
+    def reload_context(self):
+        '''Start again with a new renderer, since the build context it
+        caches is out of date.
+
+        The jinja2 Environment and dependency index are kept. Every
+        template is checked, but only those using context values which
+        actually changed are rendered again.
+        '''
+        with build.build_scope(
+                jinja_environment=self.renderer._env,
+                dependency_index=self.renderer.dependency_index,
+                build_path=self.renderer.outpath,
+                previous_manifest=self.renderer.manifest):
+            self.renderer = di.resolver.resolve('renderer')
+            self.renderer.run(use_reloader=False)
+
+    def update_outputs(self, changed_names):
+        self.renderer.forget_sources(changed_names)
+
+        for name in sorted(changed_names):
+            if not os.path.exists(
+                    os.path.join(self.renderer.searchpath, name)):
+                self.remove_output(name)
+
+        for template_name in sorted(
+                self.find_affected_templates(changed_names)):
+            self.renderer.build_template(template_name)
+
+        for name in sorted(changed_names):
+            if (os.path.isfile(os.path.join(self.renderer.searchpath, name))
+                    and self.renderer.is_static(name)):
+                self.renderer.build_static(name)
+
+    def handle_changes(self, changed_paths):
+        changed_names = set(filter(None, map(
+                self.to_source_name, changed_paths)))
+        if not changed_names:
+            return
+
+        outputs_before = self.list_outputs()
+
+        if os.path.basename(build.CONTEXT_PATH) in changed_names:
+            self.reload_context()
+        else:
+            self.update_outputs(changed_names)
+        self.renderer.manifest.save(self.manifest_path)
+        if self.dependency_index_path is not None:
+            self.renderer.save_dependency_index(self.dependency_index_path)
+
+        # Existing links in the home directory already see updated outputs,
+        # so only link again if files were added or removed
+        if self.list_outputs() != outputs_before:
+            link.link(
+                    base_build_dir=self.base_build_dir,
+                    home_dir=self.home_dir)
+
+    def collect_changes(self, changes):
+        '''Wait for a change, then gather any others which follow close
+        behind it.
+        '''
+        changed_paths = {changes.get()}
+        settle_deadline = time.monotonic() + SETTLE_SECONDS
+        while True:
+            remaining = settle_deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                changed_paths.add(changes.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return changed_paths
+
+    def watch(self):
+        changes = queue.Queue()
+        observer = watchdog.observers.Observer()
+        observer.schedule(
+                ChangeCollector(changes),
+                self.renderer.searchpath,
+                recursive=True)
+        observer.start()
+
+        self.renderer.logger.info(
+                "Watching '%s' for changes..." % self.renderer.searchpath)
+        self.renderer.logger.info("Press Ctrl+C to stop.")
+        try:
+            while True:
+                changed_paths = self.collect_changes(changes)
+                try:
+                    self.handle_changes(changed_paths)
+                except Exception:
+                    # Keep watching: the next save will probably fix it
+                    self.renderer.logger.exception("Rebuild failed")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            observer.stop()
+            observer.join()
+
+def watch(home_dir=None, use_cache=True):
+    renderer = build.build(use_cache=use_cache)
+    link.link(base_build_dir=link.BASE_BUILD_DIR, home_dir=home_dir)
+
+    watcher = Watcher(
+            renderer,
+            base_build_dir=link.BASE_BUILD_DIR,
+            home_dir=home_dir,
+            manifest_path=build.MANIFEST_PATH,
+            dependency_index_path=build.DEPENDENCY_INDEX_PATH)
+    watcher.watch()
@@ -63,7 +63,17 @@ setup(
     # project is installed. For an analysis of "install_requires" vs pip's
     # requirements files see:
     # https://packaging.python.org/en/latest/technical.html#install-requires-vs-requirements-files
-    install_requires=['click', 'colorama', 'staticjinja', 'jinja2'],
+    install_requires=[
+        'click', 'colorama', 'staticjinja', 'jinja2', 'watchdog'],
+
+    # List additional groups of dependencies here (e.g. development
+    # dependencies). You can install these using the following syntax,
+    # for example:
+    # $ pip install -e .[hosts]
+    extras_require={
+        # For reading YAML host lists in `dither build --host-list`
+        'hosts': ['PyYAML'],
+    },
 
     # If there are data files included in your packages that need to be
     # installed, specify them here.  If using Python 2.6 or less, then these
@@ -83,7 +93,7 @@ setup(
     # pip to create the appropriate form of executable for the target platform.
     entry_points={
         'console_scripts': [
-            'dither=dither.cli:cli',
+            'dither=dither.main:main',
         ],
     },
 )
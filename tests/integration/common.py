@@ -56,6 +56,18 @@ def get_context(**kwargs):
 ''')
     return test_context_path
 
+def build_version(template_path, version):
+    '''Build with the template at template_path saying which version it
+    is, keeping every old build, and return the path of the new build.
+    '''
+    import dither.build
+
+    with open(template_path, 'w') as f:
+        f.write('version {}\n'.format(version))
+    dither.build.build(keep=None)
+    return os.path.relpath(os.path.realpath(os.path.join(
+            BUILD_OUTPUT_DIR, LATEST_BUILD_LINK_NAME)))
+
 def resolve_symlink(symlink_path, os_module=None):
     if os_module is None:
         import os as os_module
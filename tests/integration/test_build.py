@@ -1,13 +1,20 @@
 import os
+import sys
+import stat
 import unittest
+import unittest.mock
+import tracemalloc
 
 import dither.build
+import dither.retention
+import dither.timing
 
 from common import (
         DitherIntegrationTestCase,
         CreateDitherSandboxDirMixin,
         create_test_template,
         create_test_context,
+        CONTEXT_NAME,
         LATEST_BUILD_LINK_NAME,
         TEST_TEMPLATED_FILE_NAME)
 
@@ -48,5 +55,471 @@ sample output
 this line should appear
 My variable is Test value.''')
 
+class Test_unchanged_template_carried_forward(
+        CreateDitherSandboxDirMixin,
+        DitherIntegrationTestCase):
+
+    def setUp(self):
+        self.create_dither_sandbox_dir()
+
+        create_test_template(self.templates_dir)
+        create_test_context(self.templates_dir)
+
+        self.change_cwd_to_sandbox_dither_dir()
+
+    def runTest(self):
+        dither.build.build()
+        first_filepath = os.path.realpath(
+                find_templated_file(self.build_output_dir))
+
+        dither.build.build()
+        second_filepath = os.path.realpath(
+                find_templated_file(self.build_output_dir))
+
+        self.assertNotEqual(
+                os.path.dirname(first_filepath),
+                os.path.dirname(second_filepath),
+                "Second build didn't get its own build directory")
+        self.assertTrue(
+                os.path.samefile(first_filepath, second_filepath),
+                "Unchanged output wasn't carried forward from first build")
+
+class Test_template_rerendered_when_partial_changes(
+        CreateDitherSandboxDirMixin,
+        DitherIntegrationTestCase):
+
+    def setUp(self):
+        self.create_dither_sandbox_dir()
+
+        template_path = os.path.join(self.templates_dir, '.test.template')
+        with open(template_path, 'w') as f:
+            f.write("{% include '_partial.tpl' %}\n")
+        self.partial_path = os.path.join(self.templates_dir, '_partial.tpl')
+        with open(self.partial_path, 'w') as f:
+            f.write('first version\n')
+        create_test_context(self.templates_dir)
+
+        self.change_cwd_to_sandbox_dither_dir()
+
+    def runTest(self):
+        dither.build.build()
+        with open(self.partial_path, 'w') as f:
+            f.write('second version\n')
+        dither.build.build()
+
+        with open(find_templated_file(self.build_output_dir), 'r') as f:
+            contents = f.read()
+        self.assertEqual(contents.strip(), 'second version')
+
+class Test_missing_partials_tolerated(
+        CreateDitherSandboxDirMixin,
+        DitherIntegrationTestCase):
+
+    def setUp(self):
+        self.create_dither_sandbox_dir()
+
+        template_path = os.path.join(self.templates_dir, '.test.template')
+        with open(template_path, 'w') as f:
+            f.write(
+                    "{% include '_optional.tpl' ignore missing %}"
+                    "{% include ['_missing.tpl', '_partial.tpl'] %}")
+        with open(os.path.join(self.templates_dir, '_partial.tpl'), 'w') as f:
+            f.write('partial')
+        self.optional_path = os.path.join(self.templates_dir, '_optional.tpl')
+        create_test_context(self.templates_dir)
+
+        self.change_cwd_to_sandbox_dither_dir()
+
+    def runTest(self):
+        dither.build.build()
+        with open(find_templated_file(self.build_output_dir), 'r') as f:
+            self.assertEqual(f.read(), 'partial')
+
+        # Once the partial exists, the template is rendered again
+        with open(self.optional_path, 'w') as f:
+            f.write('optional ')
+        dither.build.build()
+        with open(find_templated_file(self.build_output_dir), 'r') as f:
+            self.assertEqual(f.read(), 'optional partial')
+
+class Test_identical_outputs_stored_once(
+        CreateDitherSandboxDirMixin,
+        DitherIntegrationTestCase):
+
+    def setUp(self):
+        self.create_dither_sandbox_dir()
+
+        template_path = os.path.join(self.templates_dir, '.test.template')
+        with open(template_path, 'w') as f:
+            f.write("{% include '_partial.tpl' %}\n")
+        self.partial_path = os.path.join(self.templates_dir, '_partial.tpl')
+        with open(self.partial_path, 'w') as f:
+            f.write('first version\n')
+        create_test_context(self.templates_dir)
+
+        self.change_cwd_to_sandbox_dither_dir()
+
+    def runTest(self):
+        dither.build.build()
+        first_filepath = os.path.realpath(
+                find_templated_file(self.build_output_dir))
+
+        with open(self.partial_path, 'w') as f:
+            f.write('second version\n')
+        dither.build.build()
+        with open(self.partial_path, 'w') as f:
+            f.write('first version\n')
+        dither.build.build()
+        third_filepath = os.path.realpath(
+                find_templated_file(self.build_output_dir))
+
+        self.assertNotEqual(first_filepath, third_filepath)
+        self.assertTrue(
+                os.path.samefile(first_filepath, third_filepath),
+                "Output identical to an earlier build's wasn't deduplicated")
+
+class Test_edited_output_not_reused(
+        CreateDitherSandboxDirMixin,
+        DitherIntegrationTestCase):
+
+    def setUp(self):
+        self.create_dither_sandbox_dir()
+
+        template_path = os.path.join(self.templates_dir, '.test.template')
+        with open(template_path, 'w') as f:
+            f.write("{% include '_partial.tpl' %}\n")
+        self.partial_path = os.path.join(self.templates_dir, '_partial.tpl')
+        with open(self.partial_path, 'w') as f:
+            f.write('first version\n')
+        create_test_context(self.templates_dir)
+
+        self.change_cwd_to_sandbox_dither_dir()
+
+    def edit_output(self):
+        # As if edited through its link in the home directory
+        filepath = find_templated_file(self.build_output_dir)
+        self.assertEqual(stat.S_IMODE(os.stat(filepath).st_mode), 0o444)
+        os.chmod(filepath, 0o644)
+        with open(filepath, 'w') as f:
+            f.write('edited\n')
+
+    def read_output(self):
+        with open(find_templated_file(self.build_output_dir), 'r') as f:
+            return f.read().strip()
+
+    def runTest(self):
+        dither.build.build()
+        self.edit_output()
+        dither.build.build()
+        self.assertEqual(self.read_output(), 'first version')
+
+        self.edit_output()
+        with open(self.partial_path, 'w') as f:
+            f.write('second version\n')
+        dither.build.build()
+        with open(self.partial_path, 'w') as f:
+            f.write('first version\n')
+        dither.build.build()
+        self.assertEqual(self.read_output(), 'first version')
+
+class Test_identical_output_not_rewritten(
+        CreateDitherSandboxDirMixin,
+        DitherIntegrationTestCase):
+
+    def setUp(self):
+        self.create_dither_sandbox_dir()
+
+        self.template_path = os.path.join(
+                self.templates_dir, '.test.template')
+        with open(self.template_path, 'w') as f:
+            f.write("{{ 'same output' }}\n")
+        create_test_context(self.templates_dir)
+
+        self.change_cwd_to_sandbox_dither_dir()
+
+    def runTest(self):
+        dither.build.build()
+        first_filepath = os.path.realpath(
+                find_templated_file(self.build_output_dir))
+
+        # Different source, same output
+        with open(self.template_path, 'w') as f:
+            f.write("same output\n")
+        renderer = dither.build.build()
+        second_filepath = os.path.realpath(
+                find_templated_file(self.build_output_dir))
+
+        self.assertTrue(os.path.samefile(first_filepath, second_filepath))
+        self.assertEqual(renderer.output_counts, {'written': 0, 'reused': 1})
+
+class Test_unused_lazy_context_value_not_computed(
+        CreateDitherSandboxDirMixin,
+        DitherIntegrationTestCase):
+
+    def setUp(self):
+        self.create_dither_sandbox_dir()
+
+        create_test_template(self.templates_dir)
+        with open(os.path.join(self.templates_dir, CONTEXT_NAME), 'w') as f:
+            f.write('''\
+from dither.context import lazy
+
+def unused_probe():
+    raise Exception("unused lazy value was computed")
+
+def get_context(**kwargs):
+    return {
+        'test_true': True,
+        'test_var': lazy(lambda: 'Lazy value'),
+        'unused_var': lazy(unused_probe),
+    }
+''')
+
+        self.change_cwd_to_sandbox_dither_dir()
+
+    def runTest(self):
+        sys_path_length = len(sys.path)
+        dither.build.build()
+
+        with open(find_templated_file(self.build_output_dir), 'r') as f:
+            contents = f.read()
+        self.assertIn('My variable is Lazy value.', contents)
+        self.assertLessEqual(len(sys.path), sys_path_length + 1,
+                "sys.path grew by more than one entry during a build")
+
+class Test_parallel_build_output_is_as_expected(
+        CreateDitherSandboxDirMixin,
+        DitherIntegrationTestCase):
+
+    def setUp(self):
+        self.create_dither_sandbox_dir()
+
+        create_test_template(self.templates_dir)
+        create_test_context(self.templates_dir)
+        with open(os.path.join(self.templates_dir, 'static_file'), 'w') as f:
+            f.write('static contents\n')
+
+        self.change_cwd_to_sandbox_dither_dir()
+
+    def runTest(self):
+        dither.build.build(jobs=2)
+
+        with open(find_templated_file(self.build_output_dir), 'r') as f:
+            contents = f.read()
+        self.assertIn('My variable is Test value.', contents)
+
+        static_filepath = os.path.join(
+                self.build_output_dir, LATEST_BUILD_LINK_NAME, 'static_file')
+        with open(static_filepath, 'r') as f:
+            self.assertEqual(f.read(), 'static contents\n')
+
+class Test_parallel_build_without_fork_counts_each_output_once(
+        CreateDitherSandboxDirMixin,
+        DitherIntegrationTestCase):
+
+    TEMPLATE_COUNT = 20
+
+    def setUp(self):
+        self.create_dither_sandbox_dir()
+
+        for index in range(self.TEMPLATE_COUNT):
+            template_path = os.path.join(
+                    self.templates_dir, '.test{}.template'.format(index))
+            with open(template_path, 'w') as f:
+                f.write('{{ test_var }}\n')
+        create_test_context(self.templates_dir)
+
+        self.change_cwd_to_sandbox_dither_dir()
+
+    def runTest(self):
+        profiler = dither.timing.Profiler()
+        with unittest.mock.patch.object(
+                dither.build.multiprocessing, 'get_all_start_methods',
+                return_value=['spawn']):
+            renderer = dither.build.build(jobs=4, profiler=profiler)
+
+        self.assertEqual(
+                renderer.output_counts,
+                {'written': self.TEMPLATE_COUNT, 'reused': 0})
+        self.assertEqual(
+                len([event for event in profiler.events
+                     if event['category'] == 'template']),
+                self.TEMPLATE_COUNT)
+        self.assertEqual(len(renderer.manifest.templates), self.TEMPLATE_COUNT)
+
+class Test_compiled_templates_cached(
+        CreateDitherSandboxDirMixin,
+        DitherIntegrationTestCase):
+
+    def setUp(self):
+        self.create_dither_sandbox_dir()
+
+        create_test_template(self.templates_dir)
+        create_test_context(self.templates_dir)
+
+        self.change_cwd_to_sandbox_dither_dir()
+
+    def runTest(self):
+        dither.build.build()
+        self.assertTrue(os.listdir(dither.build.BYTECODE_CACHE_DIR),
+                "No compiled templates were cached")
+
+        dither.build.clear_bytecode_cache()
+        dither.build.build(use_cache=False)
+        self.assertFalse(os.path.exists(dither.build.BYTECODE_CACHE_DIR),
+                "Compiled templates were cached when caching was disabled")
+
+class Test_outdated_compiled_templates_pruned(
+        CreateDitherSandboxDirMixin,
+        DitherIntegrationTestCase):
+
+    def setUp(self):
+        self.create_dither_sandbox_dir()
+
+        self.template_path = create_test_template(self.templates_dir)
+        create_test_context(self.templates_dir)
+
+        self.change_cwd_to_sandbox_dither_dir()
+
+    def runTest(self):
+        dither.build.build(keep=None)
+        first_entries = set(os.listdir(dither.build.BYTECODE_CACHE_DIR))
+        with open(self.template_path, 'a') as f:
+            f.write('changed\n')
+        dither.build.build(keep=None)
+        self.assertEqual(
+                len(os.listdir(dither.build.BYTECODE_CACHE_DIR)),
+                len(first_entries) + 1)
+
+        dither.retention.gc(keep=10)
+
+        current_entries = set(os.listdir(dither.build.BYTECODE_CACHE_DIR))
+        self.assertEqual(len(current_entries), len(first_entries))
+        self.assertFalse(current_entries & first_entries)
+
+class Test_dependents_found_through_partials(
+        CreateDitherSandboxDirMixin,
+        DitherIntegrationTestCase):
+
+    def setUp(self):
+        self.create_dither_sandbox_dir()
+
+        for name, contents in [
+                ('.test.template', "{% extends 'base.tpl' %}"),
+                ('base.tpl', "{% include '_partial.tpl' %}"),
+                ('_partial.tpl', 'partial'),
+                ('.unrelated.template', 'unrelated')]:
+            with open(os.path.join(self.templates_dir, name), 'w') as f:
+                f.write(contents)
+
+        self.change_cwd_to_sandbox_dither_dir()
+
+    def runTest(self):
+        self.assertEqual(
+                dither.build.query_dependencies('_partial.tpl'),
+                ['.test.template', '_partial.tpl', 'base.tpl'])
+        self.assertEqual(
+                dither.build.query_dependencies(
+                    '.test.template', requires=True),
+                ['_partial.tpl', 'base.tpl'])
+
+class Test_host_list_build_shares_host_independent_outputs(
+        CreateDitherSandboxDirMixin,
+        DitherIntegrationTestCase):
+
+    def setUp(self):
+        self.create_dither_sandbox_dir()
+
+        for name, contents in [
+                ('.hostname.template', '{{ hostname }}'),
+                ('.shared.template', '{{ test_var }}')]:
+            with open(os.path.join(self.templates_dir, name), 'w') as f:
+                f.write(contents)
+        create_test_context(self.templates_dir)
+        self.host_list_path = os.path.join(self.test_dither_dir, 'hosts.json')
+        with open(self.host_list_path, 'w') as f:
+            f.write('{"alpha": {"os": "Alpha OS"}, "beta": null}')
+
+        self.change_cwd_to_sandbox_dither_dir()
+
+    def host_output_path(self, hostname, name):
+        return os.path.join(
+                self.build_output_dir, dither.build.HOSTS_SUBDIR, hostname,
+                LATEST_BUILD_LINK_NAME, name)
+
+    def runTest(self):
+        dither.build.build_hosts(self.host_list_path)
+
+        for hostname in ('alpha', 'beta'):
+            with open(self.host_output_path(hostname, '.hostname')) as f:
+                self.assertEqual(f.read().strip(), hostname)
+        self.assertTrue(
+                os.path.samefile(
+                    self.host_output_path('alpha', '.shared'),
+                    self.host_output_path('beta', '.shared')),
+                "Host-independent output was rendered for each host")
+
+class Test_profile_records_each_template(
+        CreateDitherSandboxDirMixin,
+        DitherIntegrationTestCase):
+
+    def setUp(self):
+        self.create_dither_sandbox_dir()
+
+        create_test_template(self.templates_dir)
+        create_test_context(self.templates_dir)
+
+        self.change_cwd_to_sandbox_dither_dir()
+
+    def runTest(self):
+        profiler = dither.timing.Profiler()
+        dither.build.build(profiler=profiler)
+
+        template_events = [
+                event for event in profiler.events
+                if event['category'] == 'template']
+        self.assertEqual(
+                [event['name'] for event in template_events],
+                ['.test.template'])
+        self.assertGreater(template_events[0]['bytes'], 0)
+        self.assertIn('context', [
+                event['name'] for event in profiler.events
+                if event['category'] == 'phase'])
+
+class Test_large_output_streamed_to_disk(
+        CreateDitherSandboxDirMixin,
+        DitherIntegrationTestCase):
+
+    LINE_COUNT = 100000
+
+    def setUp(self):
+        self.create_dither_sandbox_dir()
+
+        template_path = os.path.join(self.templates_dir, '.test.template')
+        with open(template_path, 'w') as f:
+            f.write(
+                    "{% for i in range(" + str(self.LINE_COUNT) + ") %}"
+                    "host-{{ i }}.example.com ssh-ed25519 AAAAC3Nza\n"
+                    "{% endfor %}")
+        create_test_context(self.templates_dir)
+
+        self.change_cwd_to_sandbox_dither_dir()
+
+    def runTest(self):
+        tracemalloc.start()
+        try:
+            dither.build.build()
+            _unused, peak_size = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        output_size = os.path.getsize(
+                find_templated_file(self.build_output_dir))
+        self.assertGreater(
+                output_size, 4 * dither.build.IN_MEMORY_OUTPUT_LIMIT)
+        self.assertLess(
+                peak_size, 2 * dither.build.IN_MEMORY_OUTPUT_LIMIT,
+                "Rendered output was held in memory")
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,66 @@
+import os
+import unittest
+
+import dither.build
+import dither.catalogue
+import dither.fingerprint
+import dither.link
+import dither.retention
+
+from common import (
+        DitherIntegrationTestCase,
+        CreateDitherSandboxDirMixin,
+        create_test_context,
+        build_version,
+        BUILD_OUTPUT_DIR,
+        TEST_TEMPLATED_FILE_NAME)
+
+
+class Test_builds_recorded_in_catalogue(
+        CreateDitherSandboxDirMixin,
+        DitherIntegrationTestCase):
+
+    def setUp(self):
+        self.create_dither_sandbox_dir()
+
+        self.template_path = os.path.join(
+                self.templates_dir, TEST_TEMPLATED_FILE_NAME + '.template')
+        create_test_context(self.templates_dir)
+
+        self.change_cwd_to_sandbox_dither_dir()
+
+    def runTest(self):
+        first_build = os.path.basename(
+                build_version(self.template_path, 1))
+        first_fingerprint = dither.fingerprint.TreeFingerprint.take(
+                self.templates_dir).digest()
+        second_build = os.path.basename(
+                build_version(self.template_path, 2))
+
+        build_catalogue = dither.catalogue.BuildCatalogue.open(
+                BUILD_OUTPUT_DIR)
+        records = build_catalogue.list_builds()
+        self.assertEqual(
+                [(record.id, record.status, record.file_count)
+                 for record in records],
+                [(first_build, dither.catalogue.COMPLETE, 1),
+                 (second_build, dither.catalogue.COMPLETE, 1)])
+        self.assertEqual(
+                build_catalogue.find_by_fingerprint(first_fingerprint).id,
+                first_build)
+
+        # Found without the latest_build link, or listing built_dotfiles
+        os.remove(os.path.join(
+                BUILD_OUTPUT_DIR, dither.build.LATEST_BUILD_LINK_NAME))
+        self.assertEqual(
+                dither.link.find_latest_build_subdir(BUILD_OUTPUT_DIR),
+                os.path.join(BUILD_OUTPUT_DIR, second_build))
+
+        dither.retention.gc(keep=1)
+        self.assertEqual(
+                [record.id for record in build_catalogue.list_builds(
+                    status=dither.catalogue.REMOVED)],
+                [first_build])
+
+if __name__ == '__main__':
+    unittest.main()
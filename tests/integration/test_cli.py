@@ -0,0 +1,89 @@
+import os
+import sys
+import subprocess
+import unittest
+
+import dither
+import dither.build
+
+from common import (
+        DitherIntegrationTestCase,
+        CreateDitherSandboxDirMixin,
+        create_test_template,
+        create_test_context)
+
+# Runs a dither command, then prints the heavy modules it imported
+RUN_DITHER_SCRIPT = '''\
+import sys
+from dither.cli import cli
+try:
+    cli(sys.argv[1:])
+except SystemExit:
+    pass
+print(' '.join(
+        name for name in ('jinja2', 'staticjinja') if name in sys.modules))
+'''
+
+
+class Test_link_and_noop_update_avoid_jinja2(
+        CreateDitherSandboxDirMixin,
+        DitherIntegrationTestCase):
+
+    def setUp(self):
+        self.create_dither_sandbox_dir()
+
+        create_test_template(self.templates_dir)
+        create_test_context(self.templates_dir)
+
+        self.change_cwd_to_sandbox_dither_dir()
+
+    def run_dither(self, *args):
+        env = dict(os.environ)
+        env['HOME'] = self.home_dir
+        env['PYTHONPATH'] = os.path.dirname(
+                os.path.dirname(os.path.abspath(dither.__file__)))
+        return subprocess.check_output(
+                [sys.executable, '-c', RUN_DITHER_SCRIPT] + list(args),
+                env=env,
+                stderr=subprocess.DEVNULL,
+                universal_newlines=True)
+
+    def runTest(self):
+        dither.build.build()
+
+        self.assertEqual(self.run_dither('link').strip(), '')
+        self.assertEqual(self.run_dither('update').strip(), '')
+        self.assertEqual(
+                self.run_dither('update', '--force').strip(),
+                'jinja2 staticjinja',
+                "Forced update didn't build")
+
+class Test_timing_imports_includes_click(
+        CreateDitherSandboxDirMixin,
+        DitherIntegrationTestCase):
+
+    def setUp(self):
+        self.create_dither_sandbox_dir()
+        self.change_cwd_to_sandbox_dither_dir()
+
+    def runTest(self):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(
+                os.path.dirname(os.path.abspath(dither.__file__)))
+        result = subprocess.run(
+                [sys.executable, '-m', 'dither.main', '--timing-imports',
+                 '--help'],
+                env=env,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                universal_newlines=True,
+                check=True)
+
+        imported_names = [
+                line.split()[-1] for line in result.stderr.splitlines()[1:]
+                if line.strip()]
+        self.assertIn('click', imported_names)
+        self.assertIn('dither.cli', imported_names)
+
+if __name__ == '__main__':
+    unittest.main()
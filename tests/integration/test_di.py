@@ -0,0 +1,156 @@
+import unittest
+
+import dither.di
+
+
+class Test_resources_cached_per_scope(unittest.TestCase):
+
+    def setUp(self):
+        self.providers = dither.di.ResourceProviderRegister()
+        self.calls = {}
+        for scope in dither.di.SCOPES:
+            self.providers.register_callable(
+                    self.make_provider(scope), scope, scope=scope)
+
+    def make_provider(self, scope):
+        def provider():
+            self.calls[scope] = self.calls.get(scope, 0) + 1
+            return object()
+        return provider
+
+    def runTest(self):
+        resolve = self.providers.resolve
+
+        self.assertIsNot(resolve('call'), resolve('call'))
+        self.assertIs(resolve('singleton'), resolve('singleton'))
+        with self.assertRaises(dither.di.NoBuildInProgressError):
+            resolve('build')
+
+        with self.providers.build_scope():
+            first_build_instance = resolve('build')
+            self.assertIs(resolve('build'), first_build_instance)
+            get_later = self.providers.defer('build')
+        with self.providers.build_scope(build='given'):
+            self.assertEqual(resolve('build'), 'given')
+
+        self.assertIs(get_later(), first_build_instance)
+        self.assertEqual(
+                self.calls, {'call': 2, 'singleton': 1, 'build': 1})
+
+class Test_injection_plans_follow_registrations(unittest.TestCase):
+
+    def setUp(self):
+        self.dependencies = dither.di.DependencyRegister()
+        self.providers = dither.di.ResourceProviderRegister()
+        self.resolver = dither.di.DependencyResolver(
+                dependency_register=self.dependencies,
+                resource_provider_register=self.providers)
+        self.providers.register_instance('a', 'first')
+        self.providers.register_instance('b', 'second')
+
+    def runTest(self):
+        depends_on = self.dependencies.register_by_decorator
+
+        @depends_on('first')
+        @depends_on('second')
+        def dependent():
+            pass
+
+        self.assertEqual(self.resolver.unpack(dependent), ['a', 'b'])
+
+        depends_on('third')(dependent)
+        with self.assertRaises(dither.di.ProviderNotFoundError):
+            self.resolver.unpack(dependent)
+
+        self.providers.register_instance('c', 'third')
+        self.assertEqual(
+                self.resolver.unpack(dependent), ['c', 'a', 'b'])
+
+class Test_provider_requirements_checked_and_initialised_in_order(
+        unittest.TestCase):
+
+    def setUp(self):
+        self.providers = dither.di.ResourceProviderRegister()
+        self.provided = []
+
+    def register(self, resource_name, requires=()):
+        def provider(*required):
+            self.provided.append(resource_name)
+            return (resource_name,) + required
+        self.providers.register_callable(
+                provider, resource_name, scope=dither.di.SINGLETON,
+                requires=requires)
+
+    def runTest(self):
+        self.register('top', requires=('middle', 'bottom'))
+        self.register('middle', requires=('bottom',))
+        with self.assertRaises(dither.di.ProviderNotFoundError):
+            self.providers.validate()
+        self.register('bottom')
+
+        with self.assertRaises(dither.di.DependencyCycleError) as raised:
+            self.register('start', requires=('top', 'start'))
+        self.assertEqual(raised.exception.cycle, ['start', 'start'])
+        self.register('a', requires=('b',))
+        with self.assertRaises(dither.di.DependencyCycleError) as raised:
+            self.register('b', requires=('a',))
+        self.assertEqual(raised.exception.cycle, ['b', 'a', 'b'])
+        self.assertNotIn('b', self.providers.resource_providers)
+        self.register('b')
+
+        # Long chains are sorted and provided without deep recursion
+        for i in range(5000):
+            self.register('link {}'.format(i + 1), requires=(
+                    'link {}'.format(i) if i else 'top',))
+        self.providers.validate()
+
+        self.providers.eager_init(['link 5000'])
+        self.assertEqual(self.provided[:3], ['bottom', 'middle', 'top'])
+        self.assertEqual(self.provided[-1], 'link 5000')
+        self.assertEqual(
+                self.providers.resolve('top'),
+                ('top', ('middle', ('bottom',)), ('bottom',)))
+
+class Test_deep_and_shared_requirements_injected(unittest.TestCase):
+
+    def setUp(self):
+        self.dependencies = dither.di.DependencyRegister()
+        self.providers = dither.di.ResourceProviderRegister()
+        self.resolver = dither.di.DependencyResolver(
+                dependency_register=self.dependencies,
+                resource_provider_register=self.providers)
+        self.provided = 0
+
+    def register(self, resource_name, requires=()):
+        def provider(*required):
+            self.provided += 1
+            return len(required) and max(required) + 1
+        self.providers.register_callable(
+                provider, resource_name, scope=dither.di.SINGLETON,
+                requires=requires)
+
+    def runTest(self):
+        # Longer than the recursion limit
+        self.register('chain 0')
+        for i in range(1, 3000):
+            self.register(
+                    'chain {}'.format(i),
+                    requires=('chain {}'.format(i - 1),))
+
+        # Each node requires both of the layer below, so there are 2 ** 24
+        # paths from top to bottom
+        self.register('left 0')
+        self.register('right 0')
+        for layer in range(1, 25):
+            below = ('left {}'.format(layer - 1), 'right {}'.format(layer - 1))
+            self.register('left {}'.format(layer), requires=below)
+            self.register('right {}'.format(layer), requires=below)
+
+        @self.dependencies.register_by_decorator('chain 2999')
+        @self.dependencies.register_by_decorator('left 24')
+        def dependent():
+            pass
+
+        self.assertEqual(self.resolver.unpack(dependent), [2999, 24])
+        # Each provided once, apart from 'right 24', which isn't needed
+        self.assertEqual(self.provided, 3000 + 49)
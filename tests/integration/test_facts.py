@@ -0,0 +1,56 @@
+import os
+import unittest
+
+import dither.facts
+
+from common import (
+        DitherIntegrationTestCase,
+        CreateDitherSandboxDirMixin,
+        BUILD_OUTPUT_DIR)
+
+
+class Test_facts_found_once_and_cached_until_expiry(
+        CreateDitherSandboxDirMixin,
+        DitherIntegrationTestCase):
+
+    def setUp(self):
+        self.create_dither_sandbox_dir()
+        self.change_cwd_to_sandbox_dither_dir()
+
+        self.probe_count = 0
+        self.now = 1000.0
+
+        @dither.facts.fact('test_probe', ttl=60)
+        def test_probe():
+            self.probe_count += 1
+            return 'value {}'.format(self.probe_count)
+        self.test_probe = test_probe
+
+    def tearDown(self):
+        dither.facts.providers.pop('test_probe', None)
+
+    def make_fact_set(self):
+        return dither.facts.FactSet(
+                cache_path=os.path.join(
+                    BUILD_OUTPUT_DIR, dither.facts.FACT_CACHE_NAME),
+                clock=lambda: self.now)
+
+    def look_up_in_new_build(self):
+        fact_set = self.make_fact_set()
+        with dither.facts.using(fact_set):
+            values = [self.test_probe(), self.test_probe()]
+        fact_set.save_cache()
+        return values
+
+    def runTest(self):
+        self.assertEqual(self.look_up_in_new_build(), ['value 1'] * 2)
+
+        self.now += 30
+        self.assertEqual(self.look_up_in_new_build(), ['value 1'] * 2)
+
+        self.now += 60
+        self.assertEqual(self.look_up_in_new_build(), ['value 2'] * 2)
+        self.assertEqual(self.probe_count, 2)
+
+if __name__ == '__main__':
+    unittest.main()
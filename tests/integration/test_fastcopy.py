@@ -0,0 +1,57 @@
+import os
+import errno
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+import dither.fastcopy
+
+
+class Test_copy_falls_back_to_next_method(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.source_path = os.path.join(self.temp_dir, 'source')
+        self.dest_path = os.path.join(self.temp_dir, 'dest')
+        self.content = os.urandom(64 * 1024 + 17)
+        with open(self.source_path, 'wb') as f:
+            f.write(self.content)
+        with open(self.dest_path, 'wb') as f:
+            f.write(b'longer stale content' * 8 * 1024)
+
+        self.patches = [
+                unittest.mock.patch.dict(dither.fastcopy._methods_by_devices),
+                unittest.mock.patch.dict(dither.fastcopy.COPY_FUNCS, {
+                    dither.fastcopy.REFLINK: self.fail_unsupported,
+                    dither.fastcopy.COPY_FILE_RANGE: self.fail_midway,
+                })]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in reversed(self.patches):
+            patch.stop()
+
+    def fail_unsupported(self, source_fd, dest_fd, size):
+        raise OSError(errno.EOPNOTSUPP, 'Operation not supported')
+
+    def fail_midway(self, source_fd, dest_fd, size):
+        os.write(dest_fd, os.read(source_fd, 1024))
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+    def runTest(self):
+        method = dither.fastcopy.copy_file(self.source_path, self.dest_path)
+
+        self.assertIn(
+                method, (dither.fastcopy.SENDFILE, dither.fastcopy.READ_WRITE))
+        with open(self.dest_path, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+
+        # Later copies start with whichever method worked
+        dev = os.stat(self.temp_dir).st_dev
+        self.assertEqual(dither.fastcopy.get_method(dev, dev), method)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import os
+import unittest
+import unittest.mock
+
+import dither.build
+import dither.fingerprint
+import dither.link
+import dither.manifest
+
+from common import (
+        DitherIntegrationTestCase,
+        CreateDitherSandboxDirMixin,
+        create_test_template,
+        create_test_context,
+        CONTEXT_NAME,
+        BUILD_OUTPUT_DIR)
+
+
+class Test_update_is_noop_until_templates_change(
+        CreateDitherSandboxDirMixin,
+        DitherIntegrationTestCase):
+
+    def setUp(self):
+        self.create_dither_sandbox_dir()
+
+        self.template_path = create_test_template(self.templates_dir)
+        create_test_context(self.templates_dir)
+
+        self.change_cwd_to_sandbox_dither_dir()
+
+    def runTest(self):
+        self.assertFalse(dither.fingerprint.is_installed_build_current())
+
+        dither.build.build()
+        self.assertFalse(
+                dither.fingerprint.is_installed_build_current(),
+                "Build counted as current before it was linked")
+
+        dither.link.link(
+                base_build_dir=BUILD_OUTPUT_DIR, home_dir=self.home_dir)
+        self.assertTrue(dither.fingerprint.is_installed_build_current())
+
+        # Touched, but not changed
+        stat = os.stat(self.template_path)
+        os.utime(
+                self.template_path,
+                ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertTrue(dither.fingerprint.is_installed_build_current())
+
+        with open(self.template_path, 'a') as f:
+            f.write('changed\n')
+        self.assertFalse(dither.fingerprint.is_installed_build_current())
+
+class Test_update_not_noop_when_context_changes(
+        CreateDitherSandboxDirMixin,
+        DitherIntegrationTestCase):
+
+    def setUp(self):
+        self.create_dither_sandbox_dir()
+
+        create_test_template(self.templates_dir)
+        self.context_path = os.path.join(self.templates_dir, CONTEXT_NAME)
+        with open(self.context_path, 'w') as f:
+            f.write('''\
+import os
+
+def get_context(**kwargs):
+    return {'test_var': os.environ.get('DITHER_TEST_VAR')}
+''')
+        patch = unittest.mock.patch.dict(
+                os.environ, {'DITHER_TEST_VAR': 'first value'})
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        self.change_cwd_to_sandbox_dither_dir()
+
+    def build_and_link(self):
+        dither.build.build()
+        dither.link.link(
+                base_build_dir=BUILD_OUTPUT_DIR, home_dir=self.home_dir)
+
+    def runTest(self):
+        self.build_and_link()
+        self.assertTrue(dither.fingerprint.is_installed_build_current())
+
+        os.environ['DITHER_TEST_VAR'] = 'second value'
+        self.assertFalse(dither.fingerprint.is_installed_build_current())
+
+        # Lazy values can't be checked without computing them
+        with open(self.context_path, 'w') as f:
+            f.write('''\
+from dither.context import lazy
+
+def get_context(**kwargs):
+    return {'test_var': lazy(lambda: 'lazy value')}
+''')
+        self.build_and_link()
+        self.assertFalse(dither.fingerprint.is_installed_build_current())
+
+class Test_unchanged_files_not_hashed_again(
+        CreateDitherSandboxDirMixin,
+        DitherIntegrationTestCase):
+
+    def setUp(self):
+        self.create_dither_sandbox_dir()
+
+        create_test_template(self.templates_dir)
+        create_test_context(self.templates_dir)
+
+    def runTest(self):
+        previous = dither.fingerprint.TreeFingerprint.take(self.templates_dir)
+        with unittest.mock.patch.object(
+                dither.manifest, 'hash_file',
+                wraps=dither.manifest.hash_file) as hash_file:
+            fingerprint = dither.fingerprint.TreeFingerprint.take(
+                    self.templates_dir, previous=previous)
+
+        hash_file.assert_not_called()
+        self.assertEqual(fingerprint.digest(), previous.digest())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -100,5 +100,178 @@ class Test_build_output_readable_in_home_dir(TestLinkTestCase):
         self.assertEqual(build_output.strip(), 'Test build output',
                 "Built file in home dir doesn't contain expected build output")
 
+class Test_relink_switches_to_new_build(TestLinkTestCase):
+
+    def _create_second_build_output(self, file_names):
+        second_build_subdir = self.os.path.join(
+                self.build_output_dir, 'built_at_yyyy')
+        self.os.mkdir(second_build_subdir)
+        for file_name in file_names:
+            with open(self.os.path.join(second_build_subdir, file_name),
+                      'w') as f:
+                f.write('Second build output\n')
+        self.os.remove(self.os.path.join(
+                self.build_output_dir, LATEST_BUILD_SYMLINK_NAME))
+        self.os.symlink('built_at_yyyy', self.os.path.join(
+                self.build_output_dir, LATEST_BUILD_SYMLINK_NAME))
+        return second_build_subdir
+
+    def runTest(self):
+        dither.link.link(
+                base_build_dir=self.build_output_dir,
+                home_dir=self.home_dir)
+
+        second_build_subdir = self._create_second_build_output(
+                [BUILD_OUTPUT_FILE_NAME, '.newfile'])
+        dither.link.link(
+                base_build_dir=self.build_output_dir,
+                home_dir=self.home_dir)
+
+        self.assert_is_link_pointing_to(
+                self.installed_build_link_path, second_build_subdir,
+                "installed_build link doesn't point to the new build")
+        with open(self.built_file_in_home_dir, 'r') as f:
+            self.assertEqual(f.read().strip(), 'Second build output')
+        with open(self.os.path.join(self.home_dir, '.newfile'), 'r') as f:
+            self.assertEqual(f.read().strip(), 'Second build output')
+        self.assertEqual(
+                [name for name in self.os.listdir(self.build_output_dir)
+                    if '.tmp-' in name],
+                [],
+                "Temporary symlinks were left behind")
+
+class Test_link_removed_for_file_no_longer_built(
+        Test_relink_switches_to_new_build):
+
+    def runTest(self):
+        dither.link.link(
+                base_build_dir=self.build_output_dir,
+                home_dir=self.home_dir)
+
+        self._create_second_build_output(['.newfile'])
+        dither.link.link(
+                base_build_dir=self.build_output_dir,
+                home_dir=self.home_dir)
+
+        self.assertFalse(
+                self.os.path.lexists(self.built_file_in_home_dir),
+                "Link to file no longer in build wasn't removed")
+        self.assert_is_link(self.os.path.join(self.home_dir, '.newfile'))
+
+class Test_nested_files_linked_recursively(TestLinkTestCase):
+
+    def _create_nested_output(self, build_subdir, nested_paths):
+        for nested_path in nested_paths:
+            output_path = self.os.path.join(build_subdir, nested_path)
+            self.os.makedirs(self.os.path.dirname(output_path), exist_ok=True)
+            with open(output_path, 'w') as f:
+                f.write('Nested output\n')
+
+    def runTest(self):
+        init_path = self.os.path.join('.config', 'nvim', 'init.vim')
+        self._create_nested_output(self.build_output_subdir, [init_path])
+        # Linked whole to begin with, as it was before --recursive
+        dither.link.link(
+                base_build_dir=self.build_output_dir,
+                home_dir=self.home_dir)
+
+        # Files already in ~/.config which dither doesn't build are kept
+        self.os.remove(self.os.path.join(self.home_dir, '.config'))
+        self.os.mkdir(self.os.path.join(self.home_dir, '.config'))
+        user_file_path = self.os.path.join(self.home_dir, '.config', 'mine')
+        with open(user_file_path, 'w') as f:
+            f.write('Not built\n')
+
+        dither.link.link(
+                base_build_dir=self.build_output_dir,
+                home_dir=self.home_dir,
+                recursive=True)
+
+        home_init_path = self.os.path.join(self.home_dir, init_path)
+        self.assert_is_link_pointing_to(
+                home_init_path,
+                self.os.path.join(self.dot_dither_dotfiles_link_path, init_path))
+        with open(home_init_path, 'r') as f:
+            self.assertEqual(f.read(), 'Nested output\n')
+        self.assertFalse(self.os.path.islink(
+                self.os.path.join(self.home_dir, '.config', 'nvim')))
+        self.assert_is_link(self.built_file_in_home_dir)
+        self.assertTrue(self.os.path.isfile(user_file_path))
+
+        # Later links stay recursive, and remove directories they empty
+        self.os.remove(
+                self.os.path.join(self.build_output_subdir, init_path))
+        dither.link.link(
+                base_build_dir=self.build_output_dir,
+                home_dir=self.home_dir)
+
+        self.assertFalse(self.os.path.lexists(
+                self.os.path.join(self.home_dir, '.config', 'nvim')))
+        self.assertTrue(self.os.path.isfile(user_file_path))
+
+class Test_existing_files_moved_aside_when_linking_recursively(
+        Test_nested_files_linked_recursively):
+
+    def runTest(self):
+        init_path = self.os.path.join('.config', 'nvim', 'init.vim')
+        self._create_nested_output(self.build_output_subdir, [init_path])
+        existing_paths = [self.built_file_in_home_dir,
+                          self.os.path.join(self.home_dir, init_path)]
+        self._create_nested_output(self.home_dir, [init_path])
+        with open(self.built_file_in_home_dir, 'w') as f:
+            f.write('Existing file\n')
+
+        dither.link.link(
+                base_build_dir=self.build_output_dir,
+                home_dir=self.home_dir,
+                recursive=True)
+
+        for existing_path in existing_paths:
+            self.assert_is_link(existing_path)
+            existing_dir, existing_name = self.os.path.split(existing_path)
+            self.assertEqual(
+                    len([name for name in self.os.listdir(existing_dir)
+                         if name.startswith(existing_name + '.moved_by_')]),
+                    1,
+                    "{} wasn't moved aside".format(existing_path))
+
+class Test_concurrent_links_kept_in_order_per_path(unittest.TestCase):
+
+    def runTest(self):
+        applied = []
+
+        def apply(path, step):
+            if path == 'broken':
+                raise PermissionError('Permission denied')
+            applied.append((path, step))
+
+        actions = [
+                dither.link.LinkAction(path, apply, (path, step))
+                for step in range(3)
+                for path in ['a', 'broken', 'b', 'c']]
+        errors = dither.link.apply_link_actions(actions, jobs=4)
+
+        self.assertEqual(
+                [path for path, error in errors], ['broken'] * 3)
+        for path in ['a', 'b', 'c']:
+            self.assertEqual(
+                    [step for applied_path, step in applied
+                        if applied_path == path],
+                    [0, 1, 2])
+
+class Test_concurrent_link_of_many_files(Test_relink_switches_to_new_build):
+
+    def runTest(self):
+        file_names = ['.file{}'.format(i) for i in range(50)]
+        self._create_second_build_output(file_names)
+        dither.link.link(
+                base_build_dir=self.build_output_dir,
+                home_dir=self.home_dir,
+                jobs=8)
+
+        for file_name in file_names:
+            with open(self.os.path.join(self.home_dir, file_name), 'r') as f:
+                self.assertEqual(f.read().strip(), 'Second build output')
+
 if __name__ == '__main__':
     unittest.main()
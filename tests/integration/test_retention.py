@@ -0,0 +1,110 @@
+import os
+import time
+import unittest
+import unittest.mock
+
+import dither.catalogue
+import dither.link
+import dither.manifest
+import dither.retention
+import dither.store
+
+from common import (
+        DitherIntegrationTestCase,
+        CreateDitherSandboxDirMixin,
+        create_test_context,
+        build_version,
+        BUILD_OUTPUT_DIR,
+        TEST_TEMPLATED_FILE_NAME)
+
+
+class Test_gc_keeps_newest_and_installed_builds(
+        CreateDitherSandboxDirMixin,
+        DitherIntegrationTestCase):
+
+    def setUp(self):
+        self.create_dither_sandbox_dir()
+
+        self.template_path = os.path.join(
+                self.templates_dir, TEST_TEMPLATED_FILE_NAME + '.template')
+        create_test_context(self.templates_dir)
+
+        self.change_cwd_to_sandbox_dither_dir()
+
+    def runTest(self):
+        installed_build = build_version(self.template_path, 1)
+        dither.link.link(
+                base_build_dir=BUILD_OUTPUT_DIR, home_dir=self.home_dir)
+        removed_build = build_version(self.template_path, 2)
+        removed_object_stat = os.stat(
+                os.path.join(removed_build, TEST_TEMPLATED_FILE_NAME))
+        latest_build = build_version(self.template_path, 3)
+
+        with unittest.mock.patch.object(
+                dither.retention, 'PRUNE_GRACE_SECONDS', 0):
+            removed, pruned = dither.retention.gc(keep=1)
+
+        self.assertEqual(removed, [removed_build])
+        self.assertFalse(os.path.exists(removed_build))
+        self.assertEqual(
+                removed_object_stat.st_nlink, 2,
+                "Output wasn't linked from the object store")
+        self.assertEqual(pruned, 1)
+        self.assertEqual(
+                [name for name, _unused in
+                 dither.retention.list_builds(BUILD_OUTPUT_DIR)],
+                [os.path.basename(installed_build),
+                 os.path.basename(latest_build)])
+
+class Test_recently_stored_objects_not_pruned(
+        CreateDitherSandboxDirMixin,
+        DitherIntegrationTestCase):
+
+    def setUp(self):
+        self.create_dither_sandbox_dir()
+
+        self.template_path = os.path.join(
+                self.templates_dir, TEST_TEMPLATED_FILE_NAME + '.template')
+        create_test_context(self.templates_dir)
+
+        self.change_cwd_to_sandbox_dither_dir()
+
+    def runTest(self):
+        removed_build = build_version(self.template_path, 1)
+        object_path = dither.store.ObjectStore(
+                dither.retention.OBJECT_STORE_DIR).get_object_path(
+                    dither.manifest.hash_file(os.path.join(
+                        removed_build, TEST_TEMPLATED_FILE_NAME)))
+        build_version(self.template_path, 2)
+        build_version(self.template_path, 3)
+
+        removed, pruned = dither.retention.gc(keep=1)
+        self.assertIn(removed_build, removed)
+        self.assertEqual(pruned, 0)
+        self.assertTrue(os.path.exists(object_path))
+
+        # Older than the grace period, but not than a running build
+        now = time.time()
+        stored_at = now - 2 * dither.retention.PRUNE_GRACE_SECONDS
+        os.utime(object_path, (stored_at, stored_at))
+        build_catalogue = dither.catalogue.BuildCatalogue.open(
+                BUILD_OUTPUT_DIR)
+        build_catalogue.record_started('running', built_at=stored_at - 1)
+        cutoff = dither.retention.find_prune_cutoff([BUILD_OUTPUT_DIR])
+        self.assertEqual(cutoff, stored_at - 1)
+        self.assertEqual(
+                dither.retention.prune_objects(
+                    dither.retention.OBJECT_STORE_DIR, cutoff=cutoff),
+                0)
+
+        build_catalogue.record_failed('running')
+        self.assertEqual(
+                dither.retention.prune_objects(
+                    dither.retention.OBJECT_STORE_DIR,
+                    cutoff=dither.retention.find_prune_cutoff(
+                        [BUILD_OUTPUT_DIR])),
+                1)
+        self.assertFalse(os.path.exists(object_path))
+
+if __name__ == '__main__':
+    unittest.main()
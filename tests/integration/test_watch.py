@@ -0,0 +1,139 @@
+import os
+import unittest
+
+import dither.build
+import dither.link
+import dither.watch
+
+from common import (
+        DitherIntegrationTestCase,
+        CreateDitherSandboxDirMixin,
+        create_test_context,
+        CONTEXT_NAME,
+        BUILD_OUTPUT_DIR,
+        LATEST_BUILD_LINK_NAME)
+
+
+class WatchTestCase(
+        CreateDitherSandboxDirMixin,
+        DitherIntegrationTestCase):
+
+    def setUp(self):
+        self.create_dither_sandbox_dir()
+
+        self.write_template_file(
+                '.test.template', "{% include '_partial.tpl' %}\n")
+        self.write_template_file('_partial.tpl', 'first version\n')
+        create_test_context(self.templates_dir)
+
+        self.change_cwd_to_sandbox_dither_dir()
+
+        renderer = dither.build.build()
+        dither.link.link(
+                base_build_dir=BUILD_OUTPUT_DIR, home_dir=self.home_dir)
+        self.watcher = dither.watch.Watcher(
+                renderer,
+                base_build_dir=BUILD_OUTPUT_DIR,
+                home_dir=self.home_dir,
+                manifest_path=dither.build.MANIFEST_PATH)
+
+    def write_template_file(self, name, contents):
+        file_path = os.path.join(self.templates_dir, name)
+        with open(file_path, 'w') as f:
+            f.write(contents)
+        return file_path
+
+    def read_home_file(self, name):
+        with open(os.path.join(self.home_dir, name), 'r') as f:
+            return f.read()
+
+class Test_partial_change_updates_including_template(WatchTestCase):
+
+    def runTest(self):
+        latest_build = os.path.realpath(
+                os.path.join(BUILD_OUTPUT_DIR, LATEST_BUILD_LINK_NAME))
+
+        changed_path = self.write_template_file(
+                '_partial.tpl', 'second version\n')
+        self.watcher.handle_changes([changed_path])
+
+        self.assertEqual(
+                self.read_home_file('.test').strip(), 'second version')
+        self.assertEqual(
+                os.path.realpath(
+                    os.path.join(BUILD_OUTPUT_DIR, LATEST_BUILD_LINK_NAME)),
+                latest_build,
+                "Latest build should be updated in place, not rebuilt")
+
+class Test_new_template_linked_into_home_dir(WatchTestCase):
+
+    def runTest(self):
+        new_path = self.write_template_file('.new.template', 'new file\n')
+        self.watcher.handle_changes([new_path])
+
+        self.assertEqual(self.read_home_file('.new').strip(), 'new file')
+
+class Test_context_change_rerenders_templates(WatchTestCase):
+
+    def runTest(self):
+        self.watcher.handle_changes([
+                self.write_template_file('_partial.tpl', '{{ test_var }}\n')])
+        self.assertEqual(self.read_home_file('.test').strip(), 'Test value')
+
+        context_path = self.write_template_file(CONTEXT_NAME, """\
+def get_context(**kwargs):
+    return {'test_var': 'Changed value'}
+""")
+        self.watcher.handle_changes([context_path])
+
+        self.assertEqual(
+                self.read_home_file('.test').strip(), 'Changed value')
+
+class Test_context_change_reuses_unaffected_templates(WatchTestCase):
+
+    def runTest(self):
+        self.watcher.handle_changes([
+                self.write_template_file('_partial.tpl', '{{ test_var }}\n'),
+                self.write_template_file(
+                    '.other.template', '{{ test_true }}\n')])
+
+        context_path = self.write_template_file(CONTEXT_NAME, """\
+def get_context(**kwargs):
+    return {'test_true': True, 'test_var': 'Changed value'}
+""")
+        self.watcher.handle_changes([context_path])
+
+        # Only .other.template doesn't use test_var
+        self.assertEqual(self.watcher.renderer.output_counts['reused'], 1)
+        self.assertEqual(
+                self.read_home_file('.test').strip(), 'Changed value')
+        self.assertEqual(self.read_home_file('.other').strip(), 'True')
+
+class Test_nested_templates_relinked_recursively(WatchTestCase):
+
+    def runTest(self):
+        os.makedirs(os.path.join(self.templates_dir, '.config', 'nvim'))
+        removed_path = self.write_template_file(
+                os.path.join('.config', 'nvim', 'init.vim.template'),
+                'init\n')
+        self.watcher.handle_changes([removed_path])
+        dither.link.link(
+                base_build_dir=BUILD_OUTPUT_DIR, home_dir=self.home_dir,
+                recursive=True)
+
+        new_path = self.write_template_file(
+                os.path.join('.config', 'nvim', 'foo.vim.template'),
+                'foo\n')
+        self.watcher.handle_changes([new_path])
+        self.assertEqual(
+                self.read_home_file(
+                    os.path.join('.config', 'nvim', 'foo.vim')).strip(),
+                'foo')
+
+        os.remove(removed_path)
+        self.watcher.handle_changes([removed_path])
+        self.assertFalse(os.path.lexists(os.path.join(
+                self.home_dir, '.config', 'nvim', 'init.vim')))
+
+if __name__ == '__main__':
+    unittest.main()